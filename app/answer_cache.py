@@ -0,0 +1,116 @@
+import hashlib
+import logging
+import re
+from collections import OrderedDict
+
+from app.db import (
+    answer_cache_get,
+    answer_cache_put,
+    answer_cache_hit,
+    answer_cache_size,
+)
+
+# Кэш готовых ответов: память (LRU по байтам) → SQLite (TTL + вытеснение по объёму, см. app/db.py)
+MEM_MAX_BYTES = 32 * 1024 * 1024
+
+log = logging.getLogger(__name__)
+
+_mem: OrderedDict[str, str] = OrderedDict()
+_mem_bytes = 0
+_stats = {"mem_hits": 0, "db_hits": 0, "misses": 0}
+
+# Приводим разные записи одного и того же к одному виду
+_FOLD = str.maketrans({
+    "ё": "е",
+    "×": "*", "·": "*", "∙": "*",
+    "÷": "/",
+    "−": "-", "–": "-", "—": "-",
+    "«": '"', "»": '"', "“": '"', "”": '"', "„": '"', "'": '"', "’": '"',
+    "²": "^2", "³": "^3",
+    "√": "sqrt",
+})
+_SPACES_AROUND = re.compile(r"\s*([-+*/=^(),.;:!?<>\"])\s*")
+_REPEATED_PUNCT = re.compile(r"([-!?.,;:\"])\1+")
+_SPACES = re.compile(r"\s+")
+_BARE_SQRT = re.compile(r"sqrt\s*([0-9a-zа-я.]+)")
+
+
+def normalize_task(text: str) -> str:
+    """
+    Нормальная форма условия: регистр, пробелы, кавычки/тире и запись формул
+    (x² = x^2, √5 = sqrt(5), 2×3 = 2*3) не влияют на результат.
+    Сами знаки препинания не выкидываем — в заданиях по русскому они и есть условие.
+    """
+    t = text.lower().translate(_FOLD)
+    t = _BARE_SQRT.sub(r"sqrt(\1)", t)
+    t = _SPACES_AROUND.sub(r"\1", t)
+    t = _REPEATED_PUNCT.sub(r"\1", t)
+    t = _SPACES.sub(" ", t)
+    return t.strip(" .!")
+
+
+def cache_namespace(model: str, system: str) -> str:
+    # модель и промпт: поменяли любой из них → старые ответы (и похожие задачи) просто перестают находиться
+    system_hash = hashlib.sha256(system.encode()).hexdigest()[:16]
+    return f"{model}\0{system_hash}"
+
+
+def answer_key(text: str, model: str, system: str) -> str:
+    raw = f"{cache_namespace(model, system)}\0{normalize_task(text)}"
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+def _mem_put(key: str, answer: str):
+    global _mem_bytes
+    old = _mem.pop(key, None)
+    if old is not None:
+        _mem_bytes -= len(old.encode())
+
+    _mem[key] = answer
+    _mem_bytes += len(answer.encode())
+    while _mem_bytes > MEM_MAX_BYTES and _mem:
+        _, evicted = _mem.popitem(last=False)
+        _mem_bytes -= len(evicted.encode())
+
+
+async def get_answer(key: str) -> str | None:
+    answer = _mem.get(key)
+    if answer is not None:
+        _mem.move_to_end(key)
+        _stats["mem_hits"] += 1
+        answer_cache_hit(key)
+        return answer
+
+    answer = await answer_cache_get(key)
+    if answer is None:
+        _stats["misses"] += 1
+        return None
+
+    _stats["db_hits"] += 1
+    _mem_put(key, answer)
+    return answer
+
+
+async def put_answer(key: str, answer: str):
+    if not answer:
+        return
+    _mem_put(key, answer)
+    try:
+        await answer_cache_put(key, answer)
+    except Exception:
+        # ответ у юзера уже есть, кэш — не повод падать
+        log.exception("answer cache write failed")
+
+
+async def answer_cache_stats() -> dict:
+    total = _stats["mem_hits"] + _stats["db_hits"] + _stats["misses"]
+    hits = _stats["mem_hits"] + _stats["db_hits"]
+    db_size = await answer_cache_size()
+    return {
+        **_stats,
+        "hit_ratio": hits / total if total else 0.0,
+        "mem_entries": len(_mem),
+        "mem_bytes": _mem_bytes,
+        "db_entries": db_size["entries"],
+        "db_bytes": db_size["bytes"],
+    }
@@ -8,7 +8,35 @@ MISTRAL_API_KEY = os.getenv("MISTRAL_API_KEY")
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY", "")
 ADMIN_IDS = {int(x.strip()) for x in (os.getenv("ADMIN_IDS") or "").split(",") if x.strip().isdigit()}
 
+# HTTP-пул к Mistral: сколько держим соединений и таймауты (секунды)
+MISTRAL_POOL_SIZE = int(os.getenv("MISTRAL_POOL_SIZE", "10"))
+MISTRAL_CONNECT_TIMEOUT = float(os.getenv("MISTRAL_CONNECT_TIMEOUT", "5"))
+MISTRAL_READ_TIMEOUT = float(os.getenv("MISTRAL_READ_TIMEOUT", "60"))
 
-if not BOT_TOKEN:
-    raise ValueError("BOT_TOKEN is missing in .env") #чтобы бот не стартовал “пустым” и не падал потом непонятно где
+# Потолки адаптивного лимита одновременных запросов (стартуем с 5, дальше лимит подстраивается сам)
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "50"))
+OCR_MAX_CONCURRENCY = int(os.getenv("OCR_MAX_CONCURRENCY", "20"))
 
+# Gemini (OCR): HTTP-пул и срок на одну попытку запроса (секунды; повторы — сверху, см. app/resilience.py)
+GEMINI_POOL_SIZE = int(os.getenv("GEMINI_POOL_SIZE", "10"))
+OCR_TIMEOUT = float(os.getenv("OCR_TIMEOUT", "30"))
+
+# Сколько фото одновременно разжимаем и уменьшаем (отдельные потоки; каждое — до ~50 МБ памяти на пике,
+# см. MAX_DECODED_PIXELS в app/vision.py)
+IMAGE_DECODE_WORKERS = int(os.getenv("IMAGE_DECODE_WORKERS", "2"))
+
+# Хедж: если ответ дольше обычного p95 — шлём второй такой же запрос и берём первый ответ (дороже, но без хвостов)
+AI_HEDGING = os.getenv("AI_HEDGING", "0") == "1"
+
+# Как списывать кредиты: answers — 1 за ответ, tokens — 1 за каждые TOKENS_PER_CREDIT токенов (минимум 1)
+BILLING_MODE = os.getenv("BILLING_MODE", "answers")
+TOKENS_PER_CREDIT = int(os.getenv("TOKENS_PER_CREDIT", "3000"))
+
+# Ответ ИИ показываем по мере генерации (правками сообщения); 0 — отправлять целиком
+STREAM_ANSWERS = os.getenv("STREAM_ANSWERS", "1") != "0"
+
+# Модель и потолок ответа — по сложности задачи (простое — маленькой модели); 0 — всё в mistral-small без потолка
+MODEL_ROUTING = os.getenv("MODEL_ROUTING", "1") != "0"
+
+# Похожая задача (оценка Жаккара по MinHash) не ниже порога → отдаём уже готовый ответ
+NEAR_DUP_THRESHOLD = float(os.getenv("NEAR_DUP_THRESHOLD", "0.85"))
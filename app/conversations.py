@@ -0,0 +1,138 @@
+import re
+import time
+from collections import OrderedDict
+
+# Память для доп. вопросов после ответа: последняя задача, ответ и уточнения.
+# Всё в памяти процесса и ограничено: токенов на юзера, время простоя, число сессий и токенов всего.
+MAX_TOKENS_PER_USER = 1500
+DIGEST_MAX_TOKENS = 300
+SESSION_TTL = 30 * 60
+MAX_SESSIONS = 20_000
+GLOBAL_MAX_TOKENS = 5_000_000
+CHARS_PER_TOKEN = 3  # грубо для русского текста; точный счёт тут не нужен
+
+# user_id -> сессия; порядок = давность последнего обращения (LRU)
+_sessions: OrderedDict[int, dict] = OrderedDict()
+_total_tokens = 0
+_stats = {"evicted_ttl": 0, "evicted_lru": 0, "digested": 0}
+
+_FINAL = re.compile(r"🎯[^\n]*\n?(.*)", re.S)
+
+
+def _tokens(text: str) -> int:
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def _session_tokens(s: dict) -> int:
+    # с дайджестом в контекст идёт и исходное условие (topic)
+    fixed = _tokens(s["digest"]) + _tokens(s["topic"]) if s["digest"] else 0
+    return fixed + sum(_tokens(q) + _tokens(a) for q, a in s["turns"])
+
+
+def _final_answer(answer: str) -> str:
+    # из ответа по формату бота в дайджест идёт только итог («🎯 Ответ»)
+    m = _FINAL.search(answer)
+    final = (m.group(1) if m else answer).strip()
+    return " ".join(final.split())[:200]
+
+
+def _shrink(text: str, max_tokens: int) -> str:
+    # одна реплика больше лимита → начало + итог в конце
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    if len(text) <= max_chars:
+        return text
+    tail = max_chars // 3
+    return text[:max_chars - tail - 1] + "…" + text[-tail:]
+
+
+def _fit(s: dict):
+    # старые реплики → строчка в дайджесте, пока не влезем в лимит; последняя остаётся целиком (или сжатой)
+    while len(s["turns"]) > 1 and _session_tokens(s) > MAX_TOKENS_PER_USER:
+        q, a = s["turns"].pop(0)
+        line = f"— {' '.join(q.split())[:150]} → {_final_answer(a)}"
+        s["digest"] = f"{s['digest']}\n{line}" if s["digest"] else line
+        _stats["digested"] += 1
+
+    while _tokens(s["digest"]) > DIGEST_MAX_TOKENS and "\n" in s["digest"]:
+        s["digest"] = s["digest"].split("\n", 1)[1]  # самое старое — первым
+    s["digest"] = _shrink(s["digest"], DIGEST_MAX_TOKENS)
+
+    if _session_tokens(s) > MAX_TOKENS_PER_USER:
+        q, a = s["turns"][-1]
+        budget = MAX_TOKENS_PER_USER - (_tokens(s["digest"]) + _tokens(s["topic"]) if s["digest"] else 0)
+        q = _shrink(q, budget // 3)
+        s["turns"][-1] = (q, _shrink(a, budget - _tokens(q)))
+
+
+def _drop(user_id: int):
+    global _total_tokens
+    s = _sessions.pop(user_id, None)
+    if s is not None:
+        _total_tokens -= s["tokens"]
+
+
+def _evict(now: float):
+    # сначала протухшие (они в начале LRU), потом — самые давние, пока не влезем в общий лимит
+    while _sessions:
+        user_id, s = next(iter(_sessions.items()))
+        if now - s["touched"] > SESSION_TTL:
+            _stats["evicted_ttl"] += 1
+        elif len(_sessions) > MAX_SESSIONS or _total_tokens > GLOBAL_MAX_TOKENS:
+            _stats["evicted_lru"] += 1
+        else:
+            return
+        _drop(user_id)
+
+
+def _save(user_id: int, s: dict):
+    global _total_tokens
+    _fit(s)
+    old = _sessions.get(user_id)
+    if old is not None:
+        _total_tokens -= old["tokens"]
+    s["tokens"] = _session_tokens(s)
+    s["touched"] = time.monotonic()
+    _sessions[user_id] = s
+    _sessions.move_to_end(user_id)
+    _total_tokens += s["tokens"]
+    _evict(s["touched"])
+
+
+def start(user_id: int, task: str, answer: str):
+    """
+    Новая задача решена → прошлый разговор забываем, начинаем новый.
+    """
+    _drop(user_id)
+    _save(user_id, {"topic": task[:500], "digest": "", "turns": [(task, answer)]})
+
+
+def add_turn(user_id: int, question: str, answer: str):
+    s = _sessions.get(user_id)
+    if s is None:
+        return
+    s["turns"].append((question, answer))
+    _save(user_id, s)
+
+
+def context(user_id: int) -> dict | None:
+    """
+    {"topic": условие задачи, "digest": кратко о старом, "history": [сообщения user/assistant]}
+    или None, если сессии нет (не было или протухла).
+    """
+    s = _sessions.get(user_id)
+    if s is None:
+        return None
+    if time.monotonic() - s["touched"] > SESSION_TTL:
+        _stats["evicted_ttl"] += 1
+        _drop(user_id)
+        return None
+
+    history = []
+    for q, a in s["turns"]:
+        history.append({"role": "user", "content": q})
+        history.append({"role": "assistant", "content": a})
+    return {"topic": s["topic"], "digest": s["digest"], "history": history}
+
+
+def conversation_stats() -> dict:
+    return {**_stats, "sessions": len(_sessions), "tokens": _total_tokens}
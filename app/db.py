@@ -1,75 +1,416 @@
+import asyncio
+import logging
 import aiosqlite
+from contextlib import asynccontextmanager
 from pathlib import Path
 import time
+from collections import OrderedDict
 
 DB_PATH = Path(__file__).resolve().parent.parent / "bot.db"
 
-async def init_db():
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            user_id INTEGER PRIMARY KEY,
-            created_at INTEGER NOT NULL,
-            plan TEXT NOT NULL DEFAULT 'free',
-            referred_by INTEGER,
-            username TEXT
-        )
-        """)
-        try:
-            await db.execute("ALTER TABLE users ADD COLUMN credits INTEGER NOT NULL DEFAULT 5;")
-        except Exception:
-            pass
-        
-        try:
-            await db.execute("ALTER TABLE users ADD COLUMN last_daily_refill INTEGER;")
-        except Exception:
-            pass    
-        
-        try:
-            await db.execute("ALTER TABLE users ADD COLUMN last_active INTEGER;")
-        except Exception:
-            pass    
+log = logging.getLogger(__name__)
+
+# Пул соединений: один писатель + несколько читателей (WAL позволяет читать параллельно с записью)
+READERS_POOL_SIZE = 3
+STATEMENT_CACHE_SIZE = 256  # sqlite3 кэширует подготовленные запросы на каждом соединении
+
+_writer: aiosqlite.Connection | None = None
+_write_lock: asyncio.Lock | None = None
+_readers: asyncio.Queue | None = None
+_all_readers: list[aiosqlite.Connection] = []
+
+# Отложенная запись активности: user_id -> last_seen, сбрасывается в базу пачкой
+ACTIVITY_FLUSH_INTERVAL = 5  # секунд
+_dirty_seen: dict[int, int] = {}
+_flush_task: asyncio.Task | None = None
+_stop_flush: asyncio.Event | None = None
+
+# usage_events тоже пишем пачками; сырые события старше RAW_RETENTION сворачиваются
+# в почасовые/посуточные агрегаты (usage_rollup) и удаляются
+_pending_usage: list[tuple[int, int]] = []
+USAGE_ROLLUP_INTERVAL = 60 * 60
+USAGE_RAW_RETENTION = 2 * 24 * 60 * 60
+USAGE_HOURLY_RETENTION = 30 * 24 * 60 * 60
+
+# Счётчики daily_metrics, которые не пишутся в чужой транзакции: (day, metric) -> +n
+_pending_metrics: dict[tuple[int, str], int] = {}
+
+# Токены ИИ: (day, user_id, model) -> [вызовов, prompt, completion], в базу — пачкой в token_usage.
+# Самые тяжёлые вызовы дня (с началом условия) — в token_heavy, не больше TOKEN_HEAVY_PER_DAY на день
+_pending_tokens: dict[tuple[int, int, str], list[int]] = {}
+_pending_heavy: list[tuple] = []
+TOKEN_HEAVY_PER_DAY = 50
+TOKEN_HEAVY_RETENTION_DAYS = 30
+
+# Кэш ответов (см. app/answer_cache.py): срок жизни и предельный объём таблицы answer_cache
+ANSWER_CACHE_TTL = 30 * 24 * 60 * 60
+ANSWER_CACHE_MAX_BYTES = 200 * 1024 * 1024
+_pending_answer_hits: dict[str, int] = {}  # key -> время последнего попадания
+# near_dup чистим пачками по id: писатель занят короткими транзакциями, а не одной на всю таблицу.
+# id удалённых строк забирает app/near_dup.py — выкинуть их из индекса в памяти
+NEAR_DUP_PRUNE_BATCH = 5000
+_pruned_near_dup: list[int] = []
+
+# Кэш условий с фото (см. app/ocr_cache.py): строка живёт, пока к ней обращаются, и строк не больше MAX_ROWS
+OCR_CACHE_TTL = 60 * 24 * 60 * 60
+OCR_CACHE_MAX_ROWS = 100_000
+_pending_ocr_hits: dict[int, int] = {}  # id строки -> время последнего попадания
+_pruned_ocr_cache: list[int] = []  # id вытесненных строк — забирает индекс похожих в app/ocr_cache.py
+
+# Кэш строк users: процесс бота — единственный писатель, поэтому кэш обновляется
+# сквозной записью (write-through) в тех же функциях, что пишут в базу
+USER_CACHE_SIZE = 50_000
+_user_cache: OrderedDict[int, dict] = OrderedDict()
+_cache_hits = 0
+_cache_misses = 0
+
+
+async def _connect() -> aiosqlite.Connection:
+    conn = await aiosqlite.connect(DB_PATH, cached_statements=STATEMENT_CACHE_SIZE)
+    await conn.execute("PRAGMA journal_mode=WAL")
+    await conn.execute("PRAGMA synchronous=NORMAL")  # в WAL этого достаточно, fsync только на чекпоинте
+    await conn.execute("PRAGMA busy_timeout=5000")
+    return conn
+
+
+async def open_pool():
+    """
+    Открывает долгоживущие соединения. Повторный вызов ничего не делает.
+    """
+    global _writer, _readers, _write_lock
+    if _writer is not None:
+        return
+
+    _write_lock = asyncio.Lock()
+    _writer = await _connect()
+    _readers = asyncio.Queue()
+    for _ in range(READERS_POOL_SIZE):
+        conn = await _connect()
+        await conn.execute("PRAGMA query_only=ON")
+        _all_readers.append(conn)
+        _readers.put_nowait(conn)
+
+
+async def close_db():
+    """
+    Закрывает все соединения (вызывается при остановке бота).
+    """
+    global _writer, _readers, _flush_task
+    if _writer is None:
+        return
+
+    if _flush_task is not None:
+        # не отменяем посреди сброса: цикл доделает текущую пачку и выйдет сам
+        _stop_flush.set()
+        await _flush_task
+        _flush_task = None
+    await flush_all()  # не теряем то, что накопилось с последнего сброса
+
+    async with _write_lock:
+        await _writer.close()
+        _writer = None
+
+    for conn in _all_readers:
+        await conn.close()
+    _all_readers.clear()
+    _readers = None
+
+
+@asynccontextmanager
+async def _read():
+    # берём свободного читателя из пула и обязательно возвращаем обратно
+    if _writer is None:
+        await open_pool()
+    conn = await _readers.get()
+    try:
+        yield conn
+    finally:
+        _readers.put_nowait(conn)
+
+
+@asynccontextmanager
+async def _write():
+    # писатель один → транзакции сериализуем локом, коммит/откат делаем здесь
+    if _writer is None:
+        await open_pool()
+    async with _write_lock:
         try:
-            await db.execute("ALTER TABLE users ADD COLUMN last_active_at INTEGER;")
-        except Exception:
-            pass            
-        await db.execute("""
-        CREATE TABLE IF NOT EXISTS referrals (
-            inviter_id INTEGER NOT NULL,
-            invitee_id INTEGER NOT NULL UNIQUE,
-            created_at INTEGER NOT NULL
-        )
-        """)
-
-        # События “запросов” (для лимитов)
-        await db.execute("""
-        CREATE TABLE IF NOT EXISTS usage_events (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            ts INTEGER NOT NULL
-        )
-        """)
-
-        await db.execute("CREATE INDEX IF NOT EXISTS idx_usage_user_ts ON usage_events(user_id, ts)")
-        await db.execute("""
-        UPDATE users
-        SET last_active_at = COALESCE(last_active_at, created_at),
-        last_active    = COALESCE(last_active, created_at)
-        WHERE last_active_at IS NULL OR last_active IS NULL
-        """)
-        
-        await db.execute("""
-        CREATE TABLE IF NOT EXISTS ref_milestones (
-            inviter_id INTEGER NOT NULL,
-            milestone INTEGER NOT NULL,
-            created_at INTEGER NOT NULL,
-            UNIQUE(inviter_id, milestone)
-        )
-        """)
-
-
-        await db.commit()
-        
+            yield _writer
+        except BaseException:
+            await _writer.rollback()
+            raise
+        await _writer.commit()
+
+
+async def _add_column(db, table: str, column: str, decl: str):
+    cur = await db.execute(f"PRAGMA table_info({table})")
+    columns = {r[1] for r in await cur.fetchall()}
+    if column not in columns:
+        await db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
+
+async def _m001_base_schema(db):
+    # для старых баз без schema_version: таблицы уже могут быть → IF NOT EXISTS и проверка колонок
+    await db.execute("""
+    CREATE TABLE IF NOT EXISTS users (
+        user_id INTEGER PRIMARY KEY,
+        created_at INTEGER NOT NULL,
+        plan TEXT NOT NULL DEFAULT 'free',
+        referred_by INTEGER,
+        username TEXT
+    )
+    """)
+    await _add_column(db, "users", "credits", "INTEGER NOT NULL DEFAULT 5")
+    await _add_column(db, "users", "last_daily_refill", "INTEGER")
+    await _add_column(db, "users", "last_active", "INTEGER")
+    await _add_column(db, "users", "last_active_at", "INTEGER")
+
+    await db.execute("""
+    CREATE TABLE IF NOT EXISTS referrals (
+        inviter_id INTEGER NOT NULL,
+        invitee_id INTEGER NOT NULL UNIQUE,
+        created_at INTEGER NOT NULL
+    )
+    """)
+
+    # События “запросов” (для лимитов)
+    await db.execute("""
+    CREATE TABLE IF NOT EXISTS usage_events (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        ts INTEGER NOT NULL
+    )
+    """)
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_usage_user_ts ON usage_events(user_id, ts)")
+
+    await db.execute("""
+    CREATE TABLE IF NOT EXISTS ref_milestones (
+        inviter_id INTEGER NOT NULL,
+        milestone INTEGER NOT NULL,
+        created_at INTEGER NOT NULL,
+        UNIQUE(inviter_id, milestone)
+    )
+    """)
+
+
+async def _m002_backfill_last_active(db):
+    await db.execute("""
+    UPDATE users
+    SET last_active_at = COALESCE(last_active_at, created_at),
+    last_active    = COALESCE(last_active, created_at)
+    WHERE last_active_at IS NULL OR last_active IS NULL
+    """)
+
+
+async def _m003_usage_rollup(db):
+    # Агрегаты usage_events: period 'h' — час (bucket = начало часа), 'd' — сутки (bucket = _day_key)
+    await db.execute("""
+    CREATE TABLE IF NOT EXISTS usage_rollup (
+        period TEXT NOT NULL,
+        bucket INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        n INTEGER NOT NULL,
+        PRIMARY KEY (period, bucket, user_id)
+    ) WITHOUT ROWID
+    """)
+
+
+async def _m004_stats_indexes_and_daily_metrics(db):
+    # /stats и карточка юзера без полных сканов
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_users_created_at ON users(created_at)")
+    await db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_users_last_seen ON users(COALESCE(last_active_at, last_active))"
+    )
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_referrals_inviter ON referrals(inviter_id)")
+
+    # Счётчики по дням (day = _day_key): new_users, active_users, solves, ocr_calls, referrals
+    await db.execute("""
+    CREATE TABLE IF NOT EXISTS daily_metrics (
+        day INTEGER NOT NULL,
+        metric TEXT NOT NULL,
+        n INTEGER NOT NULL,
+        PRIMARY KEY (day, metric)
+    ) WITHOUT ROWID
+    """)
+
+    # то, что можно восстановить из истории (активность по дням не хранилась)
+    await db.execute("""
+    INSERT OR IGNORE INTO daily_metrics(day, metric, n)
+    SELECT CAST(strftime('%Y%m%d', created_at, 'unixepoch') AS INTEGER), 'new_users', COUNT(*)
+    FROM users GROUP BY 1
+    """)
+    await db.execute("""
+    INSERT OR IGNORE INTO daily_metrics(day, metric, n)
+    SELECT CAST(strftime('%Y%m%d', created_at, 'unixepoch') AS INTEGER), 'referrals', COUNT(*)
+    FROM referrals GROUP BY 1
+    """)
+
+
+async def _m005_invited_count(db):
+    # денормализованный счётчик приглашённых вместо COUNT(*) по referrals
+    await _add_column(db, "users", "invited_count", "INTEGER NOT NULL DEFAULT 0")
+    await db.execute("""
+    UPDATE users
+    SET invited_count = (SELECT COUNT(*) FROM referrals r WHERE r.inviter_id = users.user_id)
+    WHERE user_id IN (SELECT inviter_id FROM referrals)
+    """)
+
+
+async def _m006_answer_cache(db):
+    await db.execute("""
+    CREATE TABLE IF NOT EXISTS answer_cache (
+        key TEXT PRIMARY KEY,
+        answer TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        created_at INTEGER NOT NULL,
+        last_hit_at INTEGER NOT NULL,
+        hits INTEGER NOT NULL DEFAULT 0
+    )
+    """)
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_answer_cache_last_hit ON answer_cache(last_hit_at)")
+
+
+async def _m007_near_dup(db):
+    # MinHash-подписи решённых задач (см. app/near_dup.py) → ключ ответа в answer_cache
+    await db.execute("""
+    CREATE TABLE IF NOT EXISTS near_dup (
+        id INTEGER PRIMARY KEY,
+        answer_key TEXT NOT NULL,
+        nums INTEGER NOT NULL,
+        sig BLOB NOT NULL,
+        created_at INTEGER NOT NULL
+    )
+    """)
+
+
+async def _m008_token_usage(db):
+    # одна строка на юзера × день × модель, а не на каждый вызов
+    await db.execute("""
+    CREATE TABLE IF NOT EXISTS token_usage (
+        day INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        model TEXT NOT NULL,
+        calls INTEGER NOT NULL,
+        prompt_tokens INTEGER NOT NULL,
+        completion_tokens INTEGER NOT NULL,
+        PRIMARY KEY (day, user_id, model)
+    ) WITHOUT ROWID
+    """)
+    await db.execute("""
+    CREATE TABLE IF NOT EXISTS token_heavy (
+        id INTEGER PRIMARY KEY,
+        day INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        model TEXT NOT NULL,
+        prompt_tokens INTEGER NOT NULL,
+        completion_tokens INTEGER NOT NULL,
+        task TEXT NOT NULL,
+        created_at INTEGER NOT NULL
+    )
+    """)
+    await db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_token_heavy_day_total ON token_heavy(day, prompt_tokens + completion_tokens)"
+    )
+
+
+async def _m009_ocr_cache(db):
+    # условие, считанное с фото. dhash/thumb — только у фото, которые реально читал Gemini:
+    # строки, найденные по похожести, лишь привязывают новый file_unique_id/sha256 к тому же тексту
+    await db.execute("""
+    CREATE TABLE IF NOT EXISTS ocr_cache (
+        id INTEGER PRIMARY KEY,
+        file_unique_id TEXT,
+        sha256 TEXT NOT NULL,
+        dhash BLOB,
+        thumb BLOB,
+        text TEXT NOT NULL,
+        created_at INTEGER NOT NULL,
+        last_hit_at INTEGER NOT NULL
+    )
+    """)
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_ocr_cache_file ON ocr_cache(file_unique_id)")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_ocr_cache_sha ON ocr_cache(sha256)")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_ocr_cache_last_hit ON ocr_cache(last_hit_at)")
+
+
+# Миграции схемы: (версия, название, функция). Только дописывать в конец, версии не менять!
+MIGRATIONS = [
+    (1, "base schema", _m001_base_schema),
+    (2, "backfill last_active", _m002_backfill_last_active),
+    (3, "usage_rollup", _m003_usage_rollup),
+    (4, "stats indexes + daily_metrics", _m004_stats_indexes_and_daily_metrics),
+    (5, "users.invited_count", _m005_invited_count),
+    (6, "answer_cache", _m006_answer_cache),
+    (7, "near_dup", _m007_near_dup),
+    (8, "token_usage", _m008_token_usage),
+    (9, "ocr_cache", _m009_ocr_cache),
+]
+
+
+async def init_db():
+    global _flush_task, _stop_flush
+    await open_pool()
+    async with _write() as db:
+        await db.execute("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)")
+        cur = await db.execute("SELECT MAX(version) FROM schema_version")
+        (current,) = await cur.fetchone()
+    current = current or 0
+
+    for version, name, step in MIGRATIONS:
+        if version <= current:
+            continue
+
+        t0 = time.perf_counter()
+        async with _write() as db:
+            # явный BEGIN: DDL тоже попадает в транзакцию → шаг применяется целиком или никак
+            await db.execute("BEGIN")
+            await step(db)
+            await db.execute("INSERT INTO schema_version(version) VALUES (?)", (version,))
+        log.info("migration %s (%s) applied in %.1f ms", version, name, (time.perf_counter() - t0) * 1000)
+
+    # фоновые сбросы и часовое обслуживание — только когда все таблицы и индексы уже есть
+    if _flush_task is None:
+        _stop_flush = asyncio.Event()
+        _flush_task = asyncio.create_task(_background_loop())
+
+
+# порядок колонок = порядок полей в _cache_put
+_CACHED_COLS = "credits, last_daily_refill, username, plan"
+
+
+def _cache_get(user_id: int) -> dict | None:
+    global _cache_hits, _cache_misses
+    entry = _user_cache.get(user_id)
+    if entry is None:
+        _cache_misses += 1
+        return None
+    _user_cache.move_to_end(user_id)
+    _cache_hits += 1
+    return entry
+
+
+def _cache_put(user_id: int, row) -> None:
+    # вызывать только после успешного коммита, иначе кэш разойдётся с базой
+    credits, last_daily_refill, username, plan = row
+    _user_cache[user_id] = {
+        "credits": int(credits or 0),
+        "last_daily_refill": last_daily_refill,
+        "username": username,
+        "plan": plan,
+    }
+    _user_cache.move_to_end(user_id)
+    while len(_user_cache) > USER_CACHE_SIZE:
+        _user_cache.popitem(last=False)
+
+
+def user_cache_stats() -> dict:
+    total = _cache_hits + _cache_misses
+    return {
+        "size": len(_user_cache),
+        "hits": _cache_hits,
+        "misses": _cache_misses,
+        "hit_ratio": _cache_hits / total if total else 0.0,
+    }
 
 
 async def ensure_user(user_id: int, username: str | None = None) -> bool:
@@ -78,52 +419,213 @@ async def ensure_user(user_id: int, username: str | None = None) -> bool:
     Возвращает True — если пользователь НОВЫЙ
     Возвращает False — если уже был
     """
+    entry = _cache_get(user_id)
+    if entry is not None and (username is None or entry["username"] == username):
+        return False  # горячий путь: юзер есть, username не менялся → базу не трогаем
+
+    async with _write() as db:
+        row, is_new = await _ensure_user_in_tx(db, user_id, username)
+
+    _cache_put(user_id, row)
+    return is_new
+
+
+async def _ensure_user_in_tx(db, user_id: int, username: str | None = None, referred_by: int | None = None):
+    """
+    Тело ensure_user для вызова внутри открытой _write()-транзакции.
+    Возвращает (строка для кэша, is_new).
+    """
     now = int(time.time())
+    cur = await db.execute(
+        f"SELECT {_CACHED_COLS} FROM users WHERE user_id = ?",
+        (user_id,)
+    )
+    row = await cur.fetchone()
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute(
-            "SELECT 1 FROM users WHERE user_id = ?",
-            (user_id,)
+    if not row:
+        # новый пользователь → даём стартовые 5 кредитов
+        await db.execute(
+            """
+            INSERT INTO users(user_id, created_at, username, credits, last_active_at, last_active, referred_by)
+            VALUES (?, ?, ?, 5, ?, ?, ?)
+            """,
+            (user_id, now, username,  now, now, referred_by)
         )
-        exists = await cur.fetchone()
+        await _bump_in_tx(db, "new_users", day=_day_key(now))
+        await _bump_in_tx(db, "active_users", day=_day_key(now))
+        return (5, None, username, "free"), True
 
-        if not exists:
-            # новый пользователь → даём стартовые 5 кредитов
-            await db.execute(
-                """
-                INSERT INTO users(user_id, created_at, username, credits, last_active_at, last_active)
-                VALUES (?, ?, ?, 5, ?, ?)
-                """,
-                (user_id, now, username,  now, now)   # ✅ 5 параметра под 5 знака ?
+    # пользователь уже есть → обновляем username (если появился или сменился)
+    if username is not None and row[2] != username:
+        await db.execute(
+            "UPDATE users SET username = ? WHERE user_id = ?",
+            (username, user_id)
+        )
+        row = (row[0], row[1], username, row[3])
+
+    return row, False
+
+
+async def register_referral(
+    inviter_id: int,
+    invitee_id: int,
+    invitee_username: str | None = None,
+    bonus: int = 5,
+    milestones: tuple[int, ...] = (),
+) -> dict:
+    """
+    /start по реф-ссылке одной транзакцией:
+    создаёт обоих юзеров (если нет), пишет реферала, начисляет бонус пригласившему,
+    увеличивает его invited_count и отмечает пройденные milestones.
+
+    Возвращает {"is_new": приглашённый новый?, "invited": новый счётчик или None,
+    "milestones": впервые пройденные пороги}.
+    Реферал засчитывается только новому юзеру и не самому себе.
+    """
+    result = {"is_new": False, "invited": None, "milestones": []}
+    now = int(time.time())
+    inviter_row = None
+
+    async with _write() as db:
+        invitee_row, is_new = await _ensure_user_in_tx(
+            db, invitee_id, invitee_username,
+            referred_by=inviter_id if inviter_id != invitee_id else None
+        )
+        result["is_new"] = is_new
+
+        if is_new and inviter_id != invitee_id:
+            inviter_row, _ = await _ensure_user_in_tx(db, inviter_id)
+
+            cur = await db.execute(
+                "INSERT OR IGNORE INTO referrals(inviter_id, invitee_id, created_at) VALUES(?, ?, ?)",
+                (inviter_id, invitee_id, now),
             )
-            await db.commit()
-            return True
+            if cur.rowcount == 1:
+                cur = await db.execute(
+                    f"""
+                    UPDATE users
+                    SET credits = COALESCE(credits, 0) + ?, invited_count = invited_count + 1
+                    WHERE user_id = ?
+                    RETURNING invited_count, {_CACHED_COLS}
+                    """,
+                    (bonus, inviter_id)
+                )
+                invited, *inviter_row = await cur.fetchone()
+                result["invited"] = int(invited)
+                await _bump_in_tx(db, "referrals", day=_day_key(now))
 
-        # пользователь уже есть → обновляем username (если появился)
-        if username is not None:
-            await db.execute(
-                "UPDATE users SET username = ? WHERE user_id = ?",
-                (username, user_id)
+                for m in milestones:
+                    if invited < m:
+                        continue
+                    cur = await db.execute(
+                        "INSERT OR IGNORE INTO ref_milestones(inviter_id, milestone, created_at) VALUES(?, ?, ?)",
+                        (inviter_id, m, now)
+                    )
+                    if cur.rowcount == 1:
+                        result["milestones"].append(m)
+
+    _cache_put(invitee_id, invitee_row)
+    if inviter_row is not None:
+        _cache_put(inviter_id, inviter_row)
+    return result
+
+
+async def add_usage(user_id: int, ts: int):
+    # в базу уйдёт пачкой вместе с активностью (см. flush_usage)
+    _pending_usage.append((user_id, ts))
+
+
+async def flush_usage():
+    global _pending_usage
+    if not _pending_usage:
+        return
+
+    batch, _pending_usage = _pending_usage, []
+    try:
+        async with _write() as db:
+            await db.executemany(
+                "INSERT INTO usage_events(user_id, ts) VALUES(?, ?)",
+                batch
             )
-            await db.commit()
+    except BaseException:
+        _pending_usage = batch + _pending_usage
+        raise
 
-        return False
 
+async def remove_usage(user_id: int):
+    """
+    Убирает последнее событие юзера: кредит вернули — решение не считается и в лимит частоты.
+    """
+    for i in range(len(_pending_usage) - 1, -1, -1):
+        if _pending_usage[i][0] == user_id:
+            del _pending_usage[i]
+            return
+    async with _write() as db:
+        await db.execute(
+            """
+            DELETE FROM usage_events WHERE id = (
+                SELECT id FROM usage_events WHERE user_id = ? ORDER BY ts DESC, id DESC LIMIT 1
+            )
+            """,
+            (user_id,)
+        )
 
 
+async def recent_usage(user_id: int, since_ts: int) -> list[int]:
+    """
+    Метки времени событий юзера начиная с since_ts (по возрастанию).
+    """
+    await flush_usage()
+    async with _read() as db:
+        cur = await db.execute(
+            "SELECT ts FROM usage_events WHERE user_id = ? AND ts >= ? ORDER BY ts",
+            (user_id, since_ts)
+        )
+        rows = await cur.fetchall()
+        return [int(r[0]) for r in rows]
 
 
-async def add_usage(user_id: int, ts: int):
-    async with aiosqlite.connect(DB_PATH) as db:
+async def rollup_usage(now: int | None = None):
+    """
+    Сворачивает сырые события старше USAGE_RAW_RETENTION в usage_rollup и удаляет их.
+    Почасовые агрегаты старше USAGE_HOURLY_RETENTION тоже удаляются (посуточные остаются).
+    """
+    now = now or int(time.time())
+    cutoff = now - USAGE_RAW_RETENTION
+    await flush_usage()
+
+    async with _write() as db:
+        # сворачиваем ровно те строки, которые сейчас удалим → двойного счёта нет
+        await db.execute(
+            """
+            INSERT INTO usage_rollup(period, bucket, user_id, n)
+            SELECT 'h', ts / 3600 * 3600, user_id, COUNT(*)
+            FROM usage_events WHERE ts < ?
+            GROUP BY 2, 3
+            ON CONFLICT(period, bucket, user_id) DO UPDATE SET n = n + excluded.n
+            """,
+            (cutoff,)
+        )
+        await db.execute(
+            """
+            INSERT INTO usage_rollup(period, bucket, user_id, n)
+            SELECT 'd', CAST(strftime('%Y%m%d', ts, 'unixepoch') AS INTEGER), user_id, COUNT(*)
+            FROM usage_events WHERE ts < ?
+            GROUP BY 2, 3
+            ON CONFLICT(period, bucket, user_id) DO UPDATE SET n = n + excluded.n
+            """,
+            (cutoff,)
+        )
+        await db.execute("DELETE FROM usage_events WHERE ts < ?", (cutoff,))
         await db.execute(
-            "INSERT INTO usage_events(user_id, ts) VALUES(?, ?)",
-            (user_id, ts)
+            "DELETE FROM usage_rollup WHERE period = 'h' AND bucket < ?",
+            (now - USAGE_HOURLY_RETENTION,)
         )
-        await db.commit()
 
 
 async def count_usage(user_id: int, since_ts: int) -> int:
-    async with aiosqlite.connect(DB_PATH) as db:
+    await flush_usage()
+    async with _read() as db:
         cur = await db.execute(
             "SELECT COUNT(*) FROM usage_events WHERE user_id = ? AND ts >= ?",
             (user_id, since_ts)
@@ -133,7 +635,8 @@ async def count_usage(user_id: int, since_ts: int) -> int:
 
 
 async def oldest_usage_ts(user_id: int, since_ts: int) -> int | None:
-    async with aiosqlite.connect(DB_PATH) as db:
+    await flush_usage()
+    async with _read() as db:
         cur = await db.execute(
             "SELECT MIN(ts) FROM usage_events WHERE user_id = ? AND ts >= ?",
             (user_id, since_ts)
@@ -147,55 +650,138 @@ def _day_key(ts: int | None = None) -> int:
 
 
 async def get_credits(user_id: int) -> int:
-    async with aiosqlite.connect(DB_PATH) as db:
+    entry = _cache_get(user_id)
+    if entry is not None:
+        return entry["credits"]
+
+    async with _read() as db:
         cur = await db.execute("SELECT credits FROM users WHERE user_id = ?", (user_id,))
         row = await cur.fetchone()
         return int(row[0]) if row and row[0] is not None else 0
 
 
 async def spend_credit(user_id: int, amount: int = 1) -> bool:
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("SELECT credits FROM users WHERE user_id = ?", (user_id,))
-        row = await cur.fetchone()
-        credits = int(row[0]) if row and row[0] is not None else 0
-
-        if credits < amount:
-            return False
+    entry = _cache_get(user_id)
+    if entry is not None and entry["credits"] < amount:
+        return False
 
-        await db.execute(
-            "UPDATE users SET credits = credits - ? WHERE user_id = ?",
-            (amount, user_id)
+    async with _write() as db:
+        cur = await db.execute(
+            f"UPDATE users SET credits = credits - ? WHERE user_id = ? AND credits >= ? RETURNING {_CACHED_COLS}",
+            (amount, user_id, amount)
         )
-        await db.commit()
-        return True
+        row = await cur.fetchone()
+
+    if not row:
+        return False
+    _cache_put(user_id, row)
+    return True
 
 
 async def daily_refill(user_id: int, per_day: int = 2):
     today = _day_key()
-    async with aiosqlite.connect(DB_PATH) as db:
+    entry = _cache_get(user_id)
+    if entry is not None and entry["last_daily_refill"] == today:
+        return
+
+    async with _write() as db:
         cur = await db.execute(
-            "SELECT last_daily_refill FROM users WHERE user_id = ?",
-            (user_id,)
+            f"""
+            UPDATE users SET credits = credits + ?, last_daily_refill = ?
+            WHERE user_id = ? AND last_daily_refill IS NOT ?
+            RETURNING {_CACHED_COLS}
+            """,
+            (per_day, today, user_id, today)
         )
         row = await cur.fetchone()
-        last = row[0] if row else None
 
-        if last == today:
-            return
+    if row:
+        _cache_put(user_id, row)
 
-        await db.execute(
-            "UPDATE users SET credits = credits + ?, last_daily_refill = ? WHERE user_id = ?",
-            (per_day, today, user_id)
+
+async def charge(user_id: int, amount: int = 1, per_day: int = 2) -> int | None:
+    """
+    Ежедневное начисление + списание за одну транзакцию.
+    Возвращает новый баланс или None, если кредитов не хватило (тогда ничего не списано).
+    amount=0 — просто узнать баланс (с учётом начисления).
+    """
+    today = _day_key()
+    entry = _cache_get(user_id)
+    refilled = entry is not None and entry["last_daily_refill"] == today
+    if refilled:
+        # по кэшу всё известно: отказ или просмотр баланса — без базы
+        if entry["credits"] < amount:
+            return None
+        if amount == 0:
+            return entry["credits"]
+
+    async with _write() as db:
+        # начисление срабатывает только если сегодня его ещё не было
+        if not refilled:
+            await db.execute(
+                """
+                UPDATE users
+                SET credits = COALESCE(credits, 0) + ?, last_daily_refill = ?
+                WHERE user_id = ? AND last_daily_refill IS NOT ?
+                """,
+                (per_day, today, user_id, today)
+            )
+
+        # списание только при достаточном балансе → гонки между SELECT и UPDATE нет
+        cur = await db.execute(
+            f"""
+            UPDATE users
+            SET credits = credits - ?
+            WHERE user_id = ? AND credits >= ?
+            RETURNING {_CACHED_COLS}
+            """,
+            (amount, user_id, amount)
         )
-        await db.commit()
+        row = await cur.fetchone()
+        charged = row is not None
 
-async def add_credits(user_id: int, delta: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
-            "UPDATE users SET credits = COALESCE(credits, 0) + ? WHERE user_id = ?",
+        if not charged:
+            # не хватило — всё равно запомним актуальный баланс, чтобы следующий отказ был без базы
+            cur = await db.execute(f"SELECT {_CACHED_COLS} FROM users WHERE user_id = ?", (user_id,))
+            row = await cur.fetchone()
+
+    if row:
+        _cache_put(user_id, row)
+    return int(row[0]) if charged else None
+
+
+async def add_credits(user_id: int, delta: int) -> int | None:
+    """
+    Возвращает новый баланс или None, если юзера нет в базе.
+    """
+    async with _write() as db:
+        cur = await db.execute(
+            f"UPDATE users SET credits = COALESCE(credits, 0) + ? WHERE user_id = ? RETURNING {_CACHED_COLS}",
             (delta, user_id),
         )
-        await db.commit()
+        row = await cur.fetchone()
+
+    if not row:
+        return None
+    _cache_put(user_id, row)
+    return int(row[0])
+
+
+async def debit(user_id: int, amount: int) -> int | None:
+    """
+    Списать до amount кредитов (баланс не уходит в минус). Новый баланс или None, если юзера нет.
+    """
+    async with _write() as db:
+        cur = await db.execute(
+            f"UPDATE users SET credits = MAX(COALESCE(credits, 0) - ?, 0) WHERE user_id = ? RETURNING {_CACHED_COLS}",
+            (amount, user_id),
+        )
+        row = await cur.fetchone()
+
+    if not row:
+        return None
+    _cache_put(user_id, row)
+    return int(row[0])
 
 
 async def apply_referral(inviter_id: int, invitee_id: int) -> bool:
@@ -207,34 +793,581 @@ async def apply_referral(inviter_id: int, invitee_id: int) -> bool:
         return False
 
     now = int(time.time())
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _write() as db:
         cur = await db.execute(
             "INSERT OR IGNORE INTO referrals(inviter_id, invitee_id, created_at) VALUES(?, ?, ?)",
             (inviter_id, invitee_id, now),
         )
-        await db.commit()
 
         # rowcount == 1 -> реально вставили новую запись
-        return cur.rowcount == 1
+        if cur.rowcount != 1:
+            return False
+        await db.execute(
+            "UPDATE users SET invited_count = invited_count + 1 WHERE user_id = ?",
+            (inviter_id,)
+        )
+        await _bump_in_tx(db, "referrals", day=_day_key(now))
+        return True
 
 async def touch_user(user_id: int):
+    # без коммита на каждое сообщение: просто помечаем, в базу уйдёт пачкой
+    _dirty_seen[user_id] = int(time.time())
+
+
+async def flush_activity():
+    """
+    Записывает накопленную активность одной транзакцией (executemany).
+    """
+    global _dirty_seen
+    if not _dirty_seen:
+        return
+
+    batch, _dirty_seen = _dirty_seen, {}
+    try:
+        async with _write() as db:
+            # предыдущая активность нужна, чтобы посчитать "первый раз за день" → active_users
+            prev: dict[int, int | None] = {}
+            ids = list(batch)
+            for i in range(0, len(ids), 500):
+                chunk = ids[i:i + 500]
+                cur = await db.execute(
+                    f"SELECT user_id, COALESCE(last_active_at, last_active) FROM users "
+                    f"WHERE user_id IN ({','.join('?' * len(chunk))})",
+                    chunk
+                )
+                prev.update(await cur.fetchall())
+
+            await db.executemany(
+                "UPDATE users SET last_active = ?, last_active_at = ? WHERE user_id = ?",
+                [(ts, ts, uid) for uid, ts in batch.items()]
+            )
+
+            first_today: dict[int, int] = {}
+            for uid, ts in batch.items():
+                if uid not in prev:
+                    continue  # юзера ещё нет в базе
+                day = _day_key(ts)
+                if prev[uid] is None or _day_key(prev[uid]) < day:
+                    first_today[day] = first_today.get(day, 0) + 1
+            for day, n in first_today.items():
+                await _bump_in_tx(db, "active_users", n, day=day)
+    except BaseException:
+        # не удалось (или отменили посреди записи) — возвращаем обратно, более свежие отметки не перетираем
+        for uid, ts in batch.items():
+            _dirty_seen[uid] = max(ts, _dirty_seen.get(uid, 0))
+        raise
+
+
+async def _bump_in_tx(db, metric: str, n: int = 1, day: int | None = None):
+    # для вызова внутри уже открытой _write()-транзакции
+    await db.execute(
+        """
+        INSERT INTO daily_metrics(day, metric, n) VALUES (?, ?, ?)
+        ON CONFLICT(day, metric) DO UPDATE SET n = n + excluded.n
+        """,
+        (day or _day_key(), metric, n)
+    )
+
+
+def bump_metric(metric: str, n: int = 1):
+    """
+    +n к счётчику за сегодня (solves, ocr_calls, ...). В базу уходит пачкой.
+    """
+    key = (_day_key(), metric)
+    _pending_metrics[key] = _pending_metrics.get(key, 0) + n
+
+
+async def flush_metrics():
+    global _pending_metrics
+    if not _pending_metrics:
+        return
+
+    batch, _pending_metrics = _pending_metrics, {}
+    try:
+        async with _write() as db:
+            await db.executemany(
+                """
+                INSERT INTO daily_metrics(day, metric, n) VALUES (?, ?, ?)
+                ON CONFLICT(day, metric) DO UPDATE SET n = n + excluded.n
+                """,
+                [(day, metric, n) for (day, metric), n in batch.items()]
+            )
+    except BaseException:
+        for key, n in batch.items():
+            _pending_metrics[key] = _pending_metrics.get(key, 0) + n
+        raise
+
+
+async def answer_cache_get(key: str) -> str | None:
     now = int(time.time())
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _read() as db:
+        cur = await db.execute(
+            "SELECT answer FROM answer_cache WHERE key = ? AND created_at >= ?",
+            (key, now - ANSWER_CACHE_TTL)
+        )
+        row = await cur.fetchone()
+
+    if not row:
+        return None
+    _pending_answer_hits[key] = now
+    return row[0]
+
+
+async def answer_cache_put(key: str, answer: str):
+    now = int(time.time())
+    async with _write() as db:
         await db.execute(
-            "UPDATE users SET last_active = ?, last_active_at = ? WHERE user_id = ?",
-            (now, now,  user_id)
+            """
+            INSERT OR REPLACE INTO answer_cache(key, answer, size, created_at, last_hit_at, hits)
+            VALUES (?, ?, ?, ?, ?, 0)
+            """,
+            (key, answer, len(answer.encode()), now, now)
+        )
+
+
+def answer_cache_hit(key: str):
+    # попадание в память тоже продлевает жизнь записи в базе (для вытеснения по last_hit_at)
+    _pending_answer_hits[key] = int(time.time())
+
+
+async def flush_answer_hits():
+    global _pending_answer_hits
+    if not _pending_answer_hits:
+        return
+
+    batch, _pending_answer_hits = _pending_answer_hits, {}
+    try:
+        async with _write() as db:
+            await db.executemany(
+                "UPDATE answer_cache SET last_hit_at = ?, hits = hits + 1 WHERE key = ?",
+                [(ts, key) for key, ts in batch.items()]
+            )
+    except BaseException:
+        for key, ts in batch.items():
+            _pending_answer_hits[key] = max(ts, _pending_answer_hits.get(key, 0))
+        raise
+
+
+async def evict_answer_cache(now: int | None = None):
+    """
+    Удаляет просроченные ответы, затем самые давно не использованные — пока объём > ANSWER_CACHE_MAX_BYTES.
+    """
+    now = now or int(time.time())
+    async with _write() as db:
+        await db.execute("DELETE FROM answer_cache WHERE created_at < ?", (now - ANSWER_CACHE_TTL,))
+
+        cur = await db.execute("SELECT COALESCE(SUM(size), 0) FROM answer_cache")
+        (total,) = await cur.fetchone()
+        if total <= ANSWER_CACHE_MAX_BYTES:
+            return
+
+        # идём от самых старых по last_hit_at, пока не освободим лишнее (+10% запаса)
+        excess = total - ANSWER_CACHE_MAX_BYTES * 9 // 10
+        cur = await db.execute("SELECT key, size FROM answer_cache ORDER BY last_hit_at")
+        victims = []
+        async for key, size in cur:
+            victims.append((key,))
+            excess -= size
+            if excess <= 0:
+                break
+        await cur.close()
+        await db.executemany("DELETE FROM answer_cache WHERE key = ?", victims)
+
+
+async def near_dup_add(answer_key: str, nums: int, sig: bytes) -> int:
+    async with _write() as db:
+        cur = await db.execute(
+            "INSERT INTO near_dup(answer_key, nums, sig, created_at) VALUES (?, ?, ?, ?)",
+            (answer_key, nums, sig, int(time.time()))
+        )
+        return cur.lastrowid
+
+
+async def near_dup_rows():
+    """
+    Все сохранённые подписи (id, nums, sig) — для построения индекса при старте.
+    """
+    async with _read() as db:
+        cur = await db.execute("SELECT id, nums, sig FROM near_dup ORDER BY id")
+        async for row in cur:
+            yield row
+        await cur.close()
+
+
+async def near_dup_answer_key(row_id: int) -> str | None:
+    async with _read() as db:
+        cur = await db.execute("SELECT answer_key FROM near_dup WHERE id = ?", (row_id,))
+        row = await cur.fetchone()
+        return row[0] if row else None
+
+
+async def prune_near_dup():
+    # подписи, чьи ответы уже вытеснены из answer_cache, больше ничего не дадут
+    last = 0
+    while True:
+        async with _read() as db:
+            cur = await db.execute(
+                "SELECT MAX(id) FROM (SELECT id FROM near_dup WHERE id > ? ORDER BY id LIMIT ?)",
+                (last, NEAR_DUP_PRUNE_BATCH)
+            )
+            (upto,) = await cur.fetchone()
+        if upto is None:
+            return
+
+        async with _write() as db:
+            cur = await db.execute(
+                """
+                SELECT n.id FROM near_dup n
+                WHERE n.id > ? AND n.id <= ?
+                  AND NOT EXISTS (SELECT 1 FROM answer_cache a WHERE a.key = n.answer_key)
+                """,
+                (last, upto)
+            )
+            dead = [r[0] for r in await cur.fetchall()]
+            await db.executemany("DELETE FROM near_dup WHERE id = ?", [(i,) for i in dead])
+        _pruned_near_dup.extend(dead)
+        last = upto
+
+
+def take_pruned_near_dup() -> list[int]:
+    """
+    id строк near_dup, удалённых с прошлого вызова.
+    """
+    global _pruned_near_dup
+    ids, _pruned_near_dup = _pruned_near_dup, []
+    return ids
+
+
+async def answer_cache_size() -> dict:
+    async with _read() as db:
+        cur = await db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM answer_cache")
+        n, size = await cur.fetchone()
+    return {"entries": int(n), "bytes": int(size)}
+
+
+async def ocr_cache_find(file_unique_id: str | None = None, sha256: str | None = None) -> tuple[int, str] | None:
+    """
+    (id, текст) по file_unique_id или по sha256 содержимого.
+    """
+    column, value = ("file_unique_id", file_unique_id) if file_unique_id else ("sha256", sha256)
+    async with _read() as db:
+        cur = await db.execute(
+            f"SELECT id, text FROM ocr_cache WHERE {column} = ? ORDER BY id DESC LIMIT 1", (value,)
+        )
+        row = await cur.fetchone()
+
+    if not row:
+        return None
+    _pending_ocr_hits[row[0]] = int(time.time())
+    return row[0], row[1]
+
+
+async def ocr_cache_row(row_id: int) -> tuple[str, bytes | None] | None:
+    # (текст, сжатая миниатюра) — для проверки кандидата из индекса похожих
+    async with _read() as db:
+        cur = await db.execute("SELECT text, thumb FROM ocr_cache WHERE id = ?", (row_id,))
+        row = await cur.fetchone()
+    return (row[0], row[1]) if row else None
+
+
+async def ocr_cache_put(
+    file_unique_id: str | None, sha256: str, dhash: bytes | None, thumb: bytes | None, text: str
+) -> int:
+    now = int(time.time())
+    async with _write() as db:
+        cur = await db.execute(
+            """
+            INSERT INTO ocr_cache(file_unique_id, sha256, dhash, thumb, text, created_at, last_hit_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            """,
+            (file_unique_id, sha256, dhash, thumb, text, now, now)
+        )
+        return cur.lastrowid
+
+
+def ocr_cache_hit(row_id: int):
+    _pending_ocr_hits[row_id] = int(time.time())
+
+
+async def flush_ocr_hits():
+    global _pending_ocr_hits
+    if not _pending_ocr_hits:
+        return
+
+    batch, _pending_ocr_hits = _pending_ocr_hits, {}
+    try:
+        async with _write() as db:
+            await db.executemany(
+                "UPDATE ocr_cache SET last_hit_at = ? WHERE id = ?",
+                [(ts, row_id) for row_id, ts in batch.items()]
+            )
+    except BaseException:
+        for row_id, ts in batch.items():
+            _pending_ocr_hits[row_id] = max(ts, _pending_ocr_hits.get(row_id, 0))
+        raise
+
+
+async def ocr_cache_hashes(limit: int = -1):
+    """
+    (id, dhash) фото, которые читал Gemini, — для индекса похожих при старте.
+    limit — только самые свежие limit строк (по возрастанию id, как и без него).
+    """
+    async with _read() as db:
+        cur = await db.execute(
+            """
+            SELECT id, dhash FROM (
+                SELECT id, dhash FROM ocr_cache WHERE dhash IS NOT NULL ORDER BY id DESC LIMIT ?
+            ) ORDER BY id
+            """,
+            (limit,)
+        )
+        async for row in cur:
+            yield row
+        await cur.close()
+
+
+async def evict_ocr_cache(now: int | None = None):
+    """
+    Удаляет строки, к которым не обращались OCR_CACHE_TTL, и самые давние сверх OCR_CACHE_MAX_ROWS.
+    """
+    now = now or int(time.time())
+    async with _write() as db:
+        cur = await db.execute("SELECT id FROM ocr_cache WHERE last_hit_at < ?", (now - OCR_CACHE_TTL,))
+        dead = [r[0] for r in await cur.fetchall()]
+        cur = await db.execute("SELECT COUNT(*) FROM ocr_cache")
+        (n,) = await cur.fetchone()
+        if n - len(dead) > OCR_CACHE_MAX_ROWS:
+            cur = await db.execute(
+                "SELECT id FROM ocr_cache WHERE last_hit_at >= ? ORDER BY last_hit_at LIMIT ?",
+                (now - OCR_CACHE_TTL, n - len(dead) - OCR_CACHE_MAX_ROWS * 9 // 10)
+            )
+            dead += [r[0] for r in await cur.fetchall()]
+        await db.executemany("DELETE FROM ocr_cache WHERE id = ?", [(i,) for i in dead])
+    _pruned_ocr_cache.extend(dead)
+
+
+def take_pruned_ocr_cache() -> list[int]:
+    """
+    id строк ocr_cache, вытесненных с прошлого вызова.
+    """
+    global _pruned_ocr_cache
+    ids, _pruned_ocr_cache = _pruned_ocr_cache, []
+    return ids
+
+
+async def ocr_cache_size() -> int:
+    async with _read() as db:
+        cur = await db.execute("SELECT COUNT(*) FROM ocr_cache")
+        (n,) = await cur.fetchone()
+    return int(n)
+
+
+def add_tokens(user_id: int, model: str, prompt_tokens: int, completion_tokens: int, task: str = ""):
+    """
+    Учёт токенов одного вызова ИИ. В базу уходит пачкой (token_usage + самые тяжёлые в token_heavy).
+    """
+    now = int(time.time())
+    key = (_day_key(now), user_id, model)
+    agg = _pending_tokens.get(key)
+    if agg is None:
+        agg = _pending_tokens[key] = [0, 0, 0]
+    agg[0] += 1
+    agg[1] += prompt_tokens
+    agg[2] += completion_tokens
+    _pending_heavy.append((key[0], user_id, model, prompt_tokens, completion_tokens, task[:200], now))
+    bump_metric("tokens", prompt_tokens + completion_tokens)
+
+
+async def flush_tokens():
+    global _pending_tokens, _pending_heavy
+    if not _pending_tokens and not _pending_heavy:
+        return
+
+    batch, _pending_tokens = _pending_tokens, {}
+    heavy, _pending_heavy = _pending_heavy, []
+    # из пачки в базу нужны только кандидаты в топ дня
+    heavy = sorted(heavy, key=lambda r: -(r[3] + r[4]))[:TOKEN_HEAVY_PER_DAY]
+    try:
+        async with _write() as db:
+            await db.executemany(
+                """
+                INSERT INTO token_usage(day, user_id, model, calls, prompt_tokens, completion_tokens)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT(day, user_id, model) DO UPDATE SET
+                    calls = calls + excluded.calls,
+                    prompt_tokens = prompt_tokens + excluded.prompt_tokens,
+                    completion_tokens = completion_tokens + excluded.completion_tokens
+                """,
+                [(day, uid, model, *agg) for (day, uid, model), agg in batch.items()]
+            )
+            await db.executemany(
+                """
+                INSERT INTO token_heavy(day, user_id, model, prompt_tokens, completion_tokens, task, created_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                """,
+                heavy
+            )
+            for day in {r[0] for r in heavy}:
+                await db.execute(
+                    """
+                    DELETE FROM token_heavy WHERE day = ? AND id NOT IN (
+                        SELECT id FROM token_heavy WHERE day = ?
+                        ORDER BY prompt_tokens + completion_tokens DESC LIMIT ?
+                    )
+                    """,
+                    (day, day, TOKEN_HEAVY_PER_DAY)
+                )
+    except BaseException:
+        for key, agg in batch.items():
+            cur = _pending_tokens.setdefault(key, [0, 0, 0])
+            for i in range(3):
+                cur[i] += agg[i]
+        _pending_heavy = heavy + _pending_heavy
+        raise
+
+
+async def prune_token_heavy():
+    cutoff = _day_key(int(time.time()) - TOKEN_HEAVY_RETENTION_DAYS * 24 * 60 * 60)
+    async with _write() as db:
+        await db.execute("DELETE FROM token_heavy WHERE day < ?", (cutoff,))
+
+
+async def token_report(days: int = 7, limit: int = 10) -> dict:
+    """
+    Токены за сегодня и за days дней по моделям, самые «дорогие» юзеры и самые тяжёлые вызовы за days дней.
+    """
+    await flush_tokens()
+    now = int(time.time())
+    today = _day_key(now)
+    since = _day_key(now - (days - 1) * 24 * 60 * 60)
+
+    async with _read() as db:
+        cur = await db.execute(
+            """
+            SELECT model, day = ?, SUM(calls), SUM(prompt_tokens), SUM(completion_tokens)
+            FROM token_usage WHERE day >= ?
+            GROUP BY 1, 2
+            """,
+            (today, since)
+        )
+        models: dict[str, dict] = {}
+        for model, is_today, calls, prompt, completion in await cur.fetchall():
+            m = models.setdefault(model, {"today": [0, 0, 0], "period": [0, 0, 0]})
+            for bucket in (["today", "period"] if is_today else ["period"]):
+                m[bucket][0] += calls
+                m[bucket][1] += prompt
+                m[bucket][2] += completion
+
+        cur = await db.execute(
+            """
+            SELECT user_id, SUM(calls), SUM(prompt_tokens + completion_tokens) AS total
+            FROM token_usage WHERE day >= ?
+            GROUP BY user_id ORDER BY total DESC LIMIT ?
+            """,
+            (since, limit)
+        )
+        top_users = [{"user_id": u, "calls": int(c), "tokens": int(t)} for u, c, t in await cur.fetchall()]
+
+        cur = await db.execute(
+            """
+            SELECT user_id, model, prompt_tokens, completion_tokens, task, created_at
+            FROM token_heavy WHERE day >= ?
+            ORDER BY prompt_tokens + completion_tokens DESC LIMIT ?
+            """,
+            (since, limit)
         )
-        await db.commit()
+        top_tasks = [
+            {"user_id": u, "model": m, "prompt": p, "completion": c, "task": t, "at": _fmt_ts(ts)}
+            for u, m, p, c, t, ts in await cur.fetchall()
+        ]
+
+    return {"models": models, "top_users": top_users, "top_tasks": top_tasks}
+
+
+async def flush_all():
+    # каждая пачка — отдельно: ошибка одной не должна оставить в памяти остальные (при остановке — потерять)
+    error = None
+    for flush in (flush_activity, flush_usage, flush_metrics, flush_answer_hits, flush_ocr_hits, flush_tokens):
+        try:
+            await flush()
+        except Exception as e:
+            error = error or e
+    if error is not None:
+        raise error
+
+
+async def _background_loop():
+    last_hourly = 0.0
+    while True:
+        try:
+            await asyncio.wait_for(_stop_flush.wait(), ACTIVITY_FLUSH_INTERVAL)
+            return  # close_db: последний сброс сделает сам
+        except asyncio.TimeoutError:
+            pass
+        try:
+            await flush_all()
+        except Exception:
+            log.exception("activity flush failed")
+
+        if time.monotonic() - last_hourly >= USAGE_ROLLUP_INTERVAL:
+            last_hourly = time.monotonic()
+            try:
+                await rollup_usage()
+                await evict_answer_cache()
+                await prune_near_dup()
+                await prune_token_heavy()
+                await evict_ocr_cache()
+            except Exception:
+                log.exception("hourly maintenance failed")
+
+
+async def get_plan(user_id: int) -> str:
+    entry = _cache_get(user_id)
+    if entry is not None:
+        return entry["plan"]
+
+    async with _read() as db:
+        cur = await db.execute(f"SELECT {_CACHED_COLS} FROM users WHERE user_id = ?", (user_id,))
+        row = await cur.fetchone()
+    if not row:
+        return "free"
+    _cache_put(user_id, row)
+    return row[3]
+
+
+async def set_plan(user_id: int, plan: str) -> bool:
+    async with _write() as db:
+        cur = await db.execute(
+            f"UPDATE users SET plan = ? WHERE user_id = ? RETURNING {_CACHED_COLS}",
+            (plan, user_id)
+        )
+        row = await cur.fetchone()
+
+    if not row:
+        return False
+    _cache_put(user_id, row)
+    return True
+
+
+async def set_credits(user_id: int, value: int) -> int | None:
+    async with _write() as db:
+        cur = await db.execute(
+            f"UPDATE users SET credits = ? WHERE user_id = ? RETURNING {_CACHED_COLS}",
+            (value, user_id)
+        )
+        row = await cur.fetchone()
+
+    if not row:
+        return None
+    _cache_put(user_id, row)
+    return int(row[0])
 
-async def set_credits(user_id: int, value: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("UPDATE users SET credits = ? WHERE user_id = ?", (value, user_id))
-        await db.commit()
 
 async def stats_24h() -> dict:
+    await flush_activity()
     now = int(time.time())
     since = now - 24 * 60 * 60
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _read() as db:
         cur = await db.execute("SELECT COUNT(*) FROM users WHERE created_at >= ?", (since,))
         (new_users,) = await cur.fetchone()
 
@@ -243,6 +1376,47 @@ async def stats_24h() -> dict:
 
     return {"new_users": int(new_users), "active_users": int(active_users)}
 
+
+METRICS = ("new_users", "active_users", "solves", "ocr_calls", "referrals", "tokens")
+
+
+async def stats_periods() -> dict:
+    """
+    Суммы daily_metrics за сегодня / 7 / 30 дней и за предыдущие 7 / 30 дней (для трендов).
+    {metric: {"today": .., "7d": .., "prev_7d": .., "30d": .., "prev_30d": ..}}
+    Читается не больше 60 строк на метрику → не зависит от размера базы.
+    """
+    await flush_activity()
+    await flush_metrics()
+
+    now = int(time.time())
+    day = 24 * 60 * 60
+    today = _day_key(now)
+    d7, d14 = _day_key(now - 6 * day), _day_key(now - 13 * day)
+    d30, d60 = _day_key(now - 29 * day), _day_key(now - 59 * day)
+
+    async with _read() as db:
+        cur = await db.execute(
+            """
+            SELECT metric,
+                   SUM(CASE WHEN day = ? THEN n ELSE 0 END),
+                   SUM(CASE WHEN day >= ? THEN n ELSE 0 END),
+                   SUM(CASE WHEN day >= ? AND day < ? THEN n ELSE 0 END),
+                   SUM(CASE WHEN day >= ? THEN n ELSE 0 END),
+                   SUM(CASE WHEN day < ? THEN n ELSE 0 END)
+            FROM daily_metrics
+            WHERE day >= ?
+            GROUP BY metric
+            """,
+            (today, d7, d14, d7, d30, d30, d60)
+        )
+        rows = await cur.fetchall()
+
+    out = {m: {"today": 0, "7d": 0, "prev_7d": 0, "30d": 0, "prev_30d": 0} for m in METRICS}
+    for metric, t, w, pw, mo, pmo in rows:
+        out[metric] = {"today": t, "7d": w, "prev_7d": pw, "30d": mo, "prev_30d": pmo}
+    return out
+
 def _fmt_ts(ts: int | None) -> str:
     if not ts:
         return "—"
@@ -250,11 +1424,13 @@ def _fmt_ts(ts: int | None) -> str:
 
 
 async def get_user_card(user_id: int) -> dict | None:
-    async with aiosqlite.connect(DB_PATH) as db:
+    await flush_activity()
+    async with _read() as db:
         cur = await db.execute(
             """
             SELECT user_id, username, credits, created_at,
-                   COALESCE(last_active_at, last_active) AS last_active_ts
+                   COALESCE(last_active_at, last_active) AS last_active_ts,
+                   invited_count, plan
             FROM users
             WHERE user_id = ?
             """,
@@ -264,13 +1440,7 @@ async def get_user_card(user_id: int) -> dict | None:
         if not row:
             return None
 
-        uid, username, credits, created_at, last_active_ts = row
-
-        cur2 = await db.execute(
-            "SELECT COUNT(*) FROM referrals WHERE inviter_id = ?",
-            (user_id,)
-        )
-        (invited_count,) = await cur2.fetchone()
+        uid, username, credits, created_at, last_active_ts, invited_count, plan = row
 
         return {
             "user_id": uid,
@@ -279,29 +1449,29 @@ async def get_user_card(user_id: int) -> dict | None:
             "created_at": _fmt_ts(created_at),
             "last_active": _fmt_ts(last_active_ts),
             "invited_count": int(invited_count or 0),
+            "plan": plan,
         }
 
 async def count_referrals(inviter_id: int) -> int:
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _read() as db:
         cur = await db.execute(
-            "SELECT COUNT(*) FROM referrals WHERE inviter_id = ?",
+            "SELECT invited_count FROM users WHERE user_id = ?",
             (inviter_id,)
         )
-        (n,) = await cur.fetchone()
-        return int(n or 0)
+        row = await cur.fetchone()
+        return int(row[0] or 0) if row else 0
 
 async def mark_milestone(inviter_id: int, milestone: int) -> bool:
     now = int(time.time())
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _write() as db:
         cur = await db.execute(
             "INSERT OR IGNORE INTO ref_milestones(inviter_id, milestone, created_at) VALUES(?, ?, ?)",
             (inviter_id, milestone, now)
         )
-        await db.commit()
         return cur.rowcount == 1  # True -> впервые, можно слать сообщение
 
 async def get_all_user_ids() -> list[int]:
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _read() as db:
         cur = await db.execute("SELECT user_id FROM users")
         rows = await cur.fetchall()
         return [int(r[0]) for r in rows]
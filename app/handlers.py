@@ -1,38 +1,181 @@
 import asyncio
+import contextlib
+import io
+import time
 
 from aiogram import Router, F
 from aiogram.filters import Command
-from aiogram.types import Message
+from aiogram.types import CallbackQuery, Message, PhotoSize
 from aiogram.fsm.state import StatesGroup, State
 from aiogram.fsm.context import FSMContext
-from aiogram.exceptions import TelegramForbiddenError, TelegramRetryAfter
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
 from aiogram.filters import StateFilter
 
 from app.keyboards import MAIN_KB
-from app.limits import check_and_hit, peek_limits, LIMIT_EXHAUSTED_MSG
-from app.services import ask_teacher
+from app.limits import bill_tokens, check_and_hit, hit_rate, peek_limits, refund
+from app.metering import track, total
+from app import conversations
+from app.services import ask_teacher, ask_teacher_stream, AIError, AI_ERROR_MSG, LLM_LIMITER, SOLVE_QUEUE, SOLVE_FLIGHTS, routing_stats
+from app.answer_cache import answer_cache_stats
+from app.ocr_cache import ocr_cache_stats
+from app.resilience import resilience_stats
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from urllib.parse import quote
-from app.config import ADMIN_IDS
+from app.config import ADMIN_IDS, STREAM_ANSWERS
 
-from app.vision import extract_task_from_photo_gemini
+from app.vision import extract_task_from_photo_gemini, cached_task_from_photo, ocr_stats, OCR_LIMITER, OCR_QUEUE, OCR_FLIGHTS
+from app.scheduler import QueueFull, priority_for
 from aiogram.enums import ChatAction
 
 
 from app.db import (
     ensure_user,
     touch_user,
-    apply_referral,
+    register_referral,
     add_credits,
-    get_credits,
     set_credits,
     stats_24h,
     get_user_card,
-    count_referrals,
     get_all_user_ids,
+    user_cache_stats,
+    stats_periods,
+    bump_metric,
+    METRICS,
+    get_plan,
+    set_plan,
+    token_report,
 )
 
 
+# Стриминг ответа: правим сообщение не чаще раза в STREAM_EDIT_INTERVAL секунд (лимиты Telegram)
+STREAM_EDIT_INTERVAL = 1.5
+TG_MAX_LEN = 4096
+
+
+async def _edit(sent: Message, text: str, final: bool = False):
+    while True:
+        try:
+            await sent.edit_text(text)
+            return
+        except TelegramBadRequest as e:
+            if "not modified" in str(e):
+                return
+            raise
+        except TelegramRetryAfter as e:
+            if not final:
+                return  # промежуточную правку просто пропускаем
+            await asyncio.sleep(e.retry_after)
+
+
+async def _answer_streaming(message: Message, chunks) -> str:
+    """
+    Показывает ответ по мере генерации: первое сообщение сразу, дальше — правки.
+    Длиннее лимита Telegram → продолжаем в новом сообщении. Возвращает весь текст.
+    """
+    full, current = [], ""
+    sent = None
+    last_edit = 0.0
+
+    try:
+        async with contextlib.aclosing(chunks):
+            async for chunk in chunks:
+                full.append(chunk)
+                current += chunk
+
+                while len(current) > TG_MAX_LEN:
+                    cut = current.rfind("\n", 0, TG_MAX_LEN)
+                    if cut <= 0:
+                        cut = TG_MAX_LEN
+                    head, current = current[:cut], current[cut:].lstrip("\n")
+                    if sent is None:
+                        await message.answer(head)
+                    else:
+                        await _edit(sent, head, final=True)
+                    sent = None
+
+                if not current.strip():
+                    continue
+                if sent is None:
+                    sent = await message.answer(current)
+                    last_edit = time.monotonic()
+                elif time.monotonic() - last_edit >= STREAM_EDIT_INTERVAL:
+                    await _edit(sent, current)
+                    last_edit = time.monotonic()
+    finally:
+        # и при обрыве: то, что уже пришло, показываем целиком
+        if sent is not None:
+            await _edit(sent, current, final=True)
+        elif current.strip():
+            await message.answer(current)
+    return "".join(full)
+
+
+async def _solve_and_reply(message: Message, task_text: str, context: dict | None = None, priority: int = 0) -> str | None:
+    """
+    Решает и отвечает. Возвращает текст ответа; None — ИИ не ответил (кредит надо вернуть).
+    Место в очереди к ИИ (SOLVE_QUEUE) занимает только реальный вызов модели: ответ из кэша
+    и ожидание такой же задачи от другого юзера идут мимо. Очередь полна — QueueFull.
+    """
+    def turn():
+        return SOLVE_QUEUE.turn(message.from_user.id, priority, on_wait=_queue_notice(message))
+
+    await message.bot.send_chat_action(message.chat.id, ChatAction.TYPING)
+    try:
+        if STREAM_ANSWERS:
+            answer = await _answer_streaming(message, ask_teacher_stream(task_text, context, turn))
+        else:
+            answer = await ask_teacher(task_text, context, turn=turn)
+            await message.answer(answer)
+    except AIError:
+        return None
+    bump_metric("solves")
+    return answer
+
+
+QUEUE_FULL_MSG = "⏳ Твои задачи уже в очереди. Дождись ответа и присылай следующую 🙌"
+
+
+async def _priority(user_id: int) -> int:
+    return priority_for(await get_plan(user_id), is_admin(user_id))
+
+
+def _queue_notice(message: Message):
+    async def on_wait(position: int):
+        await message.answer(f"⏳ Сейчас много задач. Ты в очереди: {position}-й")
+    return on_wait
+
+
+# Для OCR хватает PHOTO_TARGET_SIDE по длинной стороне: берём самый маленький такой размер фото,
+# а не самый большой — меньше качать и разжимать. Ничего не прочиталось — пробуем самый большой.
+PHOTO_TARGET_SIDE = 1280
+# Больше не качаем (у Telegram фото и так до 10 МБ, но file_size бывает не указан)
+PHOTO_MAX_BYTES = 10 * 1024 * 1024
+
+
+def _ocr_sizes(photos: list[PhotoSize]) -> list[PhotoSize]:
+    """
+    Размеры фото по порядку попыток OCR: самый маленький, что дотягивает до цели, потом самый большой.
+    """
+    by_side = sorted(photos, key=lambda p: max(p.width, p.height))
+    first = next((p for p in by_side if max(p.width, p.height) >= PHOTO_TARGET_SIDE), by_side[-1])
+    return [first] if first is by_side[-1] else [first, by_side[-1]]
+
+
+class _CappedBuffer(io.BytesIO):
+    # пишем кусками по мере скачивания и обрываем, как только файл перерос лимит
+    def write(self, chunk) -> int:
+        if self.tell() + len(chunk) > PHOTO_MAX_BYTES:
+            raise ValueError("photo is larger than PHOTO_MAX_BYTES")
+        return super().write(chunk)
+
+
+async def _download_photo(message: Message, photo: PhotoSize) -> bytes:
+    if (photo.file_size or 0) > PHOTO_MAX_BYTES:
+        raise ValueError("photo is larger than PHOTO_MAX_BYTES")
+    file = await message.bot.get_file(photo.file_id)
+    buf = await message.bot.download_file(file.file_path, destination=_CappedBuffer())
+    return buf.getvalue()
+
 
 router = Router() #это “папка с правилами”: какие сообщения куда отправлять
 class TaskFlow(StatesGroup):
@@ -48,42 +191,41 @@ async def start_handler(message: Message):
     args = message.text.split(maxsplit=1)
     ref_id = args[1].strip() if len(args) > 1 else None
 
-    # ⬇️ ВАЖНО: теперь сохраняем и получаем is_new
-    is_new = await ensure_user(
-        message.from_user.id,
-        message.from_user.username
-    )
-    await touch_user(message.from_user.id)
+    invitee_id = message.from_user.id
+    inviter_id = int(ref_id) if ref_id and ref_id.isdigit() else None
+
+    if inviter_id is None:
+        await ensure_user(invitee_id, message.from_user.username)
+    await touch_user(invitee_id)
+
+    # ⬇️ РЕФЕРАЛКА ТОЛЬКО ЕСЛИ ЮЗЕР НОВЫЙ (проверяется внутри, одной транзакцией)
+    if inviter_id is not None:
+        ref = await register_referral(
+            inviter_id,
+            invitee_id,
+            message.from_user.username,
+            bonus=5,
+            milestones=tuple(m for m, _ in PRIZES),
+        )
 
-    # ⬇️ РЕФЕРАЛКА ТОЛЬКО ЕСЛИ ЮЗЕР НОВЫЙ
-    if is_new and ref_id and ref_id.isdigit():
-        inviter_id = int(ref_id)
-        invitee_id = message.from_user.id
-
-        if inviter_id != invitee_id:
-            await ensure_user(inviter_id)
-
-            ok = await apply_referral(inviter_id, invitee_id)
-            if ok:
-                await add_credits(inviter_id, 5)
-
-                invited = await count_referrals(inviter_id)
-                progress = f"{invited} / 15"
-                extra = "\n\n🔥 Ты в розыгрыше iPhone 17!" if invited >= 15 else ""
-
-                try:
-                    uname = message.from_user.username
-                    who = f"@{uname}" if uname else f"id:{invitee_id}"
-                    await message.bot.send_message(
-                        inviter_id,
-                        f"🎉 Новый реферал!\n"
-                        f"👤 Друг: {who}\n"
-                        f"✅ Начислено +5 ответов 🎁\n"
-                        f"📱 Прогресс iPhone 17: {progress}"
-                        f"{extra}"
-                    )
-                except TelegramForbiddenError:
-                    pass
+        if ref["invited"] is not None:
+            invited = ref["invited"]
+            progress = f"{invited} / 15"
+            extra = "\n\n🔥 Ты в розыгрыше iPhone 17!" if invited >= 15 else ""
+
+            try:
+                uname = message.from_user.username
+                who = f"@{uname}" if uname else f"id:{invitee_id}"
+                await message.bot.send_message(
+                    inviter_id,
+                    f"🎉 Новый реферал!\n"
+                    f"👤 Друг: {who}\n"
+                    f"✅ Начислено +5 ответов 🎁\n"
+                    f"📱 Прогресс iPhone 17: {progress}"
+                    f"{extra}"
+                )
+            except TelegramForbiddenError:
+                pass
 
     # 👇 1) Приветствие с кнопкой поддержки (inline)
     support_kb = InlineKeyboardMarkup(inline_keyboard=[
@@ -99,7 +241,7 @@ async def start_handler(message: Message):
         "📚 Умею решать все предметы, объясняя простыми словами.\n\n"
         "Лайфхаки для лучшего результата:\n"
         "• Делай четкие фото при хорошем свете\n"
-        "• Пиши после ответа доп.вопросы, если нужно больше информации\n\n"
+        "• Нужно подробнее — ответь (reply) на моё решение доп. вопросом, это 1 ответ\n\n"
         "Нажми НОВОЕ ЗАДАНИЕ — и поехали 👇",
         reply_markup=support_kb,
     )
@@ -126,46 +268,71 @@ async def solve_from_photo(message: Message):
     await touch_user(user_id)
     await ensure_user(user_id, message.from_user.username)
 
-    # 0) мгновенная проверка: если 0 — Gemini не трогаем
-    info0 = await peek_limits(user_id)
-    if info0["credits"] <= 0:
-        return await message.answer(LIMIT_EXHAUSTED_MSG)
-
-    # 1) скачать фото
-    photo = message.photo[-1]
-    file = await message.bot.get_file(photo.file_id)
-    photo_bytes = await message.bot.download_file(file.file_path)
-
-    # ✅ Универсально: если это файл — читаем, если уже bytes — берём как есть
-    if hasattr(photo_bytes, "read"):
-        data = photo_bytes.read()
-    else:
-        data = photo_bytes
-
-    # 2) typing + статус
-    await message.bot.send_chat_action(message.chat.id, ChatAction.TYPING)
-    await message.answer("🧠 Понял задачу с фото. Решаю…")
-
-    # 3) Gemini OCR: получить ТОЛЬКО текст условия
-    try:
-        task_text = await extract_task_from_photo_gemini(data)
-    except Exception:
-        return await message.answer("⛔️ Не получилось прочитать фото. Попробуй другое (четче/ближе).")
-
-    if not task_text:
-        return await message.answer("⛔️ Я не увидел текст на фото. Сделай фото ближе и ровнее.")
+    # 0) частота + сразу списываем кредит (одна транзакция): если 0 — Gemini не трогаем
+    ok, msg = await hit_rate(user_id)
+    if not ok:
+        return await message.answer(msg)
 
-    # 4) списываем кредит ТОЛЬКО после успешного OCR
     ok, info = await check_and_hit(user_id)
     if not ok:
         return await message.answer(info)
 
-    # 5) решаем через Mistral (ask_teacher)
+    # 1) это фото уже читали (переслали из другого чата) → условие из кэша, ничего не качаем
+    sizes = _ocr_sizes(message.photo)
+    task_text = None
+    for photo in sizes:
+        task_text = await cached_task_from_photo(photo.file_unique_id)
+        if task_text is not None:
+            break
+
+    # 2) typing + статус
     await message.bot.send_chat_action(message.chat.id, ChatAction.TYPING)
-    answer = await ask_teacher(task_text)
-    await message.answer(answer)
+    await message.answer("🧠 Понял задачу с фото. Решаю…")
 
-    credits_left = info["credits_left"]
+    # токены OCR и решения считаем на этого юзера (и по ним списываем, если BILLING_MODE=tokens)
+    with track(user_id) as usage:
+        priority = await _priority(user_id)
+        # 3) скачать фото и через Gemini получить ТОЛЬКО текст условия (вызов Gemini — через общую очередь, по кругу между юзерами).
+        # На маленьком размере ничего не прочиталось — пробуем самый большой
+        for photo in sizes if task_text is None else ():
+            try:
+                data = await _download_photo(message, photo)
+            except Exception:
+                await refund(user_id)
+                return await message.answer("⛔️ Не получилось скачать фото. Попробуй отправить ещё раз.")
+
+            try:
+                task_text = await extract_task_from_photo_gemini(
+                    data,
+                    photo.file_unique_id,
+                    lambda: OCR_QUEUE.turn(user_id, priority, on_wait=_queue_notice(message)),
+                )
+            except QueueFull:
+                await refund(user_id)
+                return await message.answer(QUEUE_FULL_MSG)
+            except Exception:
+                await refund(user_id)
+                return await message.answer("⛔️ Не получилось прочитать фото. Попробуй другое (четче/ближе).")
+            if task_text:
+                break
+
+        # 4) кредит остаётся списанным ТОЛЬКО после успешного OCR
+        if not task_text:
+            await refund(user_id)
+            return await message.answer("⛔️ Я не увидел текст на фото. Сделай фото ближе и ровнее.")
+
+        # 5) решаем через Mistral (ответ показываем по мере генерации)
+        try:
+            answer = await _solve_and_reply(message, task_text, priority=priority)
+        except QueueFull:
+            await refund(user_id)
+            return await message.answer(QUEUE_FULL_MSG)
+        if answer is None:
+            await refund(user_id)
+            return await message.answer(AI_ERROR_MSG + "\n💳 Ответ не списан.")
+
+    conversations.start(user_id, task_text, answer)  # для доп. вопросов
+    credits_left = await bill_tokens(user_id, total(usage), info["credits_left"])
     if credits_left <= 0:
         await message.answer(
             "💳 Ответов больше нет.\n"
@@ -212,6 +379,47 @@ PRIZES = [
     (15, "📱 iPhone 17"),
 ]
 
+METRIC_TITLES = {
+    "new_users": "🆕 Новые",
+    "active_users": "🔥 Активные",
+    "solves": "✅ Решений",
+    "ocr_calls": "📷 Запросов OCR (Gemini)",
+    "referrals": "🤝 Рефералов",
+    "tokens": "🔤 Токенов ИИ",
+}
+
+
+def _resilience_line(model: str, r: dict) -> str:
+    hedges = f", хеджей {r['hedges']} (выиграли {r['hedge_wins']})" if r["hedges"] else ""
+    return (
+        f"   {model}: вызовов {r['calls']}, попыток {r['attempts']}, повторов {r['retries']}{hedges}, "
+        f"ошибок {r['failed']}, отбито {r['fast_failed']}, предохранитель {r['breaker']}, "
+        f"p95 {r['p95_ms'] / 1000:.1f} с"
+    )
+
+
+def _queue_line(title: str, q: dict) -> str:
+    return (
+        f"{title}: решается {q['running']}/{q['capacity']}, ждут {q['waiting']} "
+        f"(юзеров {q['users_waiting']}), ожидание ~{q['wait_ms'] / 1000:.1f} с, "
+        f"отказов {q['rejected']}"
+    )
+
+
+def _limiter_line(title: str, l: dict) -> str:
+    return (
+        f"{title}: лимит {l['limit']}, в работе {l['in_flight']}, в очереди {l['queued']} "
+        f"(ждут ~{l['wait_ms']:.0f} мс), ответ ~{l['latency_ms'] / 1000:.1f} с, "
+        f"перегрузок {l['overload']}"
+    )
+
+
+def _trend(cur: int, prev: int) -> str:
+    if not prev:
+        return "🆕" if cur else ""
+    pct = (cur - prev) * 100 // prev
+    return f"↑{pct}%" if pct > 0 else (f"↓{-pct}%" if pct < 0 else "→")
+
 
 
 
@@ -232,23 +440,44 @@ async def task_mode_buttons(message: Message, state: FSMContext):
         return await ask_task_button(message, state)
 
 
-@router.message(TaskFlow.waiting_task, F.text & ~F.command & ~F.text.in_(BUTTON_TEXTS))
-async def task_text_handler(message: Message, state: FSMContext):
-    await touch_user(message.from_user.id)
-    await ensure_user(message.from_user.id, message.from_user.username)
+async def _paid_text_solve(message: Message, context: dict | None = None) -> str:
+    """
+    Текстовая задача или доп. вопрос: частота → кредит → очередь → ИИ → списание по токенам.
+    Возвращает "ok", "rate" (слишком часто), "no_credits" или "failed" (кредит вернули).
+    """
+    user_id = message.from_user.id
+    await touch_user(user_id)
+    await ensure_user(user_id, message.from_user.username)
 
-    ok, info = await check_and_hit(message.from_user.id)
+    ok, msg = await hit_rate(user_id)
     if not ok:
-        await state.clear()
-        return await message.answer(info)
-
-    credits_left = info["credits_left"]
+        await message.answer(msg)
+        return "rate"
 
-    await message.bot.send_chat_action(message.chat.id, "typing")
+    ok, info = await check_and_hit(user_id)
+    if not ok:
+        await message.answer(info)
+        return "no_credits"
 
-    answer = await ask_teacher(message.text)
-    await message.answer(answer)
+    try:
+        with track(user_id) as usage:
+            answer = await _solve_and_reply(message, message.text, context, await _priority(user_id))
+    except QueueFull:
+        await refund(user_id)
+        await message.answer(QUEUE_FULL_MSG)
+        return "failed"
+
+    if answer is None:
+        await refund(user_id)
+        await message.answer(AI_ERROR_MSG + "\n💳 Ответ не списан.")
+        return "failed"
+
+    if context is None:
+        conversations.start(user_id, message.text, answer)
+    else:
+        conversations.add_turn(user_id, message.text, answer)
 
+    credits_left = await bill_tokens(user_id, total(usage), info["credits_left"])
     if credits_left <= 0:
         await message.answer(
             "💳 Ответов больше нет.\n"
@@ -259,9 +488,16 @@ async def task_text_handler(message: Message, state: FSMContext):
         )
     else:
         await message.answer(f"💳 Ответов осталось: {credits_left}")
+    return "ok"
 
-    # выходим из режима задания
-    await state.clear()
+
+@router.message(TaskFlow.waiting_task, F.text & ~F.command & ~F.text.in_(BUTTON_TEXTS))
+async def task_text_handler(message: Message, state: FSMContext):
+    # слишком часто или ИИ не ответил → остаёмся в режиме задания, можно прислать ещё раз
+    result = await _paid_text_solve(message)
+    if result in ("ok", "no_credits"):
+        # выходим из режима задания
+        await state.clear()
 
     
 
@@ -348,6 +584,8 @@ async def admin_panel(message: Message):
         "/give user_id 10 — выдать кредиты\n"
         "/set user_id 10 — установить кредиты\n"
         "/user user_id — карточка юзера\n"
+        "/plan user_id pro — сменить тариф (free — обычная очередь)\n"
+        "/tokens — расход токенов ИИ: модели, топ юзеров и задач за 7 дней\n"
         "/broadcast — рассылка всем\n"
         "/cancel — отмена действия\n"
 
@@ -364,8 +602,9 @@ async def admin_give(message: Message):
     uid = int(parts[1])
     delta = int(parts[2])
 
-    await add_credits(uid, delta)
-    credits = await get_credits(uid)
+    credits = await add_credits(uid, delta)
+    if credits is None:
+        return await message.answer(f"Юзер {uid} не найден в базе.")
     await message.answer(f"✅ Готово. У юзера {uid} теперь {credits} кредитов.")
 
 
@@ -382,21 +621,117 @@ async def admin_set(message: Message):
     uid = int(parts[1])
     value = int(parts[2])
 
-    await set_credits(uid, value)
+    if await set_credits(uid, value) is None:
+        return await message.answer(f"Юзер {uid} не найден в базе.")
     await message.answer(f"✅ Установил {value} кредитов для {uid}.")
 
+@router.message(Command("plan"))
+async def admin_plan(message: Message):
+    if not is_admin(message.from_user.id):
+        return
+
+    parts = message.text.split()
+    if len(parts) != 3 or not parts[1].isdigit():
+        return await message.answer("Формат: /plan user_id pro")
+
+    uid = int(parts[1])
+    plan = parts[2].lower()
+
+    if not await set_plan(uid, plan):
+        return await message.answer(f"Юзер {uid} не найден в базе.")
+    await message.answer(f"✅ Тариф юзера {uid}: {plan}.")
+
 @router.message(Command("stats"))
 async def admin_stats(message: Message):
     if not is_admin(message.from_user.id):
         return
 
     s = await stats_24h()
+    p = await stats_periods()
+    c = user_cache_stats()
+    a = await answer_cache_stats()
+    o = await ocr_cache_stats()
+    g = ocr_stats()
+    d = conversations.conversation_stats()
+    r = routing_stats()
+
+    lines = []
+    for metric in METRICS:
+        m = p[metric]
+        if metric == "active_users":
+            # за период это сумма по дням → показываем среднее в день
+            lines.append(
+                f"{METRIC_TITLES[metric]}: сегодня {m['today']} | "
+                f"7д ~{m['7d'] // 7}/день {_trend(m['7d'], m['prev_7d'])} | "
+                f"30д ~{m['30d'] // 30}/день {_trend(m['30d'], m['prev_30d'])}"
+            )
+        else:
+            lines.append(
+                f"{METRIC_TITLES[metric]}: сегодня {m['today']} | "
+                f"7д {m['7d']} {_trend(m['7d'], m['prev_7d'])} | "
+                f"30д {m['30d']} {_trend(m['30d'], m['prev_30d'])}"
+            )
+
     await message.answer(
         "📊 Статистика за 24ч:\n"
         f"🆕 Новых: {s['new_users']}\n"
-        f"🔥 Активных: {s['active_users']}"
+        f"🔥 Активных: {s['active_users']}\n\n"
+        "📈 По дням (тренд — к прошлому периоду):\n"
+        + "\n".join(lines) + "\n\n"
+        f"🗃 Кэш юзеров: {c['size']} шт., попаданий {c['hit_ratio']:.0%} "
+        f"({c['hits']} / {c['misses']})\n"
+        f"💾 Кэш ответов: попаданий {a['hit_ratio']:.0%} "
+        f"(память {a['mem_hits']} / база {a['db_hits']} / мимо {a['misses']})\n"
+        f"   в памяти {a['mem_entries']} шт., {a['mem_bytes'] / 1024 / 1024:.1f} МБ; "
+        f"в базе {a['db_entries']} шт., {a['db_bytes'] / 1024 / 1024:.1f} МБ\n"
+        f"🖼 Кэш фото: попаданий {o['hit_ratio']:.0%} (по file_id {o['file_hits']} / по файлу {o['content_hits']} / "
+        f"похожих {o['similar_hits']} / мимо {o['misses']}), в базе {o['db_entries']} шт.\n"
+        + "\n".join(_limiter_line(title, l.stats()) for title, l in (("🧠 Mistral", LLM_LIMITER), ("👁 Gemini", OCR_LIMITER)))
+        + f"\n👁 Запросы к Gemini: ждут ответа {g['in_flight']}, задержка p50 {g['p50_ms'] / 1000:.1f} с / "
+        f"p95 {g['p95_ms'] / 1000:.1f} с, таймаутов {g['timeouts']}, ошибок {g['failed']} из {g['calls']}"
+        + "\n" + "\n".join(_queue_line(title, q.stats()) for title, q in (("🚦 Очередь решений", SOLVE_QUEUE), ("🚦 Очередь фото", OCR_QUEUE)))
+        + "\n🪢 Склеено одинаковых запросов: "
+        + ", ".join(
+            f"{title} {f['coalesced']} к {f['calls']} вызовам"
+            for title, f in (("решения", SOLVE_FLIGHTS.stats()), ("фото", OCR_FLIGHTS.stats()))
+        )
+        + f"\n🧭 Модели по сложности: лёгкие {r['light']}, обычные {r['standard']}, сложные {r['heavy']}; "
+        f"переспрошено старшей моделью {r['escalated']}"
+        + f"\n💬 Память диалогов: {d['sessions']} шт., ~{d['tokens']:,} токенов "
+        f"(в дайджест {d['digested']}, вытеснено по времени {d['evicted_ttl']} / по объёму {d['evicted_lru']})"
+        + "\n🛡 Повторы и предохранители:\n"
+        + ("\n".join(_resilience_line(model, r) for model, r in resilience_stats().items()) or "   пока не было вызовов")
     )
 
+@router.message(Command("tokens"))
+async def admin_tokens(message: Message):
+    if not is_admin(message.from_user.id):
+        return
+
+    r = await token_report(days=7, limit=10)
+
+    models = [
+        f"{model}: сегодня {m['today'][1] + m['today'][2]:,} ({m['today'][0]} выз.) | "
+        f"7д {m['period'][1] + m['period'][2]:,} ({m['period'][0]} выз., вход {m['period'][1]:,} / выход {m['period'][2]:,})"
+        for model, m in r["models"].items()
+    ]
+    users = [
+        f"{i}. {u['user_id']}: {u['tokens']:,} токенов, {u['calls']} выз."
+        for i, u in enumerate(r["top_users"], 1)
+    ]
+    tasks = [
+        f"{i}. {t['prompt'] + t['completion']:,} ({t['prompt']:,}+{t['completion']:,}) · {t['user_id']} · "
+        f"{t['at']} · {t['task'][:60].replace(chr(10), ' ')}"
+        for i, t in enumerate(r["top_tasks"], 1)
+    ]
+    await message.answer(
+        "🔤 Токены ИИ\n"
+        + ("\n".join(models) or "пока пусто") + "\n\n"
+        "👤 Больше всех за 7д:\n" + ("\n".join(users) or "—") + "\n\n"
+        "🏋️ Самые тяжёлые вызовы за 7д:\n" + ("\n".join(tasks) or "—")
+    )
+
+
 @router.message(Command("user"))
 async def admin_user(message: Message):
     if not is_admin(message.from_user.id):
@@ -420,6 +755,7 @@ async def admin_user(message: Message):
         f"👤 Юзер: {uid}\n"
         f"@{info['username'] or '—'}\n"
         f"💳 Кредиты: {info['credits']}\n"
+        f"🏷 Тариф: {info['plan']}\n"
         f"🗓 Зарегистрирован: {info['created_at']}\n"
         f"🔥 Последняя активность: {info['last_active']}\n"
         f"👥 Приглашено: {invited}\n\n"
@@ -527,10 +863,53 @@ async def cancel_any(message: Message, state: FSMContext):
 
 
     
+FOLLOWUP_CALLBACK = "followup"
+FOLLOWUP_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="❓ Да, доп. вопрос (1 ответ)", callback_data=FOLLOWUP_CALLBACK)]
+])
+SMALL_TALK_MAX_WORDS = 3
+
+
+def _is_reply_to_bot(message: Message) -> bool:
+    reply = message.reply_to_message
+    return reply is not None and reply.from_user is not None and reply.from_user.id == message.bot.id
+
+
+def _is_small_talk(text: str) -> bool:
+    # «спасибо», «ок», «понял, круто» — не вопрос: без цифр, без «?» и всего пара слов
+    return "?" not in text and not any(c.isdigit() for c in text) and len(text.split()) <= SMALL_TALK_MAX_WORDS
+
+
 @router.message(F.text & ~F.command)
 async def text_outside_task(message: Message):
+    # доп. вопрос (платный) — только явно: ответом (reply) на сообщение бота или кнопкой под подсказкой
+    context = conversations.context(message.from_user.id)
+    if context is not None and _is_reply_to_bot(message):
+        return await _paid_text_solve(message, context)
+
     await touch_user(message.from_user.id)
+    if context is not None and not _is_small_talk(message.text):
+        return await message.reply(
+            "Это доп. вопрос к прошлой задаче? Он стоит 1 ответ 💳\n"
+            "Если это новая задача — нажми «✍️ Новое задание».",
+            reply_markup=FOLLOWUP_KB,
+        )
     await message.answer("Чтобы я решил задачу — нажми «✍️ Новое задание» 🙂")
 
 
+@router.callback_query(F.data == FOLLOWUP_CALLBACK)
+async def followup_button(callback: CallbackQuery):
+    # вопрос — сообщение юзера, на которое бот ответил подсказкой с кнопкой
+    question = callback.message.reply_to_message if callback.message else None
+    context = conversations.context(callback.from_user.id)
+    await callback.answer()
+    with contextlib.suppress(TelegramBadRequest):
+        await callback.message.edit_reply_markup(reply_markup=None)  # второй раз не нажать
+    if question is None or not question.text or question.from_user.id != callback.from_user.id:
+        return
+    if context is None:
+        return await callback.message.answer("Прошлая задача уже забылась 🙈 Нажми «✍️ Новое задание».")
+    await _paid_text_solve(question, context)
+
+
         
\ No newline at end of file
@@ -0,0 +1,167 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+
+import httpx
+
+log = logging.getLogger(__name__)
+
+# Во сколько раз сглаженная задержка должна превысить базовую, чтобы считаться всплеском
+LATENCY_SPIKE = 2.0
+# После снижения лимита не снижаем снова, пока не пройдёт столько секунд:
+# пачка одновременных 429 — это один сигнал перегрузки, а не десять
+DECREASE_COOLDOWN = 2.0
+
+
+def is_overload(exc: BaseException) -> bool:
+    """
+    Ошибка «провайдер не справляется»: 429, 5xx, таймаут.
+    400 и прочее — проблема запроса, лимит из-за них не трогаем.
+    """
+    if isinstance(exc, (asyncio.TimeoutError, httpx.TimeoutException, httpx.NetworkError)):
+        return True
+    # mistralai: status_code, google-genai: code
+    status = getattr(exc, "status_code", None) or getattr(exc, "code", None)
+    return isinstance(status, int) and (status == 429 or 500 <= status < 600)
+
+
+class _Slot:
+    def __init__(self):
+        self.started = time.monotonic()
+        self.latency: float | None = None
+
+    def mark(self):
+        # для стриминга: задержка = время до первого куска, а не до конца ответа
+        if self.latency is None:
+            self.latency = time.monotonic() - self.started
+
+
+class AdaptiveLimiter:
+    """
+    Лимит одновременных запросов к провайдеру, который подстраивается сам (AIMD):
+    пока задержка ровная и слоты заняты — +1 за «круг» запросов,
+    на 429/5xx/таймауты — вдвое меньше, на всплеск задержки — на 10% меньше.
+    """
+
+    def __init__(self, name: str, initial: int = 5, min_limit: int = 1, max_limit: int = 50):
+        self.name = name
+        self.min_limit = min_limit
+        self.max_limit = max(max_limit, min_limit)
+        self._limit = float(min(max(initial, min_limit), self.max_limit))
+        self._in_flight = 0
+        self._waiters: deque[asyncio.Future] = deque()
+        self._latency: float | None = None    # сглаженная задержка (быстрая EWMA)
+        self._baseline: float | None = None   # «нормальная» задержка (медленная EWMA)
+        self._wait: float = 0.0               # сглаженное ожидание в очереди
+        self._last_decrease = 0.0
+        self._stats = {"ok": 0, "overload": 0, "errors": 0}
+
+    @property
+    def limit(self) -> int:
+        return int(self._limit)
+
+    def has_spare(self) -> bool:
+        return not self._waiters and self._in_flight < self.limit
+
+    def _grant(self):
+        while self._waiters and self._in_flight < self.limit:
+            fut = self._waiters.popleft()
+            if not fut.done():
+                self._in_flight += 1
+                fut.set_result(None)
+
+    async def _acquire(self):
+        if self.has_spare():
+            self._in_flight += 1
+            return
+
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters.append(fut)
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                # слот уже выдали, а нас отменили — возвращаем
+                self._release()
+            else:
+                try:
+                    self._waiters.remove(fut)
+                except ValueError:
+                    pass
+            raise
+
+    def _release(self):
+        self._in_flight -= 1
+        self._grant()
+
+    def _decrease(self, factor: float, reason: str):
+        now = time.monotonic()
+        if now - self._last_decrease < DECREASE_COOLDOWN:
+            return
+        self._last_decrease = now
+        old = self.limit
+        self._limit = max(self.min_limit, self._limit * factor)
+        if self.limit != old:
+            log.info("%s concurrency %d → %d (%s)", self.name, old, self.limit, reason)
+
+    def _on_success(self, latency: float, in_flight: int):
+        self._stats["ok"] += 1
+        self._latency = latency if self._latency is None else 0.8 * self._latency + 0.2 * latency
+        self._baseline = latency if self._baseline is None else 0.98 * self._baseline + 0.02 * latency
+
+        if self._latency > self._baseline * LATENCY_SPIKE:
+            self._decrease(0.9, "latency spike")
+            return
+
+        # растём, только если лимит реально упирались: иначе 50 при 3 запросах — фиктивный запас
+        if in_flight >= self.limit - 1 and self._limit < self.max_limit:
+            old = self.limit
+            self._limit = min(self.max_limit, self._limit + 1 / self._limit)
+            if self.limit != old:
+                log.info("%s concurrency %d → %d", self.name, old, self.limit)
+                self._grant()
+
+    def _on_error(self, exc: BaseException):
+        if is_overload(exc):
+            self._stats["overload"] += 1
+            self._decrease(0.5, type(exc).__name__)
+        else:
+            self._stats["errors"] += 1
+
+    @asynccontextmanager
+    async def slot(self):
+        """
+        async with limiter.slot() as s: ...
+        Исключение внутри блока — сигнал для лимита (перегрузка или нет), и оно летит дальше.
+        """
+        queued_at = time.monotonic()
+        await self._acquire()
+        self._wait = 0.9 * self._wait + 0.1 * (time.monotonic() - queued_at)
+
+        s = _Slot()
+        in_flight = self._in_flight
+        try:
+            yield s
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self._on_error(e)
+            raise
+        else:
+            s.mark()
+            self._on_success(s.latency, in_flight)
+        finally:
+            self._release()
+
+    def stats(self) -> dict:
+        return {
+            **self._stats,
+            "limit": self.limit,
+            "in_flight": self._in_flight,
+            "queued": len(self._waiters),
+            "wait_ms": self._wait * 1000,
+            "latency_ms": (self._latency or 0.0) * 1000,
+            "baseline_ms": (self._baseline or 0.0) * 1000,
+        }
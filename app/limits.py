@@ -1,9 +1,28 @@
+import math
+import time
+from collections import deque
+
+from app.config import BILLING_MODE, TOKENS_PER_CREDIT
 from app.db import (
-    daily_refill,
-    get_credits,
-    spend_credit,
+    add_credits,
+    add_usage,
+    charge,
+    debit,
+    recent_usage,
+    remove_usage,
 )
 
+DAILY_CREDITS = 2
+
+# Скользящее окно: не больше RATE_LIMIT_SOLVES решений за RATE_LIMIT_WINDOW секунд
+RATE_LIMIT_SOLVES = 5
+RATE_LIMIT_WINDOW = 10 * 60
+RATE_SWEEP_EVERY = 1000  # раз в столько вызовов выкидываем из памяти неактивных юзеров
+
+# user_id -> метки времени последних решений (кольцевой буфер на RATE_LIMIT_SOLVES)
+_recent: dict[int, deque] = {}
+_rate_calls = 0
+
 # Общий текст, когда лимит закончился
 LIMIT_EXHAUSTED_MSG = (
     "💳 Ответов больше нет.\n"
@@ -14,32 +33,94 @@ LIMIT_EXHAUSTED_MSG = (
 )
 
 
-async def check_and_hit(user_id: int):
+def _sweep_recent(now: int):
+    cutoff = now - RATE_LIMIT_WINDOW
+    for uid in [uid for uid, q in _recent.items() if not q or q[-1] < cutoff]:
+        del _recent[uid]
+
+
+async def hit_rate(user_id: int):
     """
-    Проверка и списание кредита.
-    1) начисляем ежедневные +2 (если нужно)
-    2) проверяем, есть ли кредиты
-    3) списываем 1 кредит
+    Скользящее окно на частоту решений.
+    Если слот есть — занимает его, иначе — текст с ожиданием. В usage_events событие попадает
+    только со списанием кредита (check_and_hit); не списали или вернули кредит — слот освобождается.
     """
-    # ежедневное начисление
-    await daily_refill(user_id, per_day=2)
+    global _rate_calls
+    now = int(time.time())
+    since = now - RATE_LIMIT_WINDOW
 
-    credits = await get_credits(user_id)
-    if credits <= 0:
-        return False, LIMIT_EXHAUSTED_MSG
+    q = _recent.get(user_id)
+    if q is None:
+        # впервые видим юзера после старта → поднимаем окно из базы
+        history = await recent_usage(user_id, since)
+        q = _recent.setdefault(user_id, deque(history[-RATE_LIMIT_SOLVES:], maxlen=RATE_LIMIT_SOLVES))
+
+    _rate_calls += 1
+    if _rate_calls % RATE_SWEEP_EVERY == 0:
+        _sweep_recent(now)
+
+    # буфер полный и самое старое событие ещё в окне → лимит
+    if len(q) >= RATE_LIMIT_SOLVES and q[0] >= since:
+        wait_min = max(1, (q[0] + RATE_LIMIT_WINDOW - now + 59) // 60)
+        return False, (
+            "⏳ Слишком много задач подряд.\n"
+            f"Подожди {wait_min} мин. и присылай следующую 🙌"
+        )
+
+    q.append(now)
+    _recent[user_id] = q  # sweep мог выкинуть буфер, пока ждали базу
+    return True, None
+
+
+def _release_rate(user_id: int):
+    # отдаём слот, занятый hit_rate. Снимаем самую свежую метку: одновременные запросы юзера
+    # отличаются на секунды, а вытесненная при добавлении метка и так была вне окна
+    q = _recent.get(user_id)
+    if q:
+        q.pop()
 
-    ok = await spend_credit(user_id, 1)
-    if not ok:
+
+async def check_and_hit(user_id: int):
+    """
+    Проверка и списание кредита одной транзакцией:
+    ежедневные +2 (если нужно) → списание 1 кредита, если он есть → новый баланс
+    """
+    credits_left = await charge(user_id, 1, per_day=DAILY_CREDITS)
+    if credits_left is None:
+        _release_rate(user_id)
         return False, LIMIT_EXHAUSTED_MSG
 
-    credits_left = await get_credits(user_id)
+    await add_usage(user_id, int(time.time()))
     return True, {"credits_left": credits_left}
 
 
+async def refund(user_id: int, amount: int = 1):
+    """
+    Вернуть кредит, если ответ так и не получился (например, не прочиталось фото).
+    Вместе с ним возвращается и слот частоты: неудачная попытка не в счёт.
+    """
+    await add_credits(user_id, amount)
+    _release_rate(user_id)
+    await remove_usage(user_id)
+
+
+async def bill_tokens(user_id: int, tokens: int, credits_left: int) -> int:
+    """
+    BILLING_MODE=tokens: за ответ берём ceil(tokens / TOKENS_PER_CREDIT) кредитов (минимум 1).
+    1 уже списан в check_and_hit → добираем остальное, сколько есть. Возвращает баланс.
+    """
+    if BILLING_MODE != "tokens":
+        return credits_left
+    extra = max(1, math.ceil(tokens / TOKENS_PER_CREDIT)) - 1
+    if extra <= 0:
+        return credits_left
+    left = await debit(user_id, extra)
+    return credits_left if left is None else left
+
+
 async def peek_limits(user_id: int) -> dict:
     """
     Просто показать, сколько кредитов осталось
     """
-    await daily_refill(user_id, per_day=2)
-    credits = await get_credits(user_id)
-    return {"credits": credits}
+    credits = await charge(user_id, 0, per_day=DAILY_CREDITS)
+    return {"credits": credits or 0}
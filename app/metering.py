@@ -0,0 +1,33 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from app.db import add_tokens
+
+# Токены текущего запроса юзера: handlers открывают track(user_id), services/vision зовут record().
+# ContextVar, а не параметр: вызовы ИИ сидят глубоко (повторы, хеджи, стрим), а юзер у апдейта один
+_current: ContextVar[dict | None] = ContextVar("token_usage", default=None)
+
+
+@contextmanager
+def track(user_id: int):
+    usage = {"user_id": user_id, "calls": 0, "prompt": 0, "completion": 0}
+    token = _current.set(usage)
+    try:
+        yield usage
+    finally:
+        _current.reset(token)
+
+
+def record(model: str, prompt_tokens: int | None, completion_tokens: int | None, task: str = ""):
+    prompt_tokens, completion_tokens = int(prompt_tokens or 0), int(completion_tokens or 0)
+    usage = _current.get()
+    if usage is not None:
+        usage["calls"] += 1
+        usage["prompt"] += prompt_tokens
+        usage["completion"] += completion_tokens
+    # вне track (например, пакетные прогоны) — пишем на user_id 0
+    add_tokens(usage["user_id"] if usage is not None else 0, model, prompt_tokens, completion_tokens, task)
+
+
+def total(usage: dict) -> int:
+    return usage["prompt"] + usage["completion"]
@@ -0,0 +1,241 @@
+import asyncio
+import hashlib
+import random
+import re
+import zlib
+from array import array
+from bisect import bisect_left
+
+from app.answer_cache import normalize_task
+from app.config import NEAR_DUP_THRESHOLD
+from app.db import near_dup_add, near_dup_rows, near_dup_answer_key, take_pruned_near_dup
+
+# Поиск почти одинаковых задач: MinHash по символьным шинглам + LSH-бакеты.
+# Индекс целиком в памяти (отсортированные массивы, ~200 МБ на 1М задач), подписи — в таблице near_dup.
+SHINGLE = 4
+NUM_PERM = 48
+BANDS = 8
+ROWS = NUM_PERM // BANDS  # порог срабатывания LSH ≈ (1/BANDS)^(1/ROWS) ≈ 0.7
+MAX_ENTRIES = 2_000_000
+
+_MASK64 = (1 << 64) - 1
+# коэффициенты фиксированы: подписи лежат в базе и должны совпадать между перезапусками
+_rng = random.Random(0x0E6E61)
+_PERMS = [(_rng.getrandbits(64) | 1, _rng.getrandbits(64)) for _ in range(NUM_PERM)]
+
+# для каждого бакета: отсортированные хэши полос и параллельно — номер записи
+_band_keys = [array("Q") for _ in range(BANDS)]
+_band_idx = [array("I") for _ in range(BANDS)]
+_sigs = array("H")     # подписи подряд, по NUM_PERM на запись (старшие 16 бит каждого minhash)
+_nums = array("Q")     # отпечаток чисел из условия
+_row_ids = array("q")  # id строки в near_dup
+_loaded = False
+_load_task: asyncio.Task | None = None
+_forget_task: asyncio.Task | None = None
+# удалённые из базы записи помечаем в _nums (настоящий отпечаток — 56 бит, так что ни с чем не совпадёт);
+# мёртвых больше половины или индекс упёрся в MAX_ENTRIES — перестраиваем его из базы
+_DEAD = 1 << 63
+_dead = 0
+_added_while_loading: list[tuple[int, int, list[int]]] = []
+
+# шапки вида «Математика, 7 класс» и подписи полей из шаблона «✍️ Новое задание»
+_GRADE_LINE = re.compile(r"^[^\d\n]{0,40}\b\d{1,2}\s*-?\s*(?:й\s*)?класс[а-я]*\W*$", re.M)
+_LABELS = re.compile(r"(предмет|класс|условие|что нужно найти)\s*:")
+_NOT_CONTENT = re.compile(r"[^0-9a-zа-я+\-*/=^<>()%]+")
+_NUMBER = re.compile(r"\d+(?:[.,]\d+)?")
+
+
+def _clean(text: str) -> str:
+    t = _GRADE_LINE.sub(" ", text.lower())
+    t = _LABELS.sub(" ", t)
+    return normalize_task(t)
+
+
+def fingerprint(text: str, namespace: str = "") -> tuple[list[int], int] | None:
+    """
+    (MinHash-подпись, отпечаток чисел) или None, если сравнивать нечего.
+    Числа должны совпасть точно: «15% от 80» и «15% от 90» почти одинаковы по тексту, но это разные задачи.
+    namespace (модель + промпт, см. answer_cache.cache_namespace) входит в отпечаток чисел:
+    ответ, решённый другой моделью или со старым промптом, не находится.
+    """
+    t = _clean(text)
+    raw = namespace + "\0" + "|".join(_NUMBER.findall(t))
+    nums = hashlib.blake2b(raw.encode(), digest_size=7).digest()  # 56 бит — влезает в INTEGER
+
+    compact = _NOT_CONTENT.sub("", t)
+    if not compact:
+        return None
+
+    hashes = {
+        zlib.crc32(compact[i:i + SHINGLE].encode())
+        for i in range(max(1, len(compact) - SHINGLE + 1))
+    }
+    sig = [min(((a * h + b) & _MASK64) >> 48 for h in hashes) for a, b in _PERMS]
+    return sig, int.from_bytes(nums, "big")
+
+
+def _band_hash(sig, band: int) -> int:
+    return hash(tuple(sig[band * ROWS:(band + 1) * ROWS])) & _MASK64
+
+
+def _add(row_id: int, nums: int, sig) -> None:
+    if len(_row_ids) >= MAX_ENTRIES:
+        if _dead:
+            _reset()  # место занято удалёнными — перестроим без них, а эту запись возьмём после загрузки
+            _added_while_loading.append((row_id, nums, sig))
+        return  # в базе запись есть, в память не берём — индекс не растёт бесконечно
+
+    idx = len(_row_ids)
+    _row_ids.append(row_id)
+    _nums.append(nums)
+    _sigs.extend(sig)
+    for b in range(BANDS):
+        h = _band_hash(sig, b)
+        i = bisect_left(_band_keys[b], h)
+        _band_keys[b].insert(i, h)
+        _band_idx[b].insert(i, idx)
+
+
+def build_index(entries) -> None:
+    """
+    Массовая загрузка [(row_id, nums, sig), ...]: сортируем бакеты один раз, а не вставкой.
+    """
+    start = len(_row_ids)
+    for row_id, nums, sig in entries:
+        if len(_row_ids) >= MAX_ENTRIES:
+            break
+        _row_ids.append(row_id)
+        _nums.append(nums)
+        _sigs.extend(sig)
+
+    for b in range(BANDS):
+        pairs = [(_band_keys[b][i], _band_idx[b][i]) for i in range(len(_band_keys[b]))]
+        pairs += [
+            (_band_hash(_sigs[idx * NUM_PERM:(idx + 1) * NUM_PERM], b), idx)
+            for idx in range(start, len(_row_ids))
+        ]
+        pairs.sort()
+        _band_keys[b] = array("Q", (h for h, _ in pairs))
+        _band_idx[b] = array("I", (idx for _, idx in pairs))
+
+
+def lookup(sig, nums: int) -> tuple[int | None, float]:
+    """
+    Самая похожая запись среди кандидатов из LSH: (row_id, оценка сходства).
+    """
+    best, best_sim = None, 0.0
+    seen = set()
+    for b in range(BANDS):
+        keys, ids = _band_keys[b], _band_idx[b]
+        h = _band_hash(sig, b)
+        i = bisect_left(keys, h)
+        while i < len(keys) and keys[i] == h:
+            idx = ids[i]
+            i += 1
+            if idx in seen or _nums[idx] != nums:
+                continue
+            seen.add(idx)
+            stored = _sigs[idx * NUM_PERM:(idx + 1) * NUM_PERM]
+            sim = sum(x == y for x, y in zip(sig, stored)) / NUM_PERM
+            if sim > best_sim:
+                best, best_sim = idx, sim
+
+    return (_row_ids[best] if best is not None else None), best_sim
+
+
+async def load_index():
+    """
+    Поднимает индекс из базы. На 1М задач это секунды → сортировка в отдельном потоке.
+    """
+    global _loaded
+    rows = []
+    async for row_id, nums, blob in near_dup_rows():
+        sig = array("H")
+        sig.frombytes(blob)
+        rows.append((row_id, nums, sig))
+    await asyncio.to_thread(build_index, rows)
+
+    # то, что решили, пока шла загрузка (и чего не было в прочитанных строках)
+    last_loaded = rows[-1][0] if rows else 0
+    for row_id, nums, sig in _added_while_loading:
+        if row_id > last_loaded:
+            _add(row_id, nums, sig)
+    _added_while_loading.clear()
+    _loaded = True
+
+
+def _reset():
+    # индекс — заново из базы (в фоне, при следующем обращении); пока грузится, работаем без него
+    global _loaded, _load_task, _dead, _sigs, _nums, _row_ids
+    for b in range(BANDS):
+        _band_keys[b] = array("Q")
+        _band_idx[b] = array("I")
+    _sigs, _nums, _row_ids = array("H"), array("Q"), array("q")
+    _dead = 0
+    _loaded = False
+    _load_task = None
+
+
+async def _forget(row_ids: list[int]):
+    global _dead
+    gone = set(row_ids)
+    # полный проход по 2М записей — в потоке; менять будем уже здесь, в цикле событий
+    row_ids_now = _row_ids
+    found = await asyncio.to_thread(lambda: [i for i, r in enumerate(row_ids_now) if r in gone])
+    if row_ids_now is not _row_ids:
+        return  # индекс за это время перестроили из базы — удалённых там уже нет
+    for idx in found:
+        if _nums[idx] != _DEAD:
+            _nums[idx] = _DEAD
+            _dead += 1
+    if _dead * 2 > len(_row_ids):
+        _reset()
+
+
+def _ensure_loading() -> bool:
+    # индекс грузится в фоне при первом обращении; пока не готов — просто работаем без него
+    global _load_task, _forget_task
+    if _loaded:
+        # почистили таблицу (db.prune_near_dup) — выкидываем то же из памяти
+        if _forget_task is None or _forget_task.done():
+            pruned = take_pruned_near_dup()
+            if pruned:
+                _forget_task = asyncio.create_task(_forget(pruned))
+        return True
+    if _load_task is None:
+        _load_task = asyncio.create_task(load_index())
+    return False
+
+
+async def find_similar(text: str, namespace: str = "") -> str | None:
+    """
+    Ключ answer_cache для уже решённой похожей задачи или None.
+    """
+    if not _ensure_loading():
+        return None
+
+    fp = fingerprint(text, namespace)
+    if fp is None:
+        return None
+
+    row_id, sim = lookup(*fp)
+    if row_id is None or sim < NEAR_DUP_THRESHOLD:
+        return None
+    return await near_dup_answer_key(row_id)
+
+
+async def remember(text: str, answer_key: str, namespace: str = ""):
+    fp = fingerprint(text, namespace)
+    if fp is None:
+        return
+
+    sig, nums = fp
+    row_id = await near_dup_add(answer_key, nums, array("H", sig).tobytes())
+    if _ensure_loading():
+        _add(row_id, nums, sig)
+    else:
+        _added_while_loading.append((row_id, nums, sig))
+
+
+def index_size() -> int:
+    return len(_row_ids) - _dead
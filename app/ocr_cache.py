@@ -0,0 +1,319 @@
+import asyncio
+import logging
+import zlib
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+
+from PIL import Image, ImageChops, ImageOps
+
+from app.db import (
+    ocr_cache_find,
+    ocr_cache_row,
+    ocr_cache_put,
+    ocr_cache_hit,
+    ocr_cache_hashes,
+    ocr_cache_size,
+    take_pruned_ocr_cache,
+)
+
+# Кэш условий, считанных с фото. Ищем по очереди:
+# 1) file_unique_id — пересланное фото узнаём ещё до скачивания;
+# 2) sha256 байтов — тот же файл, загруженный заново;
+# 3) перцептивный хэш — то же фото, пережатое или уменьшенное (скриншот, «сохранить и отправить»).
+# dHash (256 бит) лишь находит кандидатов по расстоянию Хэмминга; решает сравнение миниатюр:
+# у страниц одной вёрстки с другими числами dHash почти одинаковый, а миниатюры 128×128 — нет.
+# Страница, переснятая заново (сдвиг, ракурс), поэтому обычно не совпадёт — и это правильно:
+# выдать чужое условие хуже, чем лишний раз позвать Gemini.
+THUMB_SIDE = 128
+THUMB_BLOCK = 4
+THUMB_MAX_DIFF = 24  # макс. средняя разница яркости в блоке 4×4 (0–255); пережатое фото — до ~15, другие цифры — от ~35
+HASH_SIDE = 16       # dHash 16×16 = 256 бит
+BANDS = 16           # полосы по 16 бит: расстояние ≤ 15 → хотя бы одна полоса совпадает точно
+MAX_DISTANCE = 15
+MAX_CANDIDATES = 3   # сколько ближайших кандидатов проверяем миниатюрой
+MAX_ENTRIES = 200_000
+MEM_MAX_ENTRIES = 50_000
+
+log = logging.getLogger(__name__)
+
+# "u:<file_unique_id>" / "h:<sha256>" -> (id строки, текст)
+_mem: OrderedDict[str, tuple[int, str]] = OrderedDict()
+_stats = {"file_hits": 0, "content_hits": 0, "similar_hits": 0, "misses": 0}
+
+# индекс похожих — как в app/near_dup.py: отсортированные полосы + номер записи
+_MASK64 = (1 << 64) - 1
+_band_keys = [array("H") for _ in range(BANDS)]
+_band_idx = [array("I") for _ in range(BANDS)]
+_hashes = array("Q")   # по 4 слова на запись
+_row_ids = array("q")  # id строки в ocr_cache
+_loaded = False
+_load_task: asyncio.Task | None = None
+_forget_task: asyncio.Task | None = None
+_added_while_loading: list[tuple[int, int]] = []
+# вытесненные из базы записи помечаем id = -1 и пропускаем; мёртвых больше половины — перестраиваем из базы.
+# Индекс полон — тоже перестраиваем, но только из самых свежих LOAD_ENTRIES строк: старые уходят, новые идут
+LOAD_ENTRIES = MAX_ENTRIES * 9 // 10
+_dead = 0
+
+
+def fingerprint(img: Image.Image) -> tuple[int, bytes]:
+    """
+    (dHash, миниатюра 128×128 в оттенках серого). Синхронно: зовётся в потоке разжатия (app/vision.py).
+    """
+    thumb = ImageOps.autocontrast(
+        img.convert("L").resize((THUMB_SIDE, THUMB_SIDE), Image.BOX), cutoff=2
+    )
+    small = thumb.resize((HASH_SIDE + 1, HASH_SIDE), Image.BOX).tobytes()
+    bits = 0
+    for y in range(HASH_SIDE):
+        row = small[y * (HASH_SIDE + 1):(y + 1) * (HASH_SIDE + 1)]
+        for x in range(HASH_SIDE):
+            bits = bits << 1 | (row[x] > row[x + 1])
+    return bits, thumb.tobytes()
+
+
+def thumb_diff(a: bytes, b: bytes) -> int:
+    size = (THUMB_SIDE, THUMB_SIDE)
+    d = ImageChops.difference(Image.frombytes("L", size, a), Image.frombytes("L", size, b))
+    blocks = d.resize((THUMB_SIDE // THUMB_BLOCK, THUMB_SIDE // THUMB_BLOCK), Image.BOX)
+    return max(blocks.tobytes())
+
+
+def _band(h: int, band: int) -> int:
+    return (h >> (16 * band)) & 0xFFFF
+
+
+def _add(row_id: int, h: int) -> None:
+    if len(_row_ids) >= MAX_ENTRIES:
+        _reset()
+        _added_while_loading.append((row_id, h))
+        return
+
+    idx = len(_row_ids)
+    _row_ids.append(row_id)
+    _hashes.extend((h >> (64 * w)) & _MASK64 for w in range(4))
+    for b in range(BANDS):
+        key = _band(h, b)
+        i = bisect_left(_band_keys[b], key)
+        _band_keys[b].insert(i, key)
+        _band_idx[b].insert(i, idx)
+
+
+def build_index(entries) -> None:
+    """
+    Массовая загрузка [(row_id, dhash), ...]: сортируем полосы один раз, а не вставкой.
+    """
+    start = len(_row_ids)
+    for row_id, h in entries:
+        if len(_row_ids) >= MAX_ENTRIES:
+            break
+        _row_ids.append(row_id)
+        _hashes.extend((h >> (64 * w)) & _MASK64 for w in range(4))
+
+    for b in range(BANDS):
+        pairs = list(zip(_band_keys[b], _band_idx[b]))
+        for idx in range(start, len(_row_ids)):
+            words = _hashes[idx * 4:idx * 4 + 4]
+            h = sum(word << (64 * w) for w, word in enumerate(words))
+            pairs.append((_band(h, b), idx))
+        pairs.sort()
+        _band_keys[b] = array("H", (k for k, _ in pairs))
+        _band_idx[b] = array("I", (i for _, i in pairs))
+
+
+def lookup(h: int) -> list[int]:
+    """
+    id строк с dHash не дальше MAX_DISTANCE, ближайшие первыми.
+    """
+    words = [(h >> (64 * w)) & _MASK64 for w in range(4)]
+    found = {}
+    for b in range(BANDS):
+        keys, ids = _band_keys[b], _band_idx[b]
+        key = _band(h, b)
+        i = bisect_left(keys, key)
+        while i < len(keys) and keys[i] == key:
+            idx = ids[i]
+            i += 1
+            if idx in found or _row_ids[idx] < 0:
+                continue
+            stored = _hashes[idx * 4:idx * 4 + 4]
+            found[idx] = sum((x ^ y).bit_count() for x, y in zip(words, stored))
+    near = sorted((d, idx) for idx, d in found.items() if d <= MAX_DISTANCE)
+    return [_row_ids[idx] for _, idx in near]
+
+
+async def load_index():
+    global _loaded
+    rows = [(row_id, int.from_bytes(blob, "big")) async for row_id, blob in ocr_cache_hashes(LOAD_ENTRIES)]
+    await asyncio.to_thread(build_index, rows)
+
+    last_loaded = rows[-1][0] if rows else 0
+    added = _added_while_loading[:]
+    _added_while_loading.clear()
+    for row_id, h in added:
+        # места нет — не перестраиваем посреди загрузки, запись просто не попадёт в индекс
+        if row_id > last_loaded and len(_row_ids) < MAX_ENTRIES:
+            _add(row_id, h)
+    _loaded = True
+
+
+def _reset():
+    # индекс — заново из базы (в фоне, при следующем обращении); пока грузится, ищем только точные совпадения
+    global _loaded, _load_task, _dead, _hashes, _row_ids
+    for b in range(BANDS):
+        _band_keys[b] = array("H")
+        _band_idx[b] = array("I")
+    _hashes, _row_ids = array("Q"), array("q")
+    _dead = 0
+    _loaded = False
+    _load_task = None
+
+
+async def _forget(row_ids: list[int]):
+    global _dead
+    gone = set(row_ids)
+    row_ids_now = _row_ids
+    found = await asyncio.to_thread(lambda: [i for i, r in enumerate(row_ids_now) if r in gone])
+    if row_ids_now is not _row_ids:
+        return  # индекс за это время перестроили из базы — вытесненных там уже нет
+    for idx in found:
+        if _row_ids[idx] >= 0:
+            _row_ids[idx] = -1
+            _dead += 1
+    if _dead * 2 > len(_row_ids):
+        _reset()
+
+
+def _ensure_loading() -> bool:
+    # индекс грузится в фоне при первом обращении; пока не готов — ищем только точные совпадения
+    global _load_task, _forget_task
+    if _loaded:
+        # db.evict_ocr_cache вытеснил строки — выкидываем их и из памяти
+        if _forget_task is None or _forget_task.done():
+            pruned = take_pruned_ocr_cache()
+            if pruned:
+                _forget_task = asyncio.create_task(_forget(pruned))
+        return True
+    if _load_task is None:
+        _load_task = asyncio.create_task(load_index())
+    return False
+
+
+def _mem_get(key: str) -> str | None:
+    entry = _mem.get(key)
+    if entry is None:
+        return None
+    _mem.move_to_end(key)
+    ocr_cache_hit(entry[0])  # продлеваем жизнь строки в базе
+    return entry[1]
+
+
+def _mem_put(key: str, row_id: int, text: str):
+    _mem[key] = (row_id, text)
+    _mem.move_to_end(key)
+    while len(_mem) > MEM_MAX_ENTRIES:
+        _mem.popitem(last=False)
+
+
+async def get_by_file(file_unique_id: str | None) -> str | None:
+    """
+    Условие по file_unique_id — до скачивания фото.
+    """
+    if not file_unique_id:
+        return None
+    key = "u:" + file_unique_id
+    text = _mem_get(key)
+    if text is None:
+        row = await ocr_cache_find(file_unique_id=file_unique_id)
+        if row is None:
+            return None
+        _mem_put(key, *row)
+        text = row[1]
+    _stats["file_hits"] += 1
+    return text
+
+
+async def get_by_content(sha256: str, dhash: int, thumb: bytes, file_unique_id: str | None = None) -> str | None:
+    """
+    Условие того же файла (sha256) или того же фото, пережатого/уменьшенного (dHash + миниатюра).
+    """
+    key = "h:" + sha256
+    text = _mem_get(key)
+    if text is None:
+        row = await ocr_cache_find(sha256=sha256)
+        if row is not None:
+            _mem_put(key, *row)
+            text = row[1]
+    if text is not None:
+        _stats["content_hits"] += 1
+        return text
+
+    if not _ensure_loading():
+        _stats["misses"] += 1
+        return None
+    checked = 0
+    for row_id in lookup(dhash):
+        if checked >= MAX_CANDIDATES:
+            break
+        row = await ocr_cache_row(row_id)
+        if row is None or row[1] is None:
+            continue  # строку уже вытеснили, а индекс ещё не знает — в счёт кандидатов не идёт
+        checked += 1
+        if thumb_diff(thumb, zlib.decompress(row[1])) > THUMB_MAX_DIFF:
+            continue
+        ocr_cache_hit(row_id)
+        _stats["similar_hits"] += 1
+        # привязываем новый файл к тому же тексту: в следующий раз найдётся сразу, без сравнения
+        await _link(file_unique_id, sha256, row[0])
+        return row[0]
+
+    _stats["misses"] += 1
+    return None
+
+
+async def _link(file_unique_id: str | None, sha256: str, text: str):
+    try:
+        row_id = await ocr_cache_put(file_unique_id, sha256, None, None, text)
+    except Exception:
+        log.exception("ocr cache write failed")
+        return
+    _mem_put("h:" + sha256, row_id, text)
+    if file_unique_id:
+        _mem_put("u:" + file_unique_id, row_id, text)
+
+
+async def put(file_unique_id: str | None, sha256: str, dhash: int, thumb: bytes, text: str):
+    """
+    Запоминает условие, которое только что прочитал Gemini.
+    """
+    if not text:
+        return
+    try:
+        row_id = await ocr_cache_put(
+            file_unique_id, sha256, dhash.to_bytes(HASH_SIDE * HASH_SIDE // 8, "big"), zlib.compress(thumb), text
+        )
+    except Exception:
+        # условие у юзера уже есть, кэш — не повод падать
+        log.exception("ocr cache write failed")
+        return
+
+    _mem_put("h:" + sha256, row_id, text)
+    if file_unique_id:
+        _mem_put("u:" + file_unique_id, row_id, text)
+    if _ensure_loading():
+        _add(row_id, dhash)
+    else:
+        _added_while_loading.append((row_id, dhash))
+
+
+async def ocr_cache_stats() -> dict:
+    hits = _stats["file_hits"] + _stats["content_hits"] + _stats["similar_hits"]
+    total = hits + _stats["misses"]
+    return {
+        **_stats,
+        "hit_ratio": hits / total if total else 0.0,
+        "mem_entries": len(_mem),
+        "index_entries": len(_row_ids) - _dead,
+        "db_entries": await ocr_cache_size(),
+    }
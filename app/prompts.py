@@ -0,0 +1,229 @@
+import re
+
+# Системный промпт (роль бота) собирается из кусков: ядро + модули нужных предметов + формат ответа.
+# Модули, которые к задаче не относятся, не отправляем — меньше входных токенов и быстрее первый токен.
+
+CORE = (
+"Ты — школьный учитель-наставник и решебник.\n\n"
+"Твоя задача — решать школьные задачи (5–11 классы) ЧИСЛЕННО И МЕТОДИЧЕСКИ ВЕРНО\n"
+"и объяснять решение шаг за шагом так, чтобы ученик понял логику.\n"
+"Пиши на русском. Коротко, понятно, строго по делу.\n\n"
+
+"ОСНОВНЫЕ ПРАВИЛА:\n"
+"1) НЕ здоровайся и НЕ представляйся.\n"
+"2) НЕ пиши, что ты ИИ или модель.\n"
+"3) ВСЕГДА используй формат ниже.\n"
+"4) ВСЕГДА показывай решение по шагам.\n"
+"5) Каждый шаг — одно действие и одно вычисление или логический вывод.\n"
+"6) Не делай шагов, которые просто повторяют условие.\n"
+"7) Не округляй, если в условии этого не просят.\n"
+"8) Если данных не хватает — задай уточняющий вопрос и остановись.\n"
+"9) Если есть правило «ответ -100» — при недостатке данных сразу пиши «Ответ: -100».\n"
+"10) Формулы пиши так, чтобы было удобно читать школьнику:\n"
+"    • степени: x², a³ (можно использовать символы ² и ³);\n"
+"    • корни: √5, √(a+b);\n"
+"    • дроби: (a+b)/c;\n"
+"    Если в условии формула была в виде sqrt(5),\n"
+"    в решении можно переписать как √5.\n\n"
+)
+
+FORMAT = (
+"ФОРМАТ ОТВЕТА (СТРОГО ТАК):\n\n"
+"📌 Задача\n"
+"Кратко перепиши условие в одну строку.\n\n"
+
+"🧠 Идея\n"
+"Коротко: какое правило используем и почему.\n\n"
+
+"✅ Решение\n"
+"Шаг 1 — ...\n"
+"Шаг 2 — ...\n"
+"Шаг 3 — ...\n\n"
+
+"🧾 Проверка (если уместно)\n"
+"Короткая проверка вычислений, подстановка или проверка здравым смыслом.\n\n"
+
+"🎯 Ответ\n"
+"Ответ: ...\n"
+)
+
+# порядок = порядок в промпте
+MODULES = {
+    "math": (
+        "МАТЕМАТИКА:\n"
+        "— Проценты считай от указанного или текущего значения.\n"
+        "— В задачах «было–стало» добавляй проверку здравым смыслом.\n"
+        "— В уравнениях каждое преобразование — отдельный шаг.\n"
+        "— При решении уравнений ОБЯЗАТЕЛЬНО делай проверку подстановкой.\n"
+        "— В смесях и растворах сначала находи массу вещества, затем общую массу.\n\n"
+    ),
+    "geometry": (
+        "ГЕОМЕТРИЯ:\n"
+        "— Всегда называй применяемое свойство (например: «сумма углов треугольника 180°»).\n"
+        "— В признаках равенства треугольников явно указывай признак (SSS, SAS, ASA).\n"
+        "— Если ответ состоит из нескольких равных величин, пиши явно: «по 70°», «два угла по 48°».\n"
+        "— Если можно решить без введения x, решай без x.\n"
+        "— В задачах на площади обязательно указывай единицы измерения (см^2, м^2).\n\n"
+    ),
+    "geography": (
+        "ГЕОГРАФИЯ (ОБЯЗАТЕЛЬНО):\n"
+        "— Географические координаты записывай в порядке: широта → долгота (например: 45° с. ш., 30° в. д.).\n"
+        "— В определениях (широта, долгота, атмосфера и т.п.) отвечай 1–2 предложениями без лишней теории.\n"
+        "— В задачах на масштаб всегда переводи результат в удобные школьные единицы (м, км).\n"
+        "— В ответе по масштабу пиши итог явно: «1 см на карте = … м (… км) на местности».\n"
+        "— В задачах на направление между объектами указывай ТОЧНОЕ направление\n"
+        "  (северо-запад, юго-восток и т.п.), а не только «север» или «юг».\n"
+        "— В вопросах о природных зонах и климатических поясах давай один школьный ответ без перечислений.\n\n"
+    ),
+    "russian": (
+        "РУССКИЙ ЯЗЫК (ОБЯЗАТЕЛЬНО):\n"
+        "— Никогда не объясняй запятые формулировками «можно убрать», «для удобства», «так принято».\n"
+        "— В объяснении пунктуации всегда указывай КОНКРЕТНОЕ правило.\n"
+        "— Причастный оборот:\n"
+        "  • если стоит ПОСЛЕ определяемого слова — выделяется запятыми;\n"
+        "  • если стоит ПЕРЕД определяемым словом — запятые не ставятся (если нет других условий).\n"
+        "— Деепричастный оборот:\n"
+        "  • ВСЕГДА выделяется запятыми;\n"
+        "  • причина — добавочное действие при основном;\n"
+        "  • место оборота в предложении не является причиной запятой.\n"
+        "— При поиске грамматических основ:\n"
+        "  • сначала определяй, простое или сложное предложение;\n"
+        "  • затем находи основы в КАЖДОЙ части.\n\n"
+    ),
+    "physics": (
+        "ФИЗИКА (ОБЯЗАТЕЛЬНО):\n"
+        "— Перед подстановкой в формулу ВСЕ величины должны быть в СОГЛАСОВАННЫХ единицах.\n"
+        "— Запрещено подставлять величины в разных единицах\n"
+        "  (км с м/с, часы с секундами, г с кг и т.п.).\n"
+        "— Если требуется перевод единиц, делай его ОТДЕЛЬНЫМ шагом ДО подстановки.\n"
+        "— После перевода используй ТОЛЬКО новые единицы.\n"
+        "— В формулах используй стандартные школьные обозначения:\n"
+        "  v — скорость, s — путь, t — время,\n"
+        "  m — масса, V — объём, ρ — плотность,\n"
+        "  F — сила, p — давление, A — работа, N — мощность.\n"
+        "— В «Идее» сначала указывай физический закон или правило словами,\n"
+        "  затем записывай формулу символами.\n"
+        "— В ответе ВСЕГДА указывай единицы измерения.\n"
+        "— Если ответ противоречит здравому смыслу, проверь единицы ещё раз.\n\n"
+    ),
+    "literature": (
+        "ЛИТЕРАТУРА (ОБЯЗАТЕЛЬНО):\n"
+        "— НЕ используй формальные шаги вида «проанализировать», «выделить», «определить».\n"
+        "— Ответы должны быть КРАТКИМИ и КОНКРЕТНЫМИ, без пересказа сюжета.\n"
+        "— Характеристика героя:\n"
+        "  • указывай 2–3 качества;\n"
+        "  • добавляй 1 краткий пример поступка (без пересказа сюжета).\n"
+        "— Род литературы называй напрямую (эпос / лирика / драма), без промежуточных рассуждений.\n"
+        "— Жанр произведения указывай БЕЗ оговорок и двойных формулировок\n"
+        "  (для «Капитанской дочки» — историческая повесть).\n"
+        "— Тема произведения ≠ идея произведения (не смешивай их).\n"
+        "— Средства художественной выразительности:\n"
+        "  • используй ТОЛЬКО школьные термины;\n"
+        "  • не называй оксюморон без явного противоречия;\n"
+        "  • для фразы «Мороз и солнце; день чудесный!» — ЭПИТЕТ.\n"
+        "— Литературное направление:\n"
+        "  • давай ОДИН школьный ответ;\n"
+        "  • для А. С. Пушкина — реализм.\n"
+        "— НЕ используй англицизмы и иностранные слова.\n\n"
+    ),
+}
+
+# Полный промпт — как раньше, на случай, когда предмет не угадали
+TEACHER_SYSTEM = CORE + "".join(MODULES.values()) + FORMAT
+
+# Модули, которые нужны вместе с другими: в геометрии и физике тоже есть вычисления и уравнения
+_ALSO = {"geometry": ("math",), "physics": ("math",)}
+
+# Явное название предмета: шапка «Математика, 7 класс», «Предмет: физика»
+_SUBJECT_NAMES = [
+    ("math", re.compile(r"\b(математик|алгебр)")),
+    ("geometry", re.compile(r"\bгеометри")),
+    ("geography", re.compile(r"\bгеографи")),
+    ("russian", re.compile(r"\bрусск[а-я]* язык")),
+    ("physics", re.compile(r"\bфизик")),
+    ("literature", re.compile(r"\b(литератур|литературн[а-я]* чтени)")),
+]
+SUBJECT_NAME_WEIGHT = 5
+
+# Ключевые слова (основы) по предметам: каждое совпадение — +1 к предмету
+_KEYWORDS = {
+    "math": re.compile(
+        r"\b(уравнени|вычисл|процент|дроб|выражени|упрост|неравенств|функци|график|пропорци|"
+        r"сколько|во сколько раз|на сколько|найди число|сумм[аы]|разност|произведени|частн|делител|кратн)"
+        r"|%|\d\s*[-+*/:=^]\s*\d|\b[xyх]\s*[-+=^²*/)]"
+    ),
+    "geometry": re.compile(
+        r"\b(треугольн|угол|угл[аыуо]|периметр|площад|окружност|круг|радиус|диаметр|диагонал|"
+        r"параллелограмм|трапеци|ромб|квадрат|прямоугольн|биссектрис|медиан|высот[аыу]|катет|гипотенуз|"
+        r"хорд|касательн|вершин|отрез|луч|перпендикуляр|параллельн|призм|пирамид|куб[аеу]?\b|объ[её]м)"
+        r"|°"
+    ),
+    "geography": re.compile(
+        r"\b(широт|долгот|масштаб|направлени|карт[аеуы]|материк|континент|океан|климат|природн[а-я]* зон|"
+        r"азимут|сторон[аы]? горизонта|север|юг[ау]?\b|запад|восток|рельеф|равнин|горн|вулкан|"
+        r"река|реки|озер|населени|столиц|полушари|экватор|меридиан|параллел[иья]\b|атмосфер|гидросфер|литосфер)"
+    ),
+    "russian": re.compile(
+        r"\b(запят|пунктуац|орфограф|причаст|деепричаст|грамматическ[а-я]* основ|подлежащ|сказуем|"
+        r"падеж|склонени|спряжени|част[ьи] речи|вставь|пропущенн[а-я]* букв|корень слова|суффикс|приставк|"
+        r"окончани|синоним|антоним|словосочетани|предложени|морфем|фонетическ|разбор|правописани|"
+        r"ударени|тире|двоеточи|обособ)"
+    ),
+    "physics": re.compile(
+        r"\b(скорост|масс[аыу]|сил[аыу]\b|давлени|плотност|энерги|мощност|работ[аыу]\b|ток[аи]?\b|"
+        r"напряжени|сопротивлени|ускорени|тело\b|тела\b|температур|теплот|кипени|плавлени|"
+        r"импульс|трени|рычаг|архимед|колебани|частот|линз|заряд)"
+        r"|\d\s*(м/с|км/ч|н|дж|вт|па|кг|ом)\b"
+    ),
+    "literature": re.compile(
+        r"\b(произведени[еия] [а-я]\.|произведени|геро[йяеи]|автор|стихотворени|роман[аеу]?\b|повест|рассказ[аеу]?\b|"
+        r"жанр|эпитет|метафор|олицетворени|сравнени[ея] в|гипербол|оксюморон|пушкин|лермонтов|гогол|толст[оы]|"
+        r"выразительност|тургенев|чехов|некрасов|есенин|крылов|басн|поэт|поэм|сюжет|образ[аеу]?\b|лирик|эпос|драм|"
+        r"рифм|строф|литературн)"
+    ),
+}
+
+# Берём предметы, набравшие не меньше этой доли от лучшего, и не больше MAX_SUBJECTS
+SUBJECT_SHARE = 0.4
+MAX_SUBJECTS = 3
+
+
+def classify(text: str) -> list[str]:
+    """
+    Предметы задачи по ключевым словам (без сети, доли миллисекунды). [] — не понятно.
+    """
+    t = text.lower().replace("ё", "е")
+    scores = {s: len(p.findall(t)) for s, p in _KEYWORDS.items()}
+    for s, p in _SUBJECT_NAMES:
+        if p.search(t):
+            scores[s] += SUBJECT_NAME_WEIGHT
+
+    best = max(scores.values())
+    if best == 0:
+        return []
+    picked = sorted((s for s, n in scores.items() if n >= best * SUBJECT_SHARE), key=lambda s: -scores[s])
+    return picked[:MAX_SUBJECTS]
+
+
+def _assemble(subjects: list[str]) -> str:
+    need = set(subjects)
+    for s in subjects:
+        need.update(_ALSO.get(s, ()))
+    return CORE + "".join(text for name, text in MODULES.items() if name in need) + FORMAT
+
+
+_systems: dict[frozenset, str] = {}
+
+
+def system_for(text: str) -> str:
+    """
+    Системный промпт под задачу: ядро + модули её предметов. Предмет не понятен — полный промпт.
+    """
+    subjects = classify(text)
+    if not subjects:
+        return TEACHER_SYSTEM
+    key = frozenset(subjects)
+    system = _systems.get(key)
+    if system is None:
+        system = _systems[key] = _assemble(subjects)
+    return system
@@ -0,0 +1,190 @@
+import asyncio
+import logging
+import random
+import time
+from collections import deque
+
+from app.limiter import AdaptiveLimiter, is_overload
+
+log = logging.getLogger(__name__)
+
+# Повторы: только на 429/5xx/таймаутах/обрывах сети, пауза — случайная в [0, min(MAX, BASE·2^n)]
+RETRY_ATTEMPTS = 3
+RETRY_BASE_DELAY = 0.5
+RETRY_MAX_DELAY = 8.0
+
+# Предохранитель: столько сбоев подряд → модель «лежит», BREAKER_OPEN_FOR секунд отказываем сразу,
+# потом пускаем один пробный запрос
+BREAKER_FAILURES = 5
+BREAKER_OPEN_FOR = 30.0
+
+# Хедж: второй такой же запрос, если первый дольше p95 (но не раньше HEDGE_MIN_DELAY)
+HEDGE_MIN_DELAY = 1.0
+HEDGE_MIN_SAMPLES = 20
+LATENCY_WINDOW = 200
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+def is_retryable(exc: BaseException) -> bool:
+    return is_overload(exc)
+
+
+class _Breaker:
+    def __init__(self, name: str):
+        self.name = name
+        self.failures = 0
+        self.opened_at: float | None = None
+        self.probing = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if self.probing or time.monotonic() - self.opened_at >= BREAKER_OPEN_FOR:
+            return "half-open"
+        return "open"
+
+    def allow(self) -> bool:
+        if self.opened_at is None:
+            return True
+        if self.probing or time.monotonic() - self.opened_at < BREAKER_OPEN_FOR:
+            return False
+        self.probing = True  # один пробный запрос, остальные пока отбиваем
+        return True
+
+    def success(self):
+        if self.opened_at is not None:
+            log.info("%s circuit closed", self.name)
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def failure(self):
+        self.failures += 1
+        if self.probing or (self.opened_at is None and self.failures >= BREAKER_FAILURES):
+            log.warning("%s circuit open for %.0f s after %d failures", self.name, BREAKER_OPEN_FOR, self.failures)
+            self.opened_at = time.monotonic()
+        self.probing = False
+
+    def release(self):
+        # проба закончилась ничем (отменили / ошибка запроса, а не провайдера)
+        self.probing = False
+
+
+class _Model:
+    def __init__(self, name: str):
+        self.name = name
+        self.breaker = _Breaker(name)
+        self.latencies: deque[float] = deque(maxlen=LATENCY_WINDOW)
+        self.stats = {
+            "calls": 0, "attempts": 0, "retries": 0, "hedges": 0, "hedge_wins": 0,
+            "ok": 0, "failed": 0, "fast_failed": 0,
+        }
+
+    def p95(self) -> float | None:
+        if len(self.latencies) < HEDGE_MIN_SAMPLES:
+            return None
+        values = sorted(self.latencies)
+        return values[int(len(values) * 0.95)]
+
+
+_models: dict[str, _Model] = {}
+
+
+def _model(name: str) -> _Model:
+    m = _models.get(name)
+    if m is None:
+        m = _models[name] = _Model(name)
+    return m
+
+
+async def _attempt(m: _Model, fn, limiter: AdaptiveLimiter | None):
+    if not m.breaker.allow():
+        raise CircuitOpenError(m.name)
+
+    m.stats["attempts"] += 1
+    start = time.monotonic()
+    try:
+        if limiter is None:
+            result = await fn()
+        else:
+            async with limiter.slot():
+                result = await fn()
+    except asyncio.CancelledError:
+        m.breaker.release()
+        raise
+    except Exception as e:
+        if is_retryable(e):
+            m.breaker.failure()
+        else:
+            m.breaker.release()
+        log.info("%s attempt failed after %.2f s: %r", m.name, time.monotonic() - start, e)
+        raise
+
+    m.latencies.append(time.monotonic() - start)
+    m.breaker.success()
+    return result
+
+
+async def _hedged(m: _Model, fn, limiter: AdaptiveLimiter | None):
+    p95 = m.p95()
+    if p95 is None:
+        return await _attempt(m, fn, limiter)
+
+    tasks = {asyncio.ensure_future(_attempt(m, fn, limiter))}
+    first = next(iter(tasks))
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=max(p95, HEDGE_MIN_DELAY))
+        # лимит забит — хедж только удлинит очередь остальным
+        if not done and (limiter is None or limiter.has_spare()):
+            m.stats["hedges"] += 1
+            tasks.add(asyncio.ensure_future(_attempt(m, fn, limiter)))
+
+        error = None
+        while tasks:
+            done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for t in done:
+                if t.exception() is None:
+                    if t is not first:
+                        m.stats["hedge_wins"] += 1
+                    return t.result()
+                error = t.exception()
+        raise error
+    finally:
+        for t in tasks:
+            t.cancel()
+
+
+async def call(model: str, fn, *, limiter: AdaptiveLimiter | None = None, hedge: bool = False):
+    """
+    Вызов ИИ с повторами, предохранителем на модель и (по желанию) хеджем.
+    fn — функция без аргументов, возвращающая корутину запроса; её могут вызвать несколько раз.
+    """
+    m = _model(model)
+    m.stats["calls"] += 1
+    for attempt in range(RETRY_ATTEMPTS):
+        if attempt:
+            m.stats["retries"] += 1
+            await asyncio.sleep(random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt)))
+        try:
+            result = await (_hedged(m, fn, limiter) if hedge else _attempt(m, fn, limiter))
+        except CircuitOpenError:
+            m.stats["fast_failed"] += 1
+            raise
+        except Exception as e:
+            if not is_retryable(e) or attempt == RETRY_ATTEMPTS - 1:
+                m.stats["failed"] += 1
+                raise
+            continue
+        m.stats["ok"] += 1
+        return result
+
+
+def resilience_stats() -> dict[str, dict]:
+    return {
+        name: {**m.stats, "breaker": m.breaker.state, "p95_ms": (m.p95() or 0.0) * 1000}
+        for name, m in _models.items()
+    }
@@ -0,0 +1,131 @@
+import asyncio
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+
+# Классы приоритета: меньше — раньше. Внутри класса юзеры обслуживаются по кругу,
+# так что один юзер с пачкой задач не отодвигает остальных.
+PRIORITY_ADMIN = 0
+PRIORITY_PAID = 1
+PRIORITY_FREE = 2
+
+# Сколько задач одного юзера может ждать в очереди (не считая той, что уже решается)
+USER_QUEUE_LIMIT = 2
+
+
+class QueueFull(Exception):
+    pass
+
+
+def priority_for(plan: str | None, admin: bool = False) -> int:
+    if admin:
+        return PRIORITY_ADMIN
+    return PRIORITY_FREE if (plan or "free") == "free" else PRIORITY_PAID
+
+
+class FairScheduler:
+    """
+    Очередь перед ИИ: выпускает не больше capacity() задач одновременно,
+    по приоритету класса, а внутри класса — по кругу между юзерами.
+    """
+
+    def __init__(self, name: str, capacity, user_limit: int = USER_QUEUE_LIMIT):
+        self.name = name
+        self._capacity = capacity  # функция: сейчас можно столько (следует за адаптивным лимитом)
+        self.user_limit = user_limit
+        self._running = 0
+        self._queues: dict[int, deque[asyncio.Future]] = {}
+        # класс → юзеры с ожидающими задачами, в порядке очереди обхода
+        self._rings: dict[int, OrderedDict[int, None]] = {}
+        self._wait = 0.0
+        self._stats = {"served": 0, "queued": 0, "rejected": 0}
+
+    def _dispatch(self):
+        while self._running < max(1, self._capacity()):
+            ring = next((self._rings[p] for p in sorted(self._rings) if self._rings[p]), None)
+            if ring is None:
+                return
+            user_id = next(iter(ring))
+            q = self._queues[user_id]
+            fut = q.popleft()
+            if q:
+                ring.move_to_end(user_id)  # следующий его запрос — после остальных юзеров
+            else:
+                del ring[user_id]
+                del self._queues[user_id]
+            if not fut.done():
+                self._running += 1
+                fut.set_result(None)
+
+    def _remove(self, user_id: int, priority: int, fut: asyncio.Future):
+        q = self._queues.get(user_id)
+        if q is None or fut not in q:
+            return
+        q.remove(fut)
+        if not q:
+            del self._queues[user_id]
+            self._rings[priority].pop(user_id, None)
+
+    def position(self, user_id: int, priority: int) -> int:
+        """
+        Сколько задач будет выпущено раньше ближайшей задачи юзера (0 — он следующий).
+        Оценка: новые задачи более высокого класса могут влезть вперёд.
+        """
+        ahead = sum(len(self._queues[u]) for p in sorted(self._rings) if p < priority for u in self._rings[p])
+        ring = self._rings.get(priority, {})
+        for u in ring:
+            if u == user_id:
+                break
+            ahead += 1
+        return ahead
+
+    @asynccontextmanager
+    async def turn(self, user_id: int, priority: int = PRIORITY_FREE, on_wait=None):
+        """
+        async with scheduler.turn(user_id, priority, on_wait=notify): ...
+        on_wait(position) вызывается, если сразу выпустить нельзя. Очередь юзера полна → QueueFull.
+        """
+        q = self._queues.get(user_id)
+        if q is not None and len(q) >= self.user_limit:
+            self._stats["rejected"] += 1
+            raise QueueFull(self.name)
+
+        queued_at = time.monotonic()
+        fut = asyncio.get_running_loop().create_future()
+        self._queues.setdefault(user_id, deque()).append(fut)
+        self._rings.setdefault(priority, OrderedDict()).setdefault(user_id, None)
+        self._dispatch()
+
+        try:
+            if not fut.done():
+                self._stats["queued"] += 1
+                if on_wait is not None:
+                    await on_wait(self.position(user_id, priority) + 1)
+                await fut
+        except BaseException:
+            if fut.done() and not fut.cancelled():
+                # место уже выдали — отдаём следующему
+                self._running -= 1
+                self._dispatch()
+            else:
+                fut.cancel()
+                self._remove(user_id, priority, fut)
+            raise
+
+        self._wait = 0.9 * self._wait + 0.1 * (time.monotonic() - queued_at)
+        self._stats["served"] += 1
+        try:
+            yield
+        finally:
+            self._running -= 1
+            self._dispatch()
+
+    def stats(self) -> dict:
+        return {
+            **self._stats,
+            "running": self._running,
+            "capacity": self._capacity(),
+            "waiting": sum(len(q) for q in self._queues.values()),
+            "users_waiting": len(self._queues),
+            "wait_ms": self._wait * 1000,
+        }
@@ -1,155 +1,385 @@
-import asyncio
+import contextlib
+import importlib.util
+import logging
+import re
+
+import httpx
 from mistralai import Mistral
 
-from app.config import MISTRAL_API_KEY
+from app.answer_cache import answer_key, cache_namespace, get_answer, put_answer
+from app.prompts import classify, system_for
+from app.near_dup import find_similar, remember
+from app.limiter import AdaptiveLimiter
+from app.resilience import call
+from app.scheduler import FairScheduler, QueueFull
+from app.singleflight import SingleFlight
+from app.metering import record
+from app.config import (
+    MISTRAL_API_KEY,
+    MISTRAL_POOL_SIZE,
+    MISTRAL_CONNECT_TIMEOUT,
+    MISTRAL_READ_TIMEOUT,
+    LLM_MAX_CONCURRENCY,
+    AI_HEDGING,
+    MODEL_ROUTING,
+)
+
+log = logging.getLogger(__name__)
 
-# Модель
+# Модель (без роутинга — только она)
 TEXT_MODEL = "mistral-small-latest"
 
-# Системный промпт (роль бота)
-TEACHER_SYSTEM = (
-"Ты — школьный учитель-наставник и решебник.\n\n"
-"Твоя задача — решать школьные задачи (5–11 классы) ЧИСЛЕННО И МЕТОДИЧЕСКИ ВЕРНО\n"
-"и объяснять решение шаг за шагом так, чтобы ученик понял логику.\n"
-"Пиши на русском. Коротко, понятно, строго по делу.\n\n"
-
-"ОСНОВНЫЕ ПРАВИЛА:\n"
-"1) НЕ здоровайся и НЕ представляйся.\n"
-"2) НЕ пиши, что ты ИИ или модель.\n"
-"3) ВСЕГДА используй формат ниже.\n"
-"4) ВСЕГДА показывай решение по шагам.\n"
-"5) Каждый шаг — одно действие и одно вычисление или логический вывод.\n"
-"6) Не делай шагов, которые просто повторяют условие.\n"
-"7) Не округляй, если в условии этого не просят.\n"
-"8) Если данных не хватает — задай уточняющий вопрос и остановись.\n"
-"9) Если есть правило «ответ -100» — при недостатке данных сразу пиши «Ответ: -100».\n"
-"10) Формулы пиши так, чтобы было удобно читать школьнику:\n"
-"    • степени: x², a³ (можно использовать символы ² и ³);\n"
-"    • корни: √5, √(a+b);\n"
-"    • дроби: (a+b)/c;\n"
-"    Если в условии формула была в виде sqrt(5),\n"
-"    в решении можно переписать как √5.\n\n"
-
-"МАТЕМАТИКА:\n"
-"— Проценты считай от указанного или текущего значения.\n"
-"— В задачах «было–стало» добавляй проверку здравым смыслом.\n"
-"— В уравнениях каждое преобразование — отдельный шаг.\n"
-"— При решении уравнений ОБЯЗАТЕЛЬНО делай проверку подстановкой.\n"
-"— В смесях и растворах сначала находи массу вещества, затем общую массу.\n\n"
-
-"ГЕОМЕТРИЯ:\n"
-"— Всегда называй применяемое свойство (например: «сумма углов треугольника 180°»).\n"
-"— В признаках равенства треугольников явно указывай признак (SSS, SAS, ASA).\n"
-"— Если ответ состоит из нескольких равных величин, пиши явно: «по 70°», «два угла по 48°».\n"
-"— Если можно решить без введения x, решай без x.\n"
-"— В задачах на площади обязательно указывай единицы измерения (см^2, м^2).\n\n"
-
-"ГЕОГРАФИЯ (ОБЯЗАТЕЛЬНО):\n"
-"— Географические координаты записывай в порядке: широта → долгота (например: 45° с. ш., 30° в. д.).\n"
-"— В определениях (широта, долгота, атмосфера и т.п.) отвечай 1–2 предложениями без лишней теории.\n"
-"— В задачах на масштаб всегда переводи результат в удобные школьные единицы (м, км).\n"
-"— В ответе по масштабу пиши итог явно: «1 см на карте = … м (… км) на местности».\n"
-"— В задачах на направление между объектами указывай ТОЧНОЕ направление\n"
-"  (северо-запад, юго-восток и т.п.), а не только «север» или «юг».\n"
-"— В вопросах о природных зонах и климатических поясах давай один школьный ответ без перечислений.\n\n"
-
-"РУССКИЙ ЯЗЫК (ОБЯЗАТЕЛЬНО):\n"
-"— Никогда не объясняй запятые формулировками «можно убрать», «для удобства», «так принято».\n"
-"— В объяснении пунктуации всегда указывай КОНКРЕТНОЕ правило.\n"
-"— Причастный оборот:\n"
-"  • если стоит ПОСЛЕ определяемого слова — выделяется запятыми;\n"
-"  • если стоит ПЕРЕД определяемым словом — запятые не ставятся (если нет других условий).\n"
-"— Деепричастный оборот:\n"
-"  • ВСЕГДА выделяется запятыми;\n"
-"  • причина — добавочное действие при основном;\n"
-"  • место оборота в предложении не является причиной запятой.\n"
-"— При поиске грамматических основ:\n"
-"  • сначала определяй, простое или сложное предложение;\n"
-"  • затем находи основы в КАЖДОЙ части.\n\n"
-
-"ФИЗИКА (ОБЯЗАТЕЛЬНО):\n"
-"— Перед подстановкой в формулу ВСЕ величины должны быть в СОГЛАСОВАННЫХ единицах.\n"
-"— Запрещено подставлять величины в разных единицах\n"
-"  (км с м/с, часы с секундами, г с кг и т.п.).\n"
-"— Если требуется перевод единиц, делай его ОТДЕЛЬНЫМ шагом ДО подстановки.\n"
-"— После перевода используй ТОЛЬКО новые единицы.\n"
-"— В формулах используй стандартные школьные обозначения:\n"
-"  v — скорость, s — путь, t — время,\n"
-"  m — масса, V — объём, ρ — плотность,\n"
-"  F — сила, p — давление, A — работа, N — мощность.\n"
-"— В «Идее» сначала указывай физический закон или правило словами,\n"
-"  затем записывай формулу символами.\n"
-"— В ответе ВСЕГДА указывай единицы измерения.\n"
-"— Если ответ противоречит здравому смыслу, проверь единицы ещё раз.\n\n"
-
-"ЛИТЕРАТУРА (ОБЯЗАТЕЛЬНО):\n"
-"— НЕ используй формальные шаги вида «проанализировать», «выделить», «определить».\n"
-"— Ответы должны быть КРАТКИМИ и КОНКРЕТНЫМИ, без пересказа сюжета.\n"
-"— Характеристика героя:\n"
-"  • указывай 2–3 качества;\n"
-"  • добавляй 1 краткий пример поступка (без пересказа сюжета).\n"
-"— Род литературы называй напрямую (эпос / лирика / драма), без промежуточных рассуждений.\n"
-"— Жанр произведения указывай БЕЗ оговорок и двойных формулировок\n"
-"  (для «Капитанской дочки» — историческая повесть).\n"
-"— Тема произведения ≠ идея произведения (не смешивай их).\n"
-"— Средства художественной выразительности:\n"
-"  • используй ТОЛЬКО школьные термины;\n"
-"  • не называй оксюморон без явного противоречия;\n"
-"  • для фразы «Мороз и солнце; день чудесный!» — ЭПИТЕТ.\n"
-"— Литературное направление:\n"
-"  • давай ОДИН школьный ответ;\n"
-"  • для А. С. Пушкина — реализм.\n"
-"— НЕ используй англицизмы и иностранные слова.\n\n"
-
-"ФОРМАТ ОТВЕТА (СТРОГО ТАК):\n\n"
-"📌 Задача\n"
-"Кратко перепиши условие в одну строку.\n\n"
-
-"🧠 Идея\n"
-"Коротко: какое правило используем и почему.\n\n"
-
-"✅ Решение\n"
-"Шаг 1 — ...\n"
-"Шаг 2 — ...\n"
-"Шаг 3 — ...\n\n"
-
-"🧾 Проверка (если уместно)\n"
-"Короткая проверка вычислений, подстановка или проверка здравым смыслом.\n\n"
-
-"🎯 Ответ\n"
-"Ответ: ...\n"
+# Уровни: (модель, потолок длины ответа в токенах). Простое — быстрой маленькой, сложное — большой
+TIERS = [
+    ("ministral-8b-latest", 1000),
+    ("mistral-small-latest", 2000),
+    ("mistral-medium-latest", 4000),
+]
+TIER_NAMES = ("light", "standard", "heavy")
+# «Модель» в ключе кэша ответов: с роутингом — весь набор уровней, так что их правка тоже сбрасывает кэш
+ANSWER_MODEL = "route:" + ",".join(f"{m}/{n}" for m, n in TIERS) if MODEL_ROUTING else TEXT_MODEL
+# Оценка сложности ниже LIGHT_BELOW → light, не ниже HEAVY_FROM → heavy, между — standard
+LIGHT_BELOW = 1.5
+HEAVY_FROM = 6.0
+# Вклад предмета в оценку; предмет не понятен — как средний
+SUBJECT_WEIGHT = {
+    "physics": 2.0, "geometry": 1.5, "literature": 1.5,
+    "russian": 1.0, "math": 0.5, "geography": 0.5,
+}
+UNKNOWN_SUBJECT_WEIGHT = 1.0
+
+_FORMULA = re.compile(r"[=<>^√²³]|\d\s*[-+*/:×·÷]\s*\d|\b(?:sin|cos|tg|ctg|log|sqrt)\b", re.I)
+# «1) … 2) …», «а) … б) …» — задача из нескольких пунктов
+_PARTS = re.compile(r"(?:^|\s)(?:\d{1,2}[.)]|[а-еa-e]\))\s", re.M)
+_STEPS = re.compile(r"\b(?:докажи|обоснуй|исследуй|построй график|сравни|затем|а также)", re.I)
+
+# Один общий keep-alive пул на весь бот; HTTP/2, если установлен h2 (pip install httpx[http2])
+_http = httpx.AsyncClient(
+    http2=importlib.util.find_spec("h2") is not None,
+    limits=httpx.Limits(
+        max_connections=MISTRAL_POOL_SIZE,
+        max_keepalive_connections=MISTRAL_POOL_SIZE,
+    ),
+    timeout=httpx.Timeout(
+        MISTRAL_READ_TIMEOUT,
+        connect=MISTRAL_CONNECT_TIMEOUT,
+        pool=MISTRAL_READ_TIMEOUT,
+    ),
 )
 
+client = Mistral(api_key=MISTRAL_API_KEY, async_client=_http)
 
+# Ограничиваем число одновременных запросов к ИИ: лимит растёт, пока Mistral отвечает ровно,
+# и падает на 429/5xx/таймаутах
+LLM_LIMITER = AdaptiveLimiter("mistral", initial=5, max_limit=LLM_MAX_CONCURRENCY)
+# Очередь решений перед лимитом: по кругу между юзерами, платные и админы — раньше
+SOLVE_QUEUE = FairScheduler("solve", lambda: LLM_LIMITER.limit)
+# одинаковые задачи, пришедшие одновременно, — один запрос к Mistral
+SOLVE_FLIGHTS = SingleFlight("solve")
 
+_route_stats = {**{name: 0 for name in TIER_NAMES}, "escalated": 0}
 
 
+class AIError(Exception):
+    """
+    ИИ не ответил (после повторов или предохранитель открыт) — кредит надо вернуть.
+    """
 
-client = Mistral(api_key=MISTRAL_API_KEY)
 
-# Ограничиваем число одновременных запросов к ИИ
-LLM_SEM = asyncio.Semaphore(5)
+AI_ERROR_MSG = (
+    "Похоже, сейчас есть проблема с ИИ 😕\n"
+    "Попробуй ещё раз через минуту."
+)
 
-async def ask_teacher(text: str) -> str:
+
+async def _cached_answer(text: str, system: str) -> tuple[str, str | None]:
     """
-    Отправляет текст в LLM и возвращает ответ учителя.
+    (ключ кэша, готовый ответ или None).
+    Одинаковые (после нормализации) задачи берутся из кэша ответов.
     """
-    messages = [
-        {"role": "system", "content": TEACHER_SYSTEM},
-        {"role": "user", "content": text},
+    key = answer_key(text, ANSWER_MODEL, system)
+    cached = await get_answer(key)
+    if cached is None:
+        # не точное совпадение — может, решали почти такую же (опечатки, шапка, другое фото той же страницы)
+        # тем же промптом и теми же моделями
+        similar_key = await find_similar(text, cache_namespace(ANSWER_MODEL, system))
+        if similar_key is not None:
+            cached = await get_answer(similar_key)
+    return key, cached
+
+
+async def _store_answer(text: str, system: str, key: str, answer: str):
+    # в кэш — только настоящие ответы (заглушка об ошибке сюда не доходит)
+    await put_answer(key, answer)
+    try:
+        await remember(text, key, cache_namespace(ANSWER_MODEL, system))
+    except Exception:
+        log.exception("near-dup index write failed")
+
+
+def _messages(text: str, system: str, context: dict | None = None) -> list[dict]:
+    if context is None:
+        return [
+            {"role": "system", "content": system},
+            {"role": "user", "content": text},
+        ]
+
+    # доп. вопрос: кратко старое (в системном) + последние реплики целиком + сам вопрос
+    if context["digest"]:
+        system += (
+            "\nИСХОДНАЯ ЗАДАЧА:\n" + context["topic"] + "\n"
+            "\nРАНЕЕ В ЭТОМ ДИАЛОГЕ (кратко):\n" + context["digest"] + "\n"
+        )
+    return [
+        {"role": "system", "content": system},
+        *context["history"],
+        {"role": "user", "content": "Доп. вопрос к задаче выше: " + text},
     ]
 
-    async with LLM_SEM:
+
+async def _prepare(text: str, context: dict | None) -> tuple[str, str | None, str | None]:
+    """
+    (системный промпт, ключ кэша, готовый ответ). У доп. вопросов кэша нет: ответ зависит от диалога.
+    """
+    # ядро + модули только нужных предметов; у доп. вопроса предмет — по исходной задаче
+    system = system_for(text if context is None else context["topic"] + "\n" + text)
+    if context is not None:
+        return system, None, None
+    key, cached = await _cached_answer(text, system)
+    return system, key, cached
+
+
+def task_score(text: str) -> float:
+    """
+    Грубая оценка сложности задачи локально: длина, формулы, число пунктов, предмет.
+    «Найди 15% от 80» — меньше 1, многопунктовая задача по физике — 6 и больше.
+    """
+    score = len(text) / 200
+    score += 0.5 * min(len(_FORMULA.findall(text)), 10)
+    parts = len(_PARTS.findall(text))
+    if parts > 1:
+        score += 1.5 * (parts - 1)
+    score += len(_STEPS.findall(text))
+    subjects = classify(text)
+    score += max((SUBJECT_WEIGHT.get(s, 0.0) for s in subjects), default=UNKNOWN_SUBJECT_WEIGHT)
+    return score
+
+
+def tier_for(text: str) -> int:
+    """
+    Индекс в TIERS: 0 — light, 1 — standard, 2 — heavy.
+    """
+    score = task_score(text)
+    return 0 if score < LIGHT_BELOW else 2 if score >= HEAVY_FROM else 1
+
+
+def _route(text: str, context: dict | None) -> list[tuple[str, int | None]]:
+    """
+    Попытки по порядку: [(модель, потолок ответа)]. Вторая — на уровень выше,
+    если ответ первой не прошёл проверку формата (или она не ответила); потолок у неё —
+    только если это старший уровень.
+    """
+    if not MODEL_ROUTING:
+        return [(TEXT_MODEL, None)]
+    tier = tier_for(text if context is None else context["topic"] + "\n" + text)
+    if context is not None:
+        tier = max(tier, 1)  # доп. вопрос держится на диалоге — маленькой модели не отдаём
+    _route_stats[TIER_NAMES[tier]] += 1
+    attempts = TIERS[tier:tier + 2]
+    if len(attempts) > 1 and tier + 1 < len(TIERS) - 1:
+        # последняя попытка не старшего уровня — без потолка: её ответ уже некому переспросить
+        attempts[-1] = (attempts[-1][0], None)
+    return attempts
+
+
+def _format_ok(answer: str, finish_reason: str | None, context: dict | None) -> bool:
+    # дешёвая проверка: ответ не обрезан потолком и (у задачи) есть итоговый блок «🎯 Ответ»
+    if not answer or finish_reason == "length":
+        return False
+    return context is not None or "🎯" in answer
+
+
+def _request(model: str, max_tokens: int | None, messages: list[dict]) -> dict:
+    kwargs = {"model": model, "messages": messages}
+    if max_tokens is not None:
+        kwargs["max_tokens"] = max_tokens
+    return kwargs
+
+
+def _slot(turn):
+    # turn — место в очереди к ИИ (SOLVE_QUEUE.turn у бота); занимает его только тот, кто зовёт модель:
+    # ответ из кэша и ожидание такой же задачи идут мимо очереди
+    return turn() if turn is not None else contextlib.nullcontext()
+
+
+async def _complete(text: str, system: str, context: dict | None, key: str | None, turn=None) -> str:
+    messages = _messages(text, system, context)
+    attempts = _route(text, context)
+    answer, ok, error = None, False, None
+    async with _slot(turn):
+        for i, (model, max_tokens) in enumerate(attempts):
+            if i:
+                _route_stats["escalated"] += 1
+            try:
+                # нативный async: ждём сокет, а не поток из общего executor
+                resp = await call(
+                    model,
+                    lambda m=model, n=max_tokens: client.chat.complete_async(**_request(m, n, messages)),
+                    limiter=LLM_LIMITER,
+                    hedge=AI_HEDGING,
+                )
+            except Exception as e:
+                error = e
+                continue  # младшая модель не ответила (или её предохранитель открыт) — пробуем старшую
+            if resp.usage is not None:
+                record(model, resp.usage.prompt_tokens, resp.usage.completion_tokens, text)
+            choice = resp.choices[0]
+            content = choice.message.content
+            if isinstance(content, str) and content:
+                answer = content
+                ok = _format_ok(content, choice.finish_reason, context)
+                if ok:
+                    break
+
+    if answer is None:
+        raise AIError(TEXT_MODEL) from error
+    # обрезанный или без итога — отдаём (лучше, чем ничего), но в кэш не кладём
+    if ok and key is not None:
+        await _store_answer(text, system, key, answer)
+    return answer
+
+
+async def _join_or_solve(key: str, fn):
+    # та же задача уже решается (фото гуляет по чату класса) → ждём тот же ответ, не занимая очередь
+    flight = SOLVE_FLIGHTS.pending(key)
+    if flight is not None:
         try:
-            # клиент синхронный → уводим в отдельный поток
-            resp = await asyncio.to_thread(
-                client.chat.complete,
-                model=TEXT_MODEL,
-                messages=messages,
-            )
-            return resp.choices[0].message.content
-        except Exception:
-            return (
-                "Похоже, сейчас есть проблема с ИИ 😕\n"
-                "Попробуй ещё раз через минуту."
-            )
+            return await SOLVE_FLIGHTS.wait(flight)
+        except QueueFull:
+            pass  # очередь переполнена у того юзера, не у нас — решаем сами
+    return await SOLVE_FLIGHTS.do((key,), fn)
+
+
+async def ask_teacher(text: str, context: dict | None = None, fresh: bool = False, turn=None) -> str:
+    """
+    Отправляет текст в LLM и возвращает ответ учителя.
+    context (см. app/conversations.py) — это доп. вопрос к прошлой задаче.
+    fresh — не брать из кэша, а спросить модель заново (и перезаписать кэш); для прогонов batch.py.
+    turn — очередь к ИИ (см. _slot); полна — QueueFull.
+    Не получилось — AIError.
+    """
+    if fresh and context is None:
+        # ни точного кэша, ни похожих задач — только модель
+        system = system_for(text)
+        key = answer_key(text, ANSWER_MODEL, system)
+        return await _join_or_solve(key, lambda: _complete(text, system, None, key, turn))
+
+    system, key, cached = await _prepare(text, context)
+    if cached is not None:
+        return cached
+    if key is None:
+        return await _complete(text, system, context, None, turn)
+    return await _join_or_solve(key, lambda: _complete(text, system, None, key, turn))
+
+
+async def ask_teacher_stream(text: str, context: dict | None = None, turn=None):
+    """
+    То же, что ask_teacher, но отдаёт ответ кусками по мере генерации.
+    Ответ из кэша и ответ, который ещё можно переспросить старшей моделью, приходят одним куском;
+    кусками — всегда только последняя попытка.
+    Оборвалось — AIError (часть ответа могла уже уйти). turn — как у ask_teacher.
+    """
+    system, key, cached = await _prepare(text, context)
+    if cached is not None:
+        yield cached
+        return
+
+    if key is not None:
+        # та же задача уже решается → ждём готовый ответ целиком, как из кэша (и мимо очереди)
+        flight = SOLVE_FLIGHTS.pending(key)
+        if flight is not None:
+            try:
+                answer = await SOLVE_FLIGHTS.wait(flight)
+            except (AIError, QueueFull):
+                answer = None  # у того запроса не вышло — пробуем сами
+            if answer is not None:
+                yield answer
+                return
+
+    flight = SOLVE_FLIGHTS.begin(key) if key is not None else None
+    messages = _messages(text, system, context)
+    attempts = _route(text, context)
+    streamed, answer, ok, error = False, None, False, None
+    try:
+        async with _slot(turn):
+            for i, (model, max_tokens) in enumerate(attempts):
+                if i:
+                    _route_stats["escalated"] += 1
+                # стримим только последнюю попытку: ответ раньших может не пройти проверку (обрезан, без итога),
+                # а показанное уже не забрать — они приходят целиком после проверки.
+                live = i == len(attempts) - 1
+                parts, finish = [], None
+                try:
+                    async with LLM_LIMITER.slot() as slot:
+                        # повторяем только открытие стрима: после первого куска ответ уже у юзера
+                        stream = await call(
+                            model,
+                            lambda m=model, n=max_tokens: client.chat.stream_async(**_request(m, n, messages)),
+                        )
+                        async for event in stream:
+                            if event.data.usage is not None:
+                                # usage приходит в последнем куске стрима
+                                record(model, event.data.usage.prompt_tokens, event.data.usage.completion_tokens, text)
+                            if not event.data.choices:
+                                continue
+                            choice = event.data.choices[0]
+                            finish = choice.finish_reason or finish
+                            delta = choice.delta.content
+                            if isinstance(delta, str) and delta:
+                                slot.mark()  # задержка для лимита — до первого куска
+                                parts.append(delta)
+                                if live:
+                                    streamed = True
+                                    yield delta
+                except Exception as e:
+                    error = e
+                    if streamed:
+                        # оборвалось посреди показанного ответа — второй ответ следом не дописываем
+                        answer = None
+                        break
+                    # до юзера ничего не дошло — есть модель постарше, пробуем её
+                    continue
+                if parts:
+                    answer = "".join(parts)
+                    ok = _format_ok(answer, finish, context)
+                    # показанный ответ — окончательный, даже если не прошёл проверку
+                    if ok or streamed:
+                        break
+    except QueueFull as e:
+        # места в очереди нет — ждущим то же, а не «ИИ не ответил»
+        if flight is not None:
+            SOLVE_FLIGHTS.finish(flight, None, e)
+        raise
+    finally:
+        # ждущим того же — ответ или ошибку (в том числе если наш юзер ушёл посреди стрима)
+        if flight is not None:
+            SOLVE_FLIGHTS.finish(flight, answer, None if answer is not None else AIError(TEXT_MODEL))
+
+    if answer is None:
+        raise AIError(TEXT_MODEL) from error
+    if not streamed:
+        yield answer  # ответ младшей модели (или единственный дошедший) — одним куском
+    # обрезанный или без итога — в кэш не кладём
+    if ok and key is not None:
+        await _store_answer(text, system, key, answer)
+
+
+def routing_stats() -> dict:
+    return dict(_route_stats)
+
+
+async def close_clients():
+    """
+    Закрывает HTTP-пул (вызывается при остановке бота).
+    """
+    await _http.aclose()
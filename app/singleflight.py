@@ -0,0 +1,72 @@
+import asyncio
+
+
+class SingleFlight:
+    """
+    Одинаковые запросы, пришедшие одновременно, ждут один вызов к ИИ, а не делают каждый свой.
+    Вызов идёт отдельной задачей: отмена одного ожидающего (ушёл юзер) не рвёт его остальным.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._flights: dict[str, asyncio.Future] = {}
+        self._stats = {"calls": 0, "coalesced": 0}
+
+    def pending(self, *keys: str) -> asyncio.Future | None:
+        for key in keys:
+            fut = self._flights.get(key)
+            if fut is not None:
+                return fut
+        return None
+
+    def _register(self, keys, fut: asyncio.Future):
+        for key in keys:
+            self._flights[key] = fut
+
+        def _done(f: asyncio.Future):
+            for key in keys:
+                if self._flights.get(key) is f:
+                    del self._flights[key]
+            if not f.cancelled():
+                f.exception()  # ошибку забрали: если ждать было некому, asyncio не будет ругаться
+
+        fut.add_done_callback(_done)
+
+    async def wait(self, fut: asyncio.Future):
+        self._stats["coalesced"] += 1
+        return await asyncio.shield(fut)
+
+    async def do(self, keys: tuple[str, ...], fn):
+        """
+        fn() — корутина вызова. Такой же вызов (по любому из ключей) уже идёт → ждём его результат.
+        """
+        fut = self.pending(*keys)
+        if fut is not None:
+            return await self.wait(fut)
+
+        self._stats["calls"] += 1
+        task = asyncio.ensure_future(fn())
+        self._register(keys, task)
+        return await asyncio.shield(task)
+
+    def begin(self, *keys: str) -> asyncio.Future:
+        """
+        Для стрима: ведущий сам отдаёт куски своему юзеру, а остальным в конце — весь ответ
+        (finish). Результат не пришёл (ошибка, обрыв) — finish с исключением.
+        """
+        self._stats["calls"] += 1
+        fut = asyncio.get_running_loop().create_future()
+        self._register(keys, fut)
+        return fut
+
+    @staticmethod
+    def finish(fut: asyncio.Future, result=None, error: Exception | None = None):
+        if fut.done():
+            return
+        if error is not None:
+            fut.set_exception(error)
+        else:
+            fut.set_result(result)
+
+    def stats(self) -> dict:
+        return {**self._stats, "in_flight": len(set(map(id, self._flights.values())))}
@@ -1,11 +1,64 @@
-import os
 import asyncio
+import contextlib
+import hashlib
+import importlib.util
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
+
+import httpx
 from PIL import Image
 from google import genai
+from google.genai import types
+
+from app.config import (
+    GEMINI_API_KEY,
+    GEMINI_POOL_SIZE,
+    OCR_TIMEOUT,
+    OCR_MAX_CONCURRENCY,
+    AI_HEDGING,
+    IMAGE_DECODE_WORKERS,
+)
+from app.limiter import AdaptiveLimiter
+from app.resilience import call
+from app.scheduler import FairScheduler, QueueFull
+from app.metering import record
+from app.db import bump_metric
+from app.singleflight import SingleFlight
+from app import ocr_cache
 
 MODEL_OCR = "gemini-2.5-flash"
-client = genai.Client(api_key=os.getenv("GEMINI_API_KEY", ""))
+
+# Клиент создаём при первом фото (без ключа бот работает и без OCR). Нативный async поверх своего
+# keep-alive пула: без потоков на каждый запрос и без нового соединения на каждое фото
+_http: httpx.AsyncClient | None = None
+_client: genai.Client | None = None
+
+# задержка запросов к Gemini (последние LATENCY_WINDOW) и сколько сейчас ждут ответа
+LATENCY_WINDOW = 500
+_latencies: deque[float] = deque(maxlen=LATENCY_WINDOW)
+_ocr_stats = {"calls": 0, "timeouts": 0, "failed": 0, "in_flight": 0}
+
+# свой лимит для Gemini: перегрузка OCR не должна резать решения в Mistral и наоборот
+OCR_LIMITER = AdaptiveLimiter("gemini", initial=5, max_limit=OCR_MAX_CONCURRENCY)
+OCR_QUEUE = FairScheduler("ocr", lambda: OCR_LIMITER.limit)
+# одно и то же фото от многих юзеров сразу (переслали в чат класса) — один запрос к Gemini
+OCR_FLIGHTS = SingleFlight("ocr")
+
+# Фото в Gemini — не больше MAX_SIDE по длинной стороне: стабильнее и дешевле
+MAX_SIDE = 1600
+# Больше — не разжимаем вовсе. Телефонные 12–50 Мп проходят: JPEG разжимается сразу уменьшенным (draft)
+MAX_PIXELS = 60_000_000
+# Сколько пикселей разжимаем на самом деле (после draft): ~3 байта на пиксель плюс копия при convert —
+# 8 Мп это до ~50 МБ на фото. У форматов без draft (PNG, WebP…) это и есть предел размера
+MAX_DECODED_PIXELS = 8_000_000
+JPEG_QUALITY = 90
+
+# Разжатие и уменьшение — в своих потоках, а не в цикле событий (12 Мп — десятки мс, все апдейты ждали бы).
+# Pillow отпускает GIL на декодировании и ресайзе, так что потоков хватает; число потоков = сколько фото
+# разжимаем одновременно. Свой пул, чтобы не занимать общий executor, где ждут ответы Gemini
+_decode_pool = ThreadPoolExecutor(max_workers=IMAGE_DECODE_WORKERS, thread_name_prefix="image")
 
 OCR_PROMPT = (
     "Считай текст с изображения школьного задания.\n"
@@ -15,29 +68,143 @@ OCR_PROMPT = (
     "Сохраняй формулы текстом: x^2, (a+b)/c, sqrt(5).\n"
 )
 
-def _prepare_image(photo_bytes: bytes) -> Image.Image:
-    img = Image.open(BytesIO(photo_bytes)).convert("RGB")
+def _prepare_image(photo_bytes: bytes) -> tuple[bytes, int, bytes]:
+    """
+    Фото → (JPEG не больше MAX_SIDE по длинной стороне, dHash, миниатюра для кэша OCR).
+    Синхронно: зовётся в _decode_pool.
+    """
+    img = Image.open(BytesIO(photo_bytes))  # пока только заголовок, пиксели не разжаты
+    w, h = img.size
+    if w * h > MAX_PIXELS:
+        raise ValueError(f"image too large: {w}x{h}")
+
+    scale = max(w, h) / MAX_SIDE
+    if scale > 1:
+        # JPEG разжимается сразу в 1/2, 1/4 или 1/8 размера (не меньше нужного) — быстрее и в разы меньше памяти
+        img.draft("RGB", (int(w / scale), int(h / scale)))
+    w, h = img.size  # у JPEG после draft — уже уменьшенный, у прочих — как был
+    if w * h > MAX_DECODED_PIXELS:
+        raise ValueError(f"image too large to decode: {w}x{h}")
+    img = img.convert("RGB")
 
-    # нормализация: уменьшаем, чтобы было стабильнее и дешевле
-    max_side = 1600
     w, h = img.size
-    scale = max(w, h) / max_side
+    scale = max(w, h) / MAX_SIDE
     if scale > 1:
         img = img.resize((int(w / scale), int(h / scale)))
 
-    return img
+    out = BytesIO()
+    img.save(out, "JPEG", quality=JPEG_QUALITY)
+    return out.getvalue(), *ocr_cache.fingerprint(img)
+
+
+async def prepare_image(photo_bytes: bytes) -> tuple[bytes, int, bytes]:
+    return await asyncio.get_running_loop().run_in_executor(_decode_pool, _prepare_image, photo_bytes)
+
 
-async def extract_task_from_photo_gemini(photo_bytes: bytes) -> str:
-    if not os.getenv("GEMINI_API_KEY"):
+async def cached_task_from_photo(file_unique_id: str | None) -> str | None:
+    """
+    Это фото уже читали (переслали в другой чат) → условие без скачивания и без Gemini.
+    """
+    return await ocr_cache.get_by_file(file_unique_id)
+
+
+def _gemini() -> genai.Client:
+    global _http, _client
+    if _client is None:
+        _http = httpx.AsyncClient(
+            http2=importlib.util.find_spec("h2") is not None,
+            limits=httpx.Limits(max_connections=GEMINI_POOL_SIZE, max_keepalive_connections=GEMINI_POOL_SIZE),
+            timeout=httpx.Timeout(OCR_TIMEOUT),
+        )
+        _client = genai.Client(
+            api_key=GEMINI_API_KEY,
+            http_options=types.HttpOptions(timeout=int(OCR_TIMEOUT * 1000), httpx_async_client=_http),
+        )
+    return _client
+
+
+async def extract_task_from_photo_gemini(photo_bytes: bytes, file_unique_id: str | None = None, turn=None) -> str:
+    """
+    Условие задачи с фото. turn — место в очереди к Gemini (OCR_QUEUE.turn у бота): занимает его
+    только тот, кто реально зовёт Gemini, — не ответ из кэша и не ожидание того же фото. Полна — QueueFull.
+    """
+    if not GEMINI_API_KEY:
         raise RuntimeError("GEMINI_API_KEY is empty")
 
-    img = _prepare_image(photo_bytes)
+    # пересланное фото узнаём по file_unique_id, загруженное заново тем же файлом — по содержимому
+    sha256 = hashlib.sha256(photo_bytes).hexdigest()
+    keys = ("h:" + sha256,)
+    if file_unique_id:
+        keys += ("u:" + file_unique_id,)
+    flight = OCR_FLIGHTS.pending(*keys)
+    if flight is not None:
+        try:
+            return await OCR_FLIGHTS.wait(flight)
+        except QueueFull:
+            pass  # очередь переполнена у того юзера, не у нас — читаем сами
+    return await OCR_FLIGHTS.do(keys, lambda: _ocr(photo_bytes, sha256, file_unique_id, turn))
+
+
+async def _ocr(photo_bytes: bytes, sha256: str, file_unique_id: str | None, turn=None) -> str:
+    jpeg, dhash, thumb = await prepare_image(photo_bytes)
+    # тот же файл или то же фото, пережатое, — условие уже есть
+    text = await ocr_cache.get_by_content(sha256, dhash, thumb, file_unique_id)
+    if text is not None:
+        return text
+
+    image = types.Part.from_bytes(data=jpeg, mime_type="image/jpeg")
+    client = _gemini()
+
+    async with turn() if turn is not None else contextlib.nullcontext():
+        # срок — на каждую попытку: зависший запрос обрываем, и его повторяют (таймаут = перегрузка для лимита)
+        _ocr_stats["calls"] += 1
+        bump_metric("ocr_calls")  # только настоящие запросы к Gemini: кэш и ожидание того же фото — не в счёт
+        _ocr_stats["in_flight"] += 1
+        started = time.monotonic()
+        try:
+            resp = await call(
+                MODEL_OCR,
+                lambda: asyncio.wait_for(
+                    client.aio.models.generate_content(model=MODEL_OCR, contents=[OCR_PROMPT, image]),
+                    OCR_TIMEOUT,
+                ),
+                limiter=OCR_LIMITER,
+                hedge=AI_HEDGING,
+            )
+        except Exception as e:
+            _ocr_stats["timeouts" if isinstance(e, asyncio.TimeoutError) else "failed"] += 1
+            raise
+        finally:
+            _ocr_stats["in_flight"] -= 1
+        _latencies.append(time.monotonic() - started)
+
+    meta = getattr(resp, "usage_metadata", None)
+    if meta is not None:
+        # у 2.5-flash «размышления» считаются отдельно, но оплачиваются как ответ
+        record(
+            MODEL_OCR,
+            meta.prompt_token_count,
+            (meta.candidates_token_count or 0) + (getattr(meta, "thoughts_token_count", None) or 0),
+            "[фото]",
+        )
+
+    text = (getattr(resp, "text", "") or "").strip()
+    await ocr_cache.put(file_unique_id, sha256, dhash, thumb, text)
+    return text
+
+
+def _pct(values: list[float], q: float) -> float:
+    return values[min(len(values) - 1, int(len(values) * q))] if values else 0.0
+
+
+def ocr_stats() -> dict:
+    lat = sorted(_latencies)
+    return {**_ocr_stats, "p50_ms": _pct(lat, .5) * 1000, "p95_ms": _pct(lat, .95) * 1000}
 
-    # google-genai синхронный внутри → уносим в thread
-    resp = await asyncio.to_thread(
-        client.models.generate_content,
-        model=MODEL_OCR,
-        contents=[OCR_PROMPT, img],
-    )
 
-    return (getattr(resp, "text", "") or "").strip()
+async def close_ocr_client():
+    """
+    Закрывает HTTP-пул к Gemini (вызывается при остановке бота).
+    """
+    if _http is not None:
+        await _http.aclose()
@@ -0,0 +1,196 @@
+"""
+Пакетное решение задач без Telegram: прогрев кэша ответов и прогоны после правки промпта.
+
+    python batch.py tasks.jsonl                       # решить всё, ответы — в кэш, который читает бот
+    python batch.py tasks.csv --concurrency 20
+    python batch.py tasks.jsonl --fresh --out v2.jsonl --compare v1.jsonl
+
+Вход: JSONL ({"id": ..., "task": ...}, вместо task можно text) или CSV с такими же колонками.
+Без id задача опознаётся по хэшу текста.
+Результаты дописываются в --out (по умолчанию <вход>.results.jsonl) сразу после каждой задачи —
+это и есть чекпоинт: перезапуск пропускает уже решённые, упавшие пробует снова.
+--fresh — не брать готовое из кэша, а спросить модель заново (для сравнения после правки промпта).
+--compare — прошлый файл результатов: сравнить задержку и итоговые ответы.
+
+Кэш ответов общий с ботом (SQLite), поэтому бот видит ответы сразу; индекс похожих задач
+бот держит в памяти и подхватит новые задачи после перезапуска.
+"""
+import argparse
+import asyncio
+import csv
+import hashlib
+import json
+import logging
+import re
+import time
+from pathlib import Path
+
+from app.db import init_db, close_db
+from app.metering import track
+from app.services import AIError, ask_teacher, close_clients
+
+log = logging.getLogger("batch")
+
+PROGRESS_EVERY = 50
+_FINAL = re.compile(r"🎯[^\n]*\n?(.*)", re.S)
+
+
+def read_tasks(path: Path):
+    """
+    (id, текст) по одной; пустые строки и строки без текста пропускаем.
+    """
+    with path.open(encoding="utf-8", newline="") as f:
+        rows = csv.DictReader(f) if path.suffix.lower() == ".csv" else (json.loads(line) for line in f if line.strip())
+        for row in rows:
+            text = (row.get("task") or row.get("text") or "").strip()
+            if not text:
+                continue
+            task_id = str(row.get("id") or "").strip() or hashlib.sha256(text.encode()).hexdigest()[:16]
+            yield task_id, text
+
+
+def read_results(path: Path) -> dict[str, dict]:
+    # последняя запись по id побеждает: после перезапуска упавшая задача могла решиться
+    results = {}
+    if path.exists():
+        with path.open(encoding="utf-8") as f:
+            for line in f:
+                try:
+                    row = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # недописанная строка, если процесс убили посреди записи
+                results[row["id"]] = row
+    return results
+
+
+def final_answer(answer: str) -> str:
+    m = _FINAL.search(answer or "")
+    return " ".join((m.group(1) if m else answer or "").split()).lower()
+
+
+def pct(values: list[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+async def solve(task_id: str, text: str, fresh: bool) -> dict:
+    row = {"id": task_id, "task": text}
+    t0 = time.perf_counter()
+    # пишем токены на user_id 0, как прочие вызовы не от юзера
+    with track(0) as usage:
+        try:
+            row["answer"] = await ask_teacher(text, fresh=fresh)
+            row["status"] = "ok"
+        except AIError as e:
+            row["status"] = "failed"
+            row["error"] = repr(e.__cause__ or e)
+    row["latency_ms"] = round((time.perf_counter() - t0) * 1000)
+    row["prompt_tokens"] = usage["prompt"]
+    row["completion_tokens"] = usage["completion"]
+    # вызова не было — ответ из кэша (или склеен с таким же запросом)
+    row["cached"] = row["status"] == "ok" and usage["calls"] == 0
+    return row
+
+
+async def run(args) -> list[dict]:
+    out = args.out or args.input.with_name(args.input.name + ".results.jsonl")
+    done = {i for i, r in read_results(out).items() if r.get("status") == "ok"}
+    todo = [(i, t) for i, t in read_tasks(args.input) if i not in done]
+    if args.limit:
+        todo = todo[:args.limit]
+    log.info("%d tasks to solve, %d already done (%s)", len(todo), len(done), out)
+
+    queue: asyncio.Queue = asyncio.Queue()
+    for item in todo:
+        queue.put_nowait(item)
+    rows: list[dict] = []
+    started = time.perf_counter()
+
+    with out.open("a", encoding="utf-8") as f:
+        async def worker():
+            while True:
+                try:
+                    task_id, text = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                row = await solve(task_id, text, args.fresh)
+                f.write(json.dumps(row, ensure_ascii=False) + "\n")
+                f.flush()  # чекпоинт: убили процесс — решённое не пропадёт
+                rows.append(row)
+                if len(rows) % PROGRESS_EVERY == 0:
+                    rate = len(rows) / (time.perf_counter() - started) * 60
+                    log.info("%d/%d done, %.0f tasks/min", len(rows), len(todo), rate)
+
+        # поверх — общий адаптивный лимит к Mistral (app/limiter.py), так что лишние воркеры просто подождут
+        await asyncio.gather(*(worker() for _ in range(max(1, args.concurrency))))
+
+    report(rows, time.perf_counter() - started)
+    if args.compare:
+        compare(rows, read_results(args.compare))
+    return rows
+
+
+def report(rows: list[dict], elapsed: float):
+    ok = [r for r in rows if r["status"] == "ok"]
+    failed = [r for r in rows if r["status"] != "ok"]
+    cached = sum(r["cached"] for r in ok)
+    prompt = sum(r["prompt_tokens"] for r in rows)
+    completion = sum(r["completion_tokens"] for r in rows)
+    solved = [r["latency_ms"] for r in ok if not r["cached"]]
+
+    print(f"\n{len(rows)} tasks in {elapsed:.1f} s ({len(rows) / max(elapsed, 1e-9) * 60:.0f} tasks/min)")
+    print(f"  ok {len(ok)} (from cache {cached}), failed {len(failed)}")
+    print(f"  tokens: prompt {prompt}, completion {completion}, total {prompt + completion}")
+    if solved:
+        print(f"  model latency: p50 {pct(solved, .5):.0f} ms, p95 {pct(solved, .95):.0f} ms")
+    for r in failed[:10]:
+        print(f"  failed {r['id']}: {r.get('error')}")
+    if len(failed) > 10:
+        print(f"  ... and {len(failed) - 10} more (status=failed in the results file)")
+
+
+def compare(rows: list[dict], before: dict[str, dict]):
+    pairs = [(before[r["id"]], r) for r in rows
+             if r["status"] == "ok" and before.get(r["id"], {}).get("status") == "ok"]
+    if not pairs:
+        print("\ncompare: no common solved tasks")
+        return
+
+    old_lat = [b["latency_ms"] for b, _ in pairs if not b.get("cached")]
+    new_lat = [r["latency_ms"] for _, r in pairs if not r["cached"]]
+    changed = [(b, r) for b, r in pairs if final_answer(b["answer"]) != final_answer(r["answer"])]
+    old_tok = sum(b.get("prompt_tokens", 0) + b.get("completion_tokens", 0) for b, _ in pairs)
+    new_tok = sum(r["prompt_tokens"] + r["completion_tokens"] for _, r in pairs)
+
+    print(f"\ncompare with previous run, {len(pairs)} tasks:")
+    print(f"  latency p50: {pct(old_lat, .5):.0f} → {pct(new_lat, .5):.0f} ms, "
+          f"p95: {pct(old_lat, .95):.0f} → {pct(new_lat, .95):.0f} ms")
+    print(f"  tokens: {old_tok} → {new_tok}")
+    print(f"  final answer changed: {len(changed)}")
+    for b, r in changed[:10]:
+        print(f"  {r['id']}: {final_answer(b['answer'])[:80]!r} → {final_answer(r['answer'])[:80]!r}")
+
+
+async def main():
+    ap = argparse.ArgumentParser(description="Пакетное решение задач (прогрев кэша, регрессионные прогоны)")
+    ap.add_argument("input", type=Path, help="JSONL или CSV с колонками id (необязательно) и task/text")
+    ap.add_argument("--out", type=Path, help="файл результатов и чекпоинт (по умолчанию <вход>.results.jsonl)")
+    ap.add_argument("--concurrency", type=int, default=8, help="сколько задач решаем одновременно")
+    ap.add_argument("--fresh", action="store_true", help="не брать ответы из кэша, спросить модель заново")
+    ap.add_argument("--compare", type=Path, help="прошлый файл результатов для сравнения")
+    ap.add_argument("--limit", type=int, default=0, help="решить не больше N задач (для пробы)")
+    args = ap.parse_args()
+
+    await init_db()
+    try:
+        await run(args)
+    finally:
+        await close_db()  # сбрасывает накопленные токены и метрики
+        await close_clients()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main())
@@ -0,0 +1,144 @@
+"""
+Бенчмарк подготовки фото для OCR (app/vision.py): старый путь против нового.
+
+    python bench/image_bench.py --photos 8 --size 4000x3000
+
+old — как было: полное разжатие и resize прямо в цикле событий;
+new — prepare_image: JPEG разжимается сразу уменьшенным (draft) в отдельном пуле потоков.
+
+Каждый вариант — в своём процессе (пиковая память процесса только растёт, а у дочернего
+на Linux ещё и наследуется от родителя — поэтому и фото генерируем отдельным процессом). Меряем:
+- сколько цикл событий не отвечал: «тикер» спит по 5 мс, считаем опоздания (max, p99);
+- время на все фото, пришедшие разом;
+- прирост пиковой памяти (RSS) процесса за прогон.
+"""
+import argparse
+import asyncio
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from io import BytesIO
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+TICK = 0.005
+
+
+def make_photo(width: int, height: int) -> bytes:
+    # «фото тетради»: светлый фон, строки текста и шум матрицы, чтобы JPEG весил как с телефона
+    from PIL import Image, ImageDraw
+
+    img = Image.new("RGB", (width, height), (236, 232, 220))
+    draw = ImageDraw.Draw(img)
+    for y in range(80, height - 80, 60):
+        draw.text((80, y), "Реши уравнение: 3x + 5 = 20. Найди 15% от числа 80. " * 6, fill=(40, 40, 60))
+    noise = Image.effect_noise((width, height), 24).convert("RGB")
+    img = Image.blend(img, noise, 0.15)
+    out = BytesIO()
+    img.save(out, "JPEG", quality=92)
+    return out.getvalue()
+
+
+def old_prepare(photo_bytes: bytes):
+    from PIL import Image
+
+    img = Image.open(BytesIO(photo_bytes)).convert("RGB")
+    w, h = img.size
+    scale = max(w, h) / 1600
+    if scale > 1:
+        img = img.resize((int(w / scale), int(h / scale)))
+    return img
+
+
+def pct(values: list[float], p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else 0.0
+
+
+def rss_mb() -> float:
+    # ru_maxrss: Linux — КБ, macOS — байты
+    r = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return r / 1024 / 1024 if sys.platform == "darwin" else r / 1024
+
+
+async def child(mode: str, path: str, photos: int) -> dict:
+    from app import vision
+
+    data = Path(path).read_bytes()
+    if mode == "new":
+        await vision.prepare_image(make_photo(64, 48))  # прогрев пула потоков
+    base = rss_mb()
+
+    lags: list[float] = []
+    done = False
+
+    async def ticker():
+        while not done:
+            t0 = time.perf_counter()
+            await asyncio.sleep(TICK)
+            lags.append(time.perf_counter() - t0 - TICK)
+
+    async def one():
+        if mode == "old":
+            old_prepare(data)  # так было: прямо в цикле событий
+        else:
+            await vision.prepare_image(data)
+
+    tick = asyncio.create_task(ticker())
+    await asyncio.sleep(TICK * 2)
+    t0 = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(photos)))
+    elapsed = time.perf_counter() - t0
+    done = True
+    await tick
+
+    return {
+        "elapsed_ms": elapsed * 1000,
+        "stall_max_ms": max(lags) * 1000,
+        "stall_p99_ms": pct(lags, .99) * 1000,
+        "rss_growth_mb": rss_mb() - base,
+    }
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--photos", type=int, default=8, help="сколько фото приходит одновременно")
+    ap.add_argument("--size", default="4000x3000", help="размер фото (12 Мп по умолчанию)")
+    ap.add_argument("--child", choices=["make", "old", "new"], help=argparse.SUPPRESS)
+    ap.add_argument("--path", help=argparse.SUPPRESS)
+    args = ap.parse_args()
+
+    w, h = map(int, args.size.split("x"))
+    if args.child == "make":
+        Path(args.path).write_bytes(make_photo(w, h))
+        return
+    if args.child:
+        print(json.dumps(asyncio.run(child(args.child, args.path, args.photos))))
+        return
+
+    with tempfile.NamedTemporaryFile(suffix=".jpg", delete=False) as f:
+        pass
+    try:
+        subprocess.run([sys.executable, __file__, "--child", "make", "--path", f.name, "--size", args.size], check=True)
+        size = os.path.getsize(f.name)
+        print(f"photo {w}x{h}, {size / 1024 / 1024:.1f} MB JPEG, {args.photos} at once")
+
+        for mode in ("old", "new"):
+            out = subprocess.run(
+                [sys.executable, __file__, "--child", mode, "--path", f.name, "--photos", str(args.photos)],
+                capture_output=True, text=True, check=True,
+            ).stdout
+            r = json.loads(out.strip().splitlines()[-1])
+            print(f"  {mode}: total {r['elapsed_ms']:.0f} ms, event loop stall max {r['stall_max_ms']:.1f} ms "
+                  f"(p99 {r['stall_p99_ms']:.1f} ms), peak RSS +{r['rss_growth_mb']:.0f} MB")
+    finally:
+        os.unlink(f.name)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+"""
+Бенчмарк индекса похожих задач (app/near_dup.py).
+
+    python bench/near_dup_bench.py --total 1000000 --real 20000
+
+В индекс кладём --real настоящих задач из шаблонов (со случайными числами и словами),
+остальное до --total — случайные подписи: у несвязанных текстов minhash-значения
+независимы, так что это честная замена миллиону разных задач без часов на их генерацию.
+
+Меряем:
+- задержку поиска (подпись + LSH-поиск) p50/p95/p99;
+- recall на «перепечатанных» копиях сохранённых задач (опечатки, пробелы, шапка «… класс»);
+- долю ложных совпадений на новых задачах (те же шаблоны, другие числа/слова);
+- сколько из них совпало бы без проверки чисел;
+- ложные совпадения, когда числа те же, а вопрос другой;
+- время построения и пиковую память процесса.
+"""
+import argparse
+from array import array
+import random
+import resource
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from app import near_dup  # noqa: E402
+from app.config import NEAR_DUP_THRESHOLD  # noqa: E402
+
+NAMES = ["Петя", "Маша", "Коля", "Оля", "Саша", "Вика", "Дима", "Аня"]
+THINGS = ["яблок", "груш", "тетрадей", "карандашей", "марок", "орехов", "книг", "конфет"]
+TEMPLATES = [
+    "У {n1} было {a} {t1}. Он отдал {b} {t1} другу. Сколько {t1} осталось?",
+    "Поезд ехал {a} часа со скоростью {b} км/ч. Какое расстояние он проехал?",
+    "Найди {a}% от числа {b}.",
+    "Реши уравнение: {a}x + {b} = {c}",
+    "Периметр прямоугольника {a} см, одна сторона {b} см. Найди площадь.",
+    "В классе {a} учеников, из них {b} девочек. Сколько процентов мальчиков?",
+    "Масса раствора {a} г, концентрация соли {b}%. Сколько граммов соли в растворе?",
+    "Тело массой {a} кг движется со скоростью {b} м/с. Найди кинетическую энергию.",
+    "{n1} прочитал {a} страниц, а {n2} на {b} страниц больше. Сколько страниц прочитали вместе?",
+    "Угол треугольника равен {a}°, второй угол {b}°. Найди третий угол.",
+    "На карте масштаба 1:{a}00000 расстояние между городами {b} см. Найди расстояние на местности.",
+    "Вычисли: ({a} + {b}) * {c} - {a}",
+]
+
+
+# тот же текст и те же числа, но спрашивают другое — такие задачи склеивать нельзя
+QUESTION_SWAPS = [
+    ("Сколько {t} осталось?", "Сколько {t} было бы, если бы он получил ещё столько же?"),
+    ("Какое расстояние он проехал?", "Какое время он потратит на обратный путь?"),
+    ("Найди площадь.", "Найди вторую сторону."),
+    ("Сколько процентов мальчиков?", "Во сколько раз мальчиков больше, чем девочек?"),
+    ("Найди кинетическую энергию.", "Найди импульс тела."),
+    ("Найди третий угол.", "Найди внешний угол при третьей вершине."),
+    ("Сколько страниц прочитали вместе?", "На сколько процентов больше прочитал второй?"),
+]
+
+
+def swap_question(text: str) -> str | None:
+    for old, new in QUESTION_SWAPS:
+        for t in THINGS:
+            o = old.format(t=t)
+            if o in text:
+                return text.replace(o, new.format(t=t))
+    return None
+
+
+def make_task(rng: random.Random) -> str:
+    return rng.choice(TEMPLATES).format(
+        a=rng.randint(2, 999), b=rng.randint(2, 999), c=rng.randint(2, 999),
+        n1=rng.choice(NAMES), n2=rng.choice(NAMES), t1=rng.choice(THINGS),
+    )
+
+
+def perturb(text: str, rng: random.Random) -> str:
+    chars = list(text)
+    # одна-две опечатки в буквах (цифры не трогаем — это уже другая задача)
+    for _ in range(rng.randint(1, 2)):
+        i = rng.randrange(len(chars))
+        if chars[i].isalpha():
+            chars[i] = rng.choice("аеиоуыпрст")
+    t = "".join(chars).replace(" ", "  ", 1)
+    if rng.random() < 0.5:
+        t = f"{rng.choice(['Математика', 'Физика', 'Геометрия'])}, {rng.randint(5, 11)} класс\n" + t
+    if rng.random() < 0.5:
+        t = t.rstrip("?.") + "??"
+    return t
+
+
+def pct(values: list[float], p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--total", type=int, default=1_000_000)
+    ap.add_argument("--real", type=int, default=20_000)
+    ap.add_argument("--queries", type=int, default=2_000)
+    ap.add_argument("--seed", type=int, default=1)
+    args = ap.parse_args()
+    rng = random.Random(args.seed)
+
+    t0 = time.perf_counter()
+    real_texts = [make_task(rng) for _ in range(args.real)]
+    entries = []
+    for i, text in enumerate(real_texts):
+        sig, nums = near_dup.fingerprint(text)
+        entries.append((i, nums, sig))
+    t_sig = time.perf_counter() - t0
+
+    for i in range(args.real, args.total):
+        sig = array("H")
+        sig.frombytes(rng.randbytes(2 * near_dup.NUM_PERM))
+        entries.append((i, rng.getrandbits(56), sig))
+
+    t0 = time.perf_counter()
+    near_dup.build_index(entries)
+    t_build = time.perf_counter() - t0
+    del entries
+
+    # 1) копии сохранённых задач с шумом → должны находиться и указывать на оригинал
+    lat, found, correct = [], 0, 0
+    for _ in range(args.queries):
+        i = rng.randrange(args.real)
+        q = perturb(real_texts[i], rng)
+        t0 = time.perf_counter()
+        row_id, sim = near_dup.lookup(*near_dup.fingerprint(q))
+        lat.append((time.perf_counter() - t0) * 1000)
+        if row_id is not None and sim >= NEAR_DUP_THRESHOLD:
+            found += 1
+            correct += real_texts[row_id] == real_texts[i]
+
+    # 2) новые задачи → любое срабатывание = ложное совпадение
+    stored = set(real_texts)
+    false_hits, false_without_nums, novel = 0, 0, 0
+    for _ in range(args.queries):
+        q = make_task(rng)
+        if q in stored:
+            continue
+        novel += 1
+        sig, nums = near_dup.fingerprint(q)
+        t0 = time.perf_counter()
+        row_id, sim = near_dup.lookup(sig, nums)
+        lat.append((time.perf_counter() - t0) * 1000)
+        false_hits += row_id is not None and sim >= NEAR_DUP_THRESHOLD
+
+        # то же без проверки чисел: подменяем отпечаток на отпечаток кандидата
+        best = 0.0
+        for b in range(near_dup.BANDS):
+            keys, ids = near_dup._band_keys[b], near_dup._band_idx[b]
+            h = near_dup._band_hash(sig, b)
+            j = near_dup.bisect_left(keys, h)
+            while j < len(keys) and keys[j] == h:
+                idx = ids[j]
+                j += 1
+                s = near_dup._sigs[idx * near_dup.NUM_PERM:(idx + 1) * near_dup.NUM_PERM]
+                best = max(best, sum(x == y for x, y in zip(sig, s)) / near_dup.NUM_PERM)
+        false_without_nums += best >= NEAR_DUP_THRESHOLD
+
+    # 3) те же числа, другой вопрос → совпадение = неправильный ответ
+    swapped_total, swapped_hits = 0, 0
+    for text in real_texts[:args.queries]:
+        q = swap_question(text)
+        if q is None:
+            continue
+        swapped_total += 1
+        row_id, sim = near_dup.lookup(*near_dup.fingerprint(q))
+        swapped_hits += row_id is not None and sim >= NEAR_DUP_THRESHOLD
+
+    rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    index_mb = sum(
+        a.buffer_info()[1] * a.itemsize
+        for a in [near_dup._sigs, near_dup._nums, near_dup._row_ids, *near_dup._band_keys, *near_dup._band_idx]
+    ) / 1024 / 1024
+    print(f"index: {near_dup.index_size():,} tasks ({args.real:,} real), threshold {NEAR_DUP_THRESHOLD}")
+    print(f"signatures: {t_sig / args.real * 1000:.2f} ms/task, build: {t_build:.1f} s")
+    print(f"index memory: {index_mb:.0f} MB, peak RSS of the benchmark process: {rss_mb:.0f} MB")
+    print(f"lookup latency (fingerprint + LSH): p50 {pct(lat, .5):.2f} ms, "
+          f"p95 {pct(lat, .95):.2f} ms, p99 {pct(lat, .99):.2f} ms")
+    print(f"near-duplicates found: {found}/{args.queries} ({found / args.queries:.1%}), "
+          f"pointing to the right task: {correct}/{found}")
+    print(f"false matches on {novel} new tasks: {false_hits} ({false_hits / max(novel, 1):.2%}); "
+          f"without the numbers check: {false_without_nums} ({false_without_nums / max(novel, 1):.2%})")
+    print(f"false matches on {swapped_total} same-numbers/different-question tasks: {swapped_hits} "
+          f"({swapped_hits / max(swapped_total, 1):.2%})")
+
+
+if __name__ == "__main__":
+    main()
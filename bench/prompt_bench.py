@@ -0,0 +1,165 @@
+"""
+Бенчмарк сборки промпта по предметам (app/prompts.py) против полного TEACHER_SYSTEM.
+
+    python bench/prompt_bench.py
+    python bench/prompt_bench.py --live 10   # + реальные запросы к Mistral (нужен MISTRAL_API_KEY)
+
+Без сети меряем:
+- размер системного промпта (символы и оценка токенов) — полный и собранный, по предметам;
+- угадывает ли классификатор предмет на размеченных задачах;
+- время классификации + сборки p50/p99;
+- на какой уровень модели роутер (app/services.py) отправляет задачи каждого предмета.
+С --live: prompt_tokens из usage и время до первого токена (стрим) для обоих вариантов.
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from app.prompts import TEACHER_SYSTEM, classify, system_for  # noqa: E402
+from app.services import TIER_NAMES, tier_for  # noqa: E402
+
+# Для русского текста у токенизатора Mistral выходит ~3 символа на токен; точные числа — в --live
+CHARS_PER_TOKEN = 3.0
+
+TASKS = [
+    ("math", "Реши уравнение: 3x + 5 = 20"),
+    ("math", "Найди 15% от числа 80."),
+    ("math", "Вычисли: (12 + 8) * 3 - 12"),
+    ("math", "У Пети было 25 яблок. Он отдал 7 яблок другу. Сколько яблок осталось?"),
+    ("math", "Сократи дробь 18/24 и найди значение выражения 3/4 + 1/8."),
+    ("math", "Масса раствора 200 г, концентрация соли 15%. Сколько граммов соли в растворе?"),
+    ("math", "Реши неравенство 2x - 7 > 5"),
+    ("math", "Во сколько раз 96 больше, чем 12?"),
+    ("geometry", "Угол треугольника равен 40°, второй угол 70°. Найди третий угол."),
+    ("geometry", "Найди площадь прямоугольника со сторонами 3 см и 4 см."),
+    ("geometry", "Периметр квадрата 36 см. Найди его сторону."),
+    ("geometry", "Катеты прямоугольного треугольника 6 и 8. Найди гипотенузу."),
+    ("geometry", "Радиус окружности 5 см. Найди длину окружности и площадь круга."),
+    ("geometry", "В равнобедренном треугольнике угол при вершине 80°. Найди углы при основании."),
+    ("geography", "Определи географические координаты Москвы (широта и долгота)."),
+    ("geography", "Масштаб карты 1:100000, расстояние между городами 5 см. Найди расстояние на местности."),
+    ("geography", "В каком направлении от Москвы находится Санкт-Петербург?"),
+    ("geography", "Какой климатический пояс и природная зона у Сахары?"),
+    ("geography", "Назови самый большой материк и омывающие его океаны."),
+    ("russian", "Расставь запятые: Мальчик читающий книгу сидел у окна."),
+    ("russian", "Подчеркни грамматическую основу: Солнце ярко светило над рекой."),
+    ("russian", "Выдели деепричастный оборот: Улыбаясь он вошёл в комнату."),
+    ("russian", "Вставь пропущенные буквы: пр..красный, пр..ехать, пр..говор."),
+    ("russian", "Сделай морфемный разбор слова «подснежник»: корень, приставка, суффикс."),
+    ("russian", "Определи падеж и склонение существительных в предложении: Дети гуляли в парке."),
+    ("physics", "Тело массой 2 кг движется со скоростью 3 м/с. Найди кинетическую энергию."),
+    ("physics", "Какое давление оказывает вода на глубине 10 м? Плотность воды 1000 кг/м³."),
+    ("physics", "Сила тока 2 А, напряжение 12 В. Найди сопротивление проводника."),
+    ("physics", "Какую работу совершает сила 50 Н на пути 4 м?"),
+    ("physics", "Сколько теплоты нужно, чтобы нагреть 2 кг воды на 10 °C?"),
+    ("physics", "Автомобиль разгоняется с ускорением 2 м/с² за 5 с. Какую скорость он наберёт?"),
+    ("literature", "Охарактеризуй героя повести Пушкина «Капитанская дочка» Петра Гринёва."),
+    ("literature", "Какое средство выразительности в строке «Мороз и солнце; день чудесный!»?"),
+    ("literature", "Определи жанр и род литературы произведения «Бородино» Лермонтова."),
+    ("literature", "В чём тема и идея басни Крылова «Стрекоза и муравей»?"),
+    ("literature", "Найди эпитеты и метафоры в стихотворении Есенина «Берёза»."),
+    ("math", "Математика, 6 класс\nВычисли 2/3 от 27."),
+    ("physics", "Предмет: физика\nКласс: 7\nУсловие: Плотность тела 800 кг/м³, объём 0,5 м³. Найди массу."),
+]
+
+
+def tokens(text: str) -> int:
+    return round(len(text) / CHARS_PER_TOKEN)
+
+
+def pct(values: list[float], p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+async def live(n: int):
+    import httpx
+    from mistralai import Mistral
+    from app.services import TEXT_MODEL
+
+    client = Mistral(api_key=os.environ["MISTRAL_API_KEY"], async_client=httpx.AsyncClient(timeout=60))
+
+    async def ttft(system: str, task: str) -> tuple[float, int]:
+        t0 = time.perf_counter()
+        first, prompt_tokens = None, 0
+        stream = await client.chat.stream_async(
+            model=TEXT_MODEL,
+            messages=[{"role": "system", "content": system}, {"role": "user", "content": task}],
+        )
+        async for event in stream:
+            if first is None and event.data.choices and event.data.choices[0].delta.content:
+                first = time.perf_counter() - t0
+            if event.data.usage is not None:
+                prompt_tokens = event.data.usage.prompt_tokens
+        return first or 0.0, prompt_tokens
+
+    full_t, full_tok, mod_t, mod_tok = [], [], [], []
+    for _, task in TASKS[:n]:
+        # по очереди, чтобы прогрев и загрузка API были одинаковыми для обоих вариантов
+        t, k = await ttft(TEACHER_SYSTEM, task)
+        full_t.append(t)
+        full_tok.append(k)
+        t, k = await ttft(system_for(task), task)
+        mod_t.append(t)
+        mod_tok.append(k)
+
+    print(f"\nlive, {len(full_t)} tasks, {TEXT_MODEL}:")
+    print(f"  prompt_tokens avg: full {sum(full_tok) / len(full_tok):.0f}, "
+          f"assembled {sum(mod_tok) / len(mod_tok):.0f}")
+    print(f"  time to first token p50: full {pct(full_t, .5) * 1000:.0f} ms, "
+          f"assembled {pct(mod_t, .5) * 1000:.0f} ms")
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--live", type=int, default=0, help="сколько задач прогнать через Mistral")
+    args = ap.parse_args()
+
+    full = len(TEACHER_SYSTEM)
+    print(f"full prompt: {full} chars, ~{tokens(TEACHER_SYSTEM)} tokens")
+
+    by_subject: dict[str, list[int]] = {}
+    correct, fallback = 0, 0
+    for label, task in TASKS:
+        picked = classify(task)
+        correct += label in picked
+        fallback += not picked
+        by_subject.setdefault(label, []).append(len(system_for(task)))
+        if label not in picked:
+            print(f"  miss: {label} -> {picked or 'full prompt'}: {task[:60]}")
+
+    total = 0
+    for label, sizes in by_subject.items():
+        avg = sum(sizes) / len(sizes)
+        total += sum(sizes)
+        print(f"  {label:<11} ~{avg / CHARS_PER_TOKEN:.0f} tokens ({1 - avg / full:.0%} less)")
+    avg = total / len(TASKS)
+    print(f"assembled avg: {avg:.0f} chars, ~{avg / CHARS_PER_TOKEN:.0f} tokens ({1 - avg / full:.0%} less)")
+    print(f"classifier: {correct}/{len(TASKS)} right subject, {fallback} fell back to the full prompt")
+
+    lat = []
+    for _ in range(200):
+        for _, task in TASKS:
+            t0 = time.perf_counter()
+            system_for(task)
+            lat.append((time.perf_counter() - t0) * 1000)
+    print(f"classify + assemble: p50 {pct(lat, .5):.3f} ms, p99 {pct(lat, .99):.3f} ms")
+
+    tiers: dict[str, list[int]] = {}
+    for label, task in TASKS:
+        tiers.setdefault(label, [0] * len(TIER_NAMES))[tier_for(task)] += 1
+    print("routing (" + " / ".join(TIER_NAMES) + "):")
+    for label, counts in tiers.items():
+        print(f"  {label:<11} " + " / ".join(map(str, counts)))
+
+    if args.live:
+        asyncio.run(live(args.live))
+
+
+if __name__ == "__main__":
+    main()
@@ -8,7 +8,9 @@ from aiogram.fsm.storage.memory import MemoryStorage
 
 from app.config import BOT_TOKEN
 from app.handlers import router # router → «набор правил: кто на какие сообщения отвечает»
-from app.db import init_db
+from app.db import init_db, close_db
+from app.services import close_clients
+from app.vision import close_ocr_client
 
 # НА ЭТОМ ЭТАПЕ ПОДГОТОВИЛИ "ДЕТАЛИ"
 
@@ -17,6 +19,9 @@ from app.db import init_db
 logging.basicConfig(level=logging.INFO) # Показывай сообщения уровня INFO и выше
 
 async def main():
+    # токен нужен только боту: batch.py и бенчмарки работают с той же базой и без него
+    if not BOT_TOKEN:
+        raise ValueError("BOT_TOKEN is missing in .env") #чтобы бот не стартовал “пустым” и не падал потом непонятно где
     await init_db()
     bot = Bot(token=BOT_TOKEN) # Создаю объект bot, который умеет: отправлять сообщения, получать апдейты, общаться с Telegram API. ⚠️ Здесь нет подключения к Telegram, просто объект.
     
@@ -25,7 +30,12 @@ async def main():
     dp.include_router(router) # Подключаю набор правил (router), где написано: если /start → делай X, если текст → делай Y. 📌 Без этого бот бы молчал, даже если Telegram присылал сообщения
 
     await bot(DeleteWebhook(drop_pending_updates=True)) #Telegram, забудь старые сообщения, которые накопились, пока бот был выключен
-    await dp.start_polling(bot) # 🔥 ВОТ ЗДЕСЬ БОТ ОЖИЛ. Запускаю бесконечный цикл: спрашиваю есть новые сообщения, если есть, то передаю диспечеру
+    try:
+        await dp.start_polling(bot) # 🔥 ВОТ ЗДЕСЬ БОТ ОЖИЛ. Запускаю бесконечный цикл: спрашиваю есть новые сообщения, если есть, то передаю диспечеру
+    finally:
+        await close_db() # закрываю соединения с базой, чтобы WAL корректно схлопнулся
+        await close_clients() # и HTTP-пул к Mistral
+        await close_ocr_client() # и к Gemini
 
 if __name__ == "__main__": # Этот файл запущен напрямую, а не импортирован — значит, можно стартовать
     asyncio.run(main())